@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+bench.py
+Scale benchmark for rag.py (full schema) and rag-ultralight.py.
+
+- Generates N synthetic lessons that validate against each script's DEFAULT_SCHEMA
+  (enums are read from the schema itself, rag blocks come from the script's ensure_rag).
+- Runs validate, build-index and a query workload end to end, each stage in its own process.
+- Reports wall time, peak RSS, files/sec, encodes/sec, query p50/p95/p99 and recall@k of
+  the store's index against exact search, and saves everything as JSON for tracking regressions.
+
+Usage:
+  python3 bench.py generate --flavor full --n 1000 --out ./bench/data
+  python3 bench.py run --flavor ultralight --scales 1000,10000 --out bench-ultralight.json
+  python3 bench.py run --flavor full --scales 1000,10000,100000 --index-type hnsw --jobs 8 --out bench-full-hnsw.json
+  python3 bench.py run --flavor ultralight --scales 100000 --vector-dtype int8 --pca-dim 128 --out bench-int8.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+from rag_common import compile_validator, index_vectors, validate_json
+
+HERE = Path(__file__).resolve().parent
+SCRIPTS = {"full": HERE / "rag.py", "ultralight": HERE / "rag-ultralight.py"}
+FILES_PER_DIR = 1000  # keep generated directories small at 1M scale
+
+# ---------- synthetic lessons ----------
+SUBJECTS = [
+    "data contract", "timezone overlap", "HIPAA review", "vendor API", "GPU quota", "model drift monitor",
+    "staging environment", "sprint scope", "effort estimate", "stakeholder sign-off", "on-call rotation",
+    "SOC 2 audit", "labeling backlog", "feature store", "client SSO integration", "release freeze",
+    "cost forecast", "pilot success criteria", "data retention policy", "load test", "schema migration",
+    "PII redaction", "handover document", "demo environment", "access request", "annotation guideline",
+]
+MISTAKES = [
+    ("skip", "was skipped to save time"),
+    ("assume", "was assumed to be ready without checking"),
+    ("postpone", "was postponed until the last week"),
+    ("underestimate", "was underestimated by more than half"),
+    ("ignore", "was ignored until the client escalated"),
+    ("hand-wave", "was agreed verbally but never written down"),
+]
+CONSEQUENCES = [
+    "the team lost a full sprint to rework", "the client escalated to their executive sponsor",
+    "the launch slipped by three weeks", "costs overran the fixed bid", "a compliance finding blocked the release",
+    "two engineers were pulled into firefighting", "the pilot was paused pending review",
+]
+FIXES = [
+    "put it on the kickoff checklist with a named owner", "add a go/no-go gate that checks it explicitly",
+    "timebox a spike in the first week to surface it", "review it in every weekly risk meeting",
+    "get written sign-off from the client before building on it", "automate a check for it in CI",
+]
+INDUSTRIES = ["Healthcare", "Biotech", "Pharma", "Fintech", "Retail", "Logistics", "Media", "Energy", "Insurance"]
+UL_PHASES = ["Discovery", "Kickoff", "Execution", "Delivery", "Handover"]
+UL_CATEGORIES = ["Scope", "Team Coordination", "Compliance", "Data", "Infrastructure", "Communication"]
+
+def load_script(path: Path):
+    """Import rag.py / rag-ultralight.py as a module (the hyphen rules out a plain import)."""
+    spec = importlib.util.spec_from_file_location(path.stem.replace("-", "_"), path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def _enum(schema: Dict[str, Any], *path: str) -> List[str]:
+    node = schema
+    for key in path:
+        node = node["properties"][key]
+    return node["enum"]
+
+def make_lesson(i: int, rng: random.Random, flavor: str, mod) -> Dict[str, Any]:
+    subject = rng.choice(SUBJECTS)
+    verb, happened = rng.choice(MISTAKES)
+    consequence = rng.choice(CONSEQUENCES)
+    fix = rng.choice(FIXES)
+    industries = rng.sample(INDUSTRIES, rng.randint(1, 2))
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=rng.randrange(60 * 24 * 600))
+    base = {
+        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "title": f"Do not {verb} the {subject} (case {i})",
+        "summary": f"On a {industries[0].lower()} engagement the {subject} {happened}, and {consequence}.",
+        "industries": industries,
+        "guidance": {
+            "do_not_do": f"Do not {verb} the {subject} because the schedule looks tight.",
+            "do_instead": f"Treat the {subject} as a first-class risk: {fix}.",
+        },
+        "tags": sorted({subject.split()[0].capitalize(), verb.capitalize(), industries[0]}),
+        "created_at": created.isoformat().replace("+00:00", "Z"),
+    }
+    what = f"Midway through delivery the {subject} {happened}; nobody owned it and {consequence}."
+    cause = f"No owner or checkpoint existed for the {subject}."
+    schema = mod.DEFAULT_SCHEMA
+    if flavor == "ultralight":
+        level = rng.randint(1, 5)
+        doc = {
+            **base,
+            "phase": rng.choice(UL_PHASES),
+            "client_name": f"Client {rng.randrange(500)}",
+            "project_type": rng.choice(["POC", "MVP", "Production"]),
+            "incident": {
+                "what_happened": what,
+                "root_cause": cause,
+                "root_cause_category": rng.choice(UL_CATEGORIES),
+                "impact": {"level": level, "description": mod.IMPACT_MAP[level]},
+            },
+            "author": "bench",
+        }
+        return mod.ensure_rag(doc)
+    start = created.date()
+    doc = {
+        **base,
+        "phase": rng.choice(_enum(schema, "phase")),
+        "area": rng.choice(_enum(schema, "area")),
+        "severity": rng.choice(_enum(schema, "severity")),
+        "confidence": rng.randint(1, 5),
+        "evidence_strength": rng.choice(_enum(schema, "evidence_strength")),
+        "lesson_type": rng.choice(_enum(schema, "lesson_type")),
+        "guidance": {**base["guidance"], "checklists": [f"Name an owner for the {subject}", "Review weekly"]},
+        "incident": {
+            "context": {
+                "project_goal": f"Deliver a {industries[0].lower()} {rng.choice(['dashboard', 'ML pilot', 'data platform'])}",
+                "client_profile": {
+                    "industry": industries[0],
+                    "size": rng.choice(_enum(schema, "incident", "context", "client_profile", "size")),
+                    "delivery_model": rng.choice(_enum(schema, "incident", "context", "client_profile", "delivery_model")),
+                },
+            },
+            "what_happened": what,
+            "root_cause": cause,
+            "root_cause_category": rng.choice(_enum(schema, "incident", "root_cause_category")),
+            "timeline": {"start": start.isoformat(), "end": (start + timedelta(days=rng.randint(3, 60))).isoformat()},
+        },
+        "impact": {
+            "time_hours": rng.randint(4, 400),
+            "cost_currency": {"amount": rng.randint(0, 100_000), "currency": "USD"},
+            "quality": f"Deliverable quality dropped while the {subject} was fixed.",
+            "client_sentiment_before": rng.randint(0, 5),
+            "client_sentiment_after": rng.randint(-5, 2),
+            "mttd_hours": rng.randint(1, 200),
+            "mttr_hours": rng.randint(1, 400),
+        },
+        "signals": [f"{subject.capitalize()} not on the plan", "No named owner"],
+        "controls": [{"name": f"{subject.capitalize()} gate", "kind": rng.choice(["preventative", "detective", "corrective"]),
+                      "is_automatable": rng.random() < 0.3}],
+        "evidence": [{"kind": "Doc", "title": "Retro notes", "url_or_path": f"docs/retro-{i}.md",
+                      "confidentiality": rng.choice(["Public", "Internal", "Restricted"])}],
+        "authorship": {"authors": [{"display": "Bench Bot", "role": "TPM", "org": "Loka"}],
+                       "review": {"status": "approved"}},
+        "confidentiality": rng.choice(["Public", "Internal", "Internal", "Restricted"]),
+        "updated_at": base["created_at"],
+        "version": "1.0.0",
+    }
+    return mod.ensure_rag(doc)
+
+def make_queries(n: int, seed: int) -> List[str]:
+    rng = random.Random(seed + 1)
+    return [f"{rng.choice(INDUSTRIES)} project: avoid problems with the {rng.choice(SUBJECTS)}"
+            f" {rng.choice(['in kickoff', 'before launch', 'during delivery', 'with the client'])}" for _ in range(n)]
+
+def generate(flavor: str, n: int, out: Path, seed: int = 0, queries: int = 200) -> Dict[str, Any]:
+    """Write n lessons (FILES_PER_DIR per subdirectory) plus queries.jsonl next to them."""
+    mod = load_script(SCRIPTS[flavor])
+    validator = compile_validator(mod.DEFAULT_SCHEMA)
+    rng = random.Random(seed)
+    if out.exists():
+        shutil.rmtree(out)
+    t0 = time.perf_counter()
+    for i in range(n):
+        doc = make_lesson(i, rng, flavor, mod)
+        if i < 50:  # spot-check that the generator still matches the schema
+            ok, msg = validate_json(doc, mod.DEFAULT_SCHEMA, validator)
+            if not ok:
+                raise RuntimeError(f"Generated lesson {i} does not match the {flavor} schema:\n{msg}")
+        d = out / "data" / f"{i // FILES_PER_DIR:05d}"
+        if i % FILES_PER_DIR == 0:
+            d.mkdir(parents=True, exist_ok=True)
+        with open(d / f"lesson-{i:07d}.json", "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False)
+    with open(out / "queries.jsonl", "w", encoding="utf-8") as f:
+        for q in make_queries(queries, seed):
+            f.write(json.dumps({"q": q}) + "\n")
+    wall = time.perf_counter() - t0
+    return {"n": n, "wall_s": round(wall, 3), "files_per_s": round(n / max(wall, 1e-9), 1)}
+
+# ---------- stages ----------
+def run_stage(cmd: List[str]) -> Dict[str, Any]:
+    """Run one stage in a child process; wall time + that child's own peak RSS."""
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([str(c) for c in cmd], stdout=subprocess.PIPE, text=True)
+    out = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - t0
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {"cmd": " ".join(map(str, cmd[1:])), "returncode": proc.returncode,
+            "wall_s": round(wall, 3), "peak_rss_mb": round(rss, 1), "stdout": out}
+
+def percentile(values: List[float], pct: float) -> float:
+    vals = sorted(values)
+    if not vals:
+        return 0.0
+    i = min(len(vals) - 1, max(0, int(round(pct / 100.0 * (len(vals) - 1)))))
+    return vals[i]
+
+def cmd_query_stage(args):
+    """Child process of `run`: query latency, encoder throughput and recall@k vs exact search."""
+    import faiss  # type: ignore
+    import numpy as np
+    mod = load_script(Path(args.script))
+    with open(args.queries, "r", encoding="utf-8") as f:
+        queries = [json.loads(line)["q"] for line in f if line.strip()]
+    retriever = mod.Retriever(Path(args.store))
+    retriever.search(queries[0], k=args.k, mode=args.mode)  # warm up: model + index load
+
+    latencies = []
+    for q in queries:
+        t0 = time.perf_counter()
+        retriever.search(q, k=args.k, mode=args.mode)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+
+    # Encoder throughput on its own (the retriever's embedder has no cache)
+    t0 = time.perf_counter()
+    xq = retriever.embedder.embed(queries).astype("float32")
+    encodes_per_s = len(queries) / max(time.perf_counter() - t0, 1e-9)
+
+    # recall@k: the store's index (flat / IVF / HNSW) against brute force over its own vectors
+    faiss.normalize_L2(xq)
+    index = retriever.view.index
+    ids, vecs = index_vectors(index)
+    exact = faiss.IndexFlatIP(vecs.shape[1])
+    exact.add(np.ascontiguousarray(vecs, dtype="float32"))
+    _, gt = exact.search(xq, args.k)
+    _, got = index.search(xq, args.k)
+    recall = float(np.mean([len(set(ids[g[g >= 0]].tolist()) & set(r[r >= 0].tolist())) / args.k
+                            for g, r in zip(gt, got)]))
+
+    print(json.dumps({
+        "queries": len(queries),
+        "mode": args.mode,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "encodes_per_s": round(encodes_per_s, 1),
+        f"recall_at_{args.k}": round(recall, 4),
+    }))
+    return 0
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return ""
+
+def cmd_generate(args):
+    info = generate(args.flavor, args.n, Path(args.out), seed=args.seed, queries=args.queries)
+    print(f"✅ Generated {info['n']} {args.flavor} lessons under {Path(args.out) / 'data'} "
+          f"in {info['wall_s']}s ({info['files_per_s']} files/s)")
+    return 0
+
+def cmd_run(args):
+    script = SCRIPTS[args.flavor]
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    report: Dict[str, Any] = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_rev": git_rev(),
+        "flavor": args.flavor,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"index_type": args.index_type, "vector_dtype": args.vector_dtype, "pca_dim": args.pca_dim,
+                   "jobs": args.jobs, "k": args.k, "mode": args.mode,
+                   "queries": args.queries, "embed_cache": args.embed_cache, "seed": args.seed},
+        "scales": [],
+    }
+    out_path = Path(args.out)
+    for n in scales:
+        work = Path(args.workdir) / f"{args.flavor}-{n}"
+        data, store = work / "data", work / "store"
+        if n >= 100_000:
+            print(f"⚠️  {n} lessons: generation and build can take a long time.", file=sys.stderr)
+        gen = generate(args.flavor, n, work, seed=args.seed, queries=args.queries)
+
+        validate = run_stage([sys.executable, script, "validate", "--data", data, "--jobs", args.jobs])
+        validate["files_per_s"] = round(n / max(validate["wall_s"], 1e-9), 1)
+
+        build_cmd = [sys.executable, script, "build-index", "--data", data, "--out", store, "--reset",
+                     "--index-type", args.index_type, "--jobs", args.jobs]
+        if not args.embed_cache:
+            build_cmd.append("--no-embed-cache")
+        compressed = args.vector_dtype != "float32" or args.pca_dim
+        if compressed:
+            # the query stage's recall is against the index's own (compressed) vectors;
+            # build-index compares against exact float32 search instead
+            build_cmd += ["--vector-dtype", args.vector_dtype, "--check-recall", args.queries]
+            if args.pca_dim:
+                build_cmd += ["--pca-dim", args.pca_dim]
+        build = run_stage(build_cmd)
+        m = re.search(r"\((\d+) embedded", build["stdout"])
+        embedded = int(m.group(1)) if m else 0
+        build.update(files_per_s=round(n / max(build["wall_s"], 1e-9), 1), embedded=embedded,
+                     encodes_per_s=round(embedded / max(build["wall_s"], 1e-9), 1))
+        m = re.search(r"recall@\d+ vs exact float32 search: ([\d.]+)", build["stdout"])
+        if m:
+            build["recall_vs_float32"] = float(m.group(1))
+        current = store / "CURRENT"
+        gen_dir = store / "generations" / current.read_text(encoding="utf-8").strip() if current.exists() else store
+        if (gen_dir / "index.faiss").exists():
+            build["index_mb"] = round((gen_dir / "index.faiss").stat().st_size / 2**20, 2)
+
+        query = run_stage([sys.executable, Path(__file__).resolve(), "query-stage", "--script", script,
+                           "--store", store, "--queries", work / "queries.jsonl", "-k", args.k, "--mode", args.mode])
+        try:
+            query.update(json.loads(query["stdout"].strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+            pass
+
+        for stage in (validate, build, query):
+            stage.pop("stdout")
+        report["scales"].append({"n": n, "generate": gen, "validate": validate, "build": build, "query": query})
+        # saved after every scale, so a long run that dies still leaves its results
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        vs_f32 = f", recall vs float32 {build['recall_vs_float32']}" if "recall_vs_float32" in build else ""
+        status = "✅" if not (validate["returncode"] or build["returncode"] or query["returncode"]) else "❌"
+        print(f"{status} {n} lessons | validate {validate['wall_s']}s ({validate['files_per_s']} files/s, "
+              f"{validate['peak_rss_mb']} MB) | build {build['wall_s']}s ({build['files_per_s']} files/s, "
+              f"{build['encodes_per_s']} enc/s, {build['peak_rss_mb']} MB, index {build.get('index_mb')} MB{vs_f32}) "
+              f"| query p50={query.get('p50_ms')}ms "
+              f"p95={query.get('p95_ms')}ms p99={query.get('p99_ms')}ms "
+              f"recall@{args.k}={query.get(f'recall_at_{args.k}')} ({query['peak_rss_mb']} MB)", flush=True)
+        if not args.keep_data:
+            shutil.rmtree(work, ignore_errors=True)
+    print(f"✅ Results saved to {out_path}")
+    return 0
+
+def main():
+    p = argparse.ArgumentParser(description="Scale benchmark for the Antifragile RAG scripts")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    g = sub.add_parser("generate", help="Write N schema-conforming synthetic lessons")
+    g.add_argument("--flavor", choices=sorted(SCRIPTS), default="ultralight")
+    g.add_argument("--n", type=int, required=True, help="Number of lessons")
+    g.add_argument("--out", required=True, help="Output dir (lessons go to <out>/data, queries to <out>/queries.jsonl)")
+    g.add_argument("--seed", type=int, default=0)
+    g.add_argument("--queries", type=int, default=200, help="Number of benchmark queries to write")
+    g.set_defaults(func=cmd_generate)
+
+    r = sub.add_parser("run", help="Generate, validate, build and query at each scale; save JSON results")
+    r.add_argument("--flavor", choices=sorted(SCRIPTS), default="ultralight")
+    r.add_argument("--scales", default="1000,10000", help="Comma-separated corpus sizes (e.g. 1000,10000,100000,1000000)")
+    r.add_argument("--out", default="bench-results.json", help="JSON results file")
+    r.add_argument("--workdir", default="./bench_work", help="Scratch dir for generated data + stores")
+    r.add_argument("--keep-data", action="store_true", help="Keep generated lessons and stores after each scale")
+    r.add_argument("--index-type", choices=("flat", "ivf", "hnsw"), default="flat")
+    r.add_argument("--vector-dtype", choices=("float32", "float16", "int8"), default="float32",
+                   help="Flat stores: vector storage passed to build-index (compressed runs also report recall vs float32)")
+    r.add_argument("--pca-dim", type=int, default=None, help="Flat stores: PCA dimension passed to build-index")
+    r.add_argument("--jobs", type=int, default=1, help="Worker processes for validate/build-index")
+    r.add_argument("-k", type=int, default=10, help="Top-k for queries and recall@k")
+    r.add_argument("--mode", choices=("dense", "lexical", "hybrid"), default="dense", help="Query mode to time")
+    r.add_argument("--queries", type=int, default=200, help="Queries per scale")
+    r.add_argument("--embed-cache", action="store_true", help="Let build-index use the embedding cache (default: off, to time real encoding)")
+    r.add_argument("--seed", type=int, default=0)
+    r.set_defaults(func=cmd_run)
+
+    qs = sub.add_parser("query-stage", help=argparse.SUPPRESS)
+    qs.add_argument("--script", required=True)
+    qs.add_argument("--store", required=True)
+    qs.add_argument("--queries", required=True)
+    qs.add_argument("-k", type=int, default=10)
+    qs.add_argument("--mode", default="dense")
+    qs.set_defaults(func=cmd_query_stage)
+
+    args = p.parse_args()
+    try:
+        rc = args.func(args)
+    except Exception as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        rc = 1
+    sys.exit(rc)
+
+if __name__ == "__main__":
+    main()
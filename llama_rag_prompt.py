@@ -1,29 +1,94 @@
 #!/usr/bin/env python3
+import hashlib
+import os
 import subprocess
 import json
-import shlex
 import textwrap
 import sys
 import shutil
 import textwrap
 import re
 import argparse
+import asyncio
+import http.client
+import importlib.util
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import logging
-from typing import Any, Dict, List, Union, Optional
+from typing import Any, Dict, List, Tuple, Union, Optional
+
+from rag_common import Metrics
 
 log = logging.getLogger(__name__)
 
-def run_rag(query: str, rag_script: str, rag_store: str, k: int):
-    """Run rag-ultralight.py query and return parsed JSON results"""
-    cmd = (
-        f"python3 {shlex.quote(rag_script)} query "
-        f"--store {shlex.quote(rag_store)} "
-        f"--q {shlex.quote(query)} "
-        f"-k {k} "
-        f"--json-response"
-    )
-    raw = subprocess.check_output(cmd, shell=True, text=True)
+# Same span/counter layer as rag.py / rag-ultralight.py: off unless --timings / --profile / --metrics-file.
+# A separate instance, so an in-process retriever's own METRICS stay apart in --timings.
+METRICS = Metrics(prefix="llama_rag")
+
+def load_rag_module(rag_script: str):
+    """Import rag-ultralight.py (or rag.py) as a module; the hyphen rules out a plain import."""
+    path = Path(rag_script).resolve()
+    name = path.stem.replace("-", "_")
+    mod = sys.modules.get(name)
+    if mod is not None and getattr(mod, "__file__", None) == str(path):
+        return mod
+    spec = importlib.util.spec_from_file_location(name, path)
+    if spec is None or spec.loader is None:
+        raise FileNotFoundError(f"RAG script not found: {rag_script}")
+    if str(path.parent) not in sys.path:
+        sys.path.insert(0, str(path.parent))  # for its `from rag_common import ...`
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+def load_retriever(rag_script: str, rag_store: str):
+    """
+    Load the store once, in this process (FAISS index now, embedding model on first miss).
+    Repeated questions are served from an in-memory query cache without touching the model.
+    """
+    mod = load_rag_module(rag_script)
+    mod.METRICS.enabled = METRICS.enabled
+    cache = mod.QueryCache() if hasattr(mod, "QueryCache") else None
+    kwargs = {"cache": cache} if cache is not None else {}
+    return mod.Retriever(Path(rag_store), **kwargs)
+
+def run_rag(query: str, rag_script: str, rag_store: str, k: int, rag_url: Optional[str] = None,
+            retriever: Optional[Any] = None):
+    """
+    Run a RAG query and return the `query --json-response` payload.
+    With retriever (see load_retriever), search in-process; with rag_url, ask a running
+    `rag-ultralight.py serve`; otherwise spawn `rag-ultralight.py query` and parse its stdout.
+    """
+    if retriever is not None:
+        with METRICS.span("rag.in_process"):
+            data = retriever.search(query, k=k)
+        METRICS.count("rag.results", len(data["results"]))
+        return data
+
+    if rag_url:
+        req = urllib.request.Request(
+            rag_url.rstrip("/") + "/query",
+            data=json.dumps({"q": query, "k": k}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with METRICS.span("rag.http"), urllib.request.urlopen(req, timeout=60) as resp:
+            raw = resp.read().decode("utf-8")
+    else:
+        cmd = [
+            sys.executable, rag_script, "query",
+            "--store", rag_store,
+            "--q", query,
+            "-k", str(k),
+            "--json-response",
+        ]
+        # includes interpreter start + model load in the child; compare with --rag-url to see that cost
+        with METRICS.span("rag.subprocess"):
+            raw = subprocess.check_output(cmd, text=True)
     log.debug("RAG raw output: %s", raw)
     data = json.loads(raw)
 
@@ -40,7 +105,8 @@ def run_rag(query: str, rag_script: str, rag_store: str, k: int):
     if "query" not in data:
         log.warning("RAG JSON missing 'query' field; proceeding with empty string.")
         data["query"] = query
-    
+    METRICS.count("rag.results", len(data["results"]))
+
     return data
 
 def build_context(results: list, max_len: int = 200) -> str:
@@ -122,14 +188,181 @@ def dumps_compact(obj: Any) -> str:
     return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
 
 
+# Words, numbers and single symbols; long words are split the way BPE vocabularies tend to
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+
+def approx_tokens(text: str) -> int:
+    """Fast local estimate of Llama-style BPE token counts (usually within ~10% on English prose/JSON)."""
+    n = 0
+    for m in _TOKEN_RE.finditer(text):
+        w = m.group()
+        n += 1 + (len(w) - 1) // 7 if w[0].isalpha() else 1
+    return n
+
+class TokenCounter:
+    """
+    Counts prompt tokens with the target model's tokenizer when a llama-server is
+    available (its /tokenize endpoint), otherwise with approx_tokens().
+    """
+    def __init__(self, server: Optional["LlamaServer"] = None):
+        self.server = server
+        self.exact = server is not None
+        self._fixed: Dict[str, int] = {}
+
+    def __call__(self, text: str) -> int:
+        if self.exact:
+            try:
+                return self.server.tokenize(text)
+            except (OSError, RuntimeError, KeyError, ValueError) as e:
+                log.debug("llama server tokenizer unavailable (%s); estimating token counts locally", e)
+                self.exact = False
+        return approx_tokens(text)
+
+    def fixed(self, text: str) -> int:
+        """Count for prompt text that is identical for every question: tokenized once per run."""
+        n = self._fixed.get(text)
+        if n is None:
+            n = self._fixed[text] = self(text)
+        return n
+
+def pack_context(
+    rag: Dict[str, Any],
+    budget: int,
+    count_tokens=approx_tokens,
+    *,
+    include_titles: bool = True,
+    min_impact: int = 0,
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Greedily pack the highest-impact items of a RAG payload into `budget` tokens of
+    compact CONTEXT JSON. Items that don't fit are skipped, so a smaller lower-impact
+    item can still use the remaining room. Returns (context object, tokens used).
+    """
+    compact = to_compact_context(rag, include_titles=include_titles, min_impact=min_impact)
+    packed: Dict[str, Any] = {"query": compact["query"], "results": []}
+    used = count_tokens(dumps_compact(packed))
+    for item in compact["results"]:
+        cost = count_tokens(dumps_compact(item)) + 1  # + the separating comma
+        if used + cost > budget:
+            METRICS.count("context.items_dropped")
+            continue
+        packed["results"].append(item)
+        used += cost
+    return packed, used
+
+
+# Sampling + stop words shared by the llama-cli and llama-server backends
+SAMPLING = {"temperature": 0.2, "top_p": 0.95, "repeat_penalty": 1.25, "repeat_last_n": 320}
+STOP_WORDS = ["CONTEXT_START", "CONTEXT_END", "QUESTION:", "Answer:", "Answers:"]
+
+class LlamaServer:
+    """
+    Client for a long-running `llama-server` (llama.cpp's OpenAI-compatible HTTP server),
+    e.g. `llama-server -m model.gguf --port 8080`. The model stays loaded between questions,
+    and each thread keeps one keep-alive connection open.
+    """
+    def __init__(self, url: str, timeout_sec: int = 300):
+        u = urllib.parse.urlsplit(url if "://" in url else f"http://{url}")
+        if u.scheme != "http":
+            raise ValueError(f"Only http:// llama server URLs are supported, got {url!r}")
+        self.url = url
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 80
+        self.base = u.path.rstrip("/")
+        self.timeout_sec = timeout_sec
+        self._local = threading.local()
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout_sec)
+        return conn
+
+    def _post(self, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        payload = json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        for attempt in (0, 1):
+            conn = self._conn()
+            try:
+                conn.request("POST", self.base + path, body=payload, headers=headers)
+                resp = conn.getresponse()
+                raw = resp.read()
+                break
+            except Exception as e:
+                # never reuse a connection left mid-request; a fresh one is opened next time
+                conn.close()
+                self._local.conn = None
+                # the server closed an idle keep-alive connection: reconnect once
+                stale = isinstance(e, (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError))
+                if attempt or not stale:
+                    raise
+        if resp.status != 200:
+            raise RuntimeError(f"llama server {self.url} returned HTTP {resp.status}: {raw[:300]!r}")
+        return json.loads(raw)
+
+    def tokenize(self, text: str) -> int:
+        """Token count from the loaded model's own tokenizer (llama.cpp's /tokenize)."""
+        return len(self._post("/tokenize", {"content": text})["tokens"])
+
+    def chat(self, system_msg: str, user_msg: str, n_predict: int = 512) -> str:
+        body = {
+            "messages": [
+                {"role": "system", "content": system_msg},
+                {"role": "user", "content": user_msg},
+            ],
+            "max_tokens": n_predict,
+            "stop": STOP_WORDS,
+            # reuse the slot's KV cache for the shared prefix (system prompt + instructions)
+            "cache_prompt": True,
+            **SAMPLING,
+        }
+        data = self._post("/v1/chat/completions", body)
+        return data["choices"][0]["message"]["content"] or ""
+
 def query_llama(system_msg: str, 
                 user_msg: str,
                 llama_bin: str,
                 model_path: str,
                 n_predict: int = 512,
-                timeout_sec: int = 300) -> str:
+                timeout_sec: int = 300,
+                server: Optional[LlamaServer] = None,
+                ctx_size: int = 4096,
+                prompt_cache: Optional[Path] = None) -> str:
     """
     Calls llama.cpp and returns ONLY the generated text as a Python string.
+    With `server`, asks the running llama-server; if it can't be reached, falls back
+    to spawning llama-cli (which reloads the model on every call). `prompt_cache` is the
+    llama-cli --prompt-cache file (see prompt_cache_path); the server keeps its own in memory.
+    """
+    # Clean whitespace
+    system_msg = textwrap.dedent(system_msg).strip()
+    user_msg   = textwrap.dedent(user_msg).strip()
+
+    if server is not None:
+        try:
+            with METRICS.span("llama.server"):
+                out = server.chat(system_msg, user_msg, n_predict=n_predict)
+            METRICS.count("llama.output_chars", len(out))
+            return out.strip()
+        except TimeoutError:
+            raise
+        except OSError as e:
+            METRICS.count("llama.server_fallbacks")
+            log.warning("llama server %s unavailable (%s); falling back to %s", server.url, e, llama_bin)
+
+    return query_llama_cli(system_msg, user_msg, llama_bin, model_path, n_predict, timeout_sec, ctx_size,
+                           prompt_cache=prompt_cache)
+
+def query_llama_cli(system_msg: str,
+                    user_msg: str,
+                    llama_bin: str,
+                    model_path: str,
+                    n_predict: int = 512,
+                    timeout_sec: int = 300,
+                    ctx_size: int = 4096,
+                    prompt_cache: Optional[Path] = None) -> str:
+    """
+    One llama-cli process per call.
     Works with builds that don't support -ins/--system.
     """
 
@@ -138,31 +371,31 @@ def query_llama(system_msg: str,
     
     if not Path(model_path).is_file():
         raise FileNotFoundError(f"model file not found: {model_path}")
-    
-     # Clean whitespace
-    system_msg = textwrap.dedent(system_msg).strip()
-    user_msg   = textwrap.dedent(user_msg).strip()
 
     cmd = [
         llama_bin,
         "-m", model_path,
         "-t", "12", "--threads-batch", "12",
-        "--ctx-size", "4096",
-        "--temp", "0.2", "--top-p", "0.95",
-        "--repeat-penalty", "1.25", "--repeat-last-n", "320",
+        "--ctx-size", str(ctx_size),
+        "--temp", str(SAMPLING["temperature"]), "--top-p", str(SAMPLING["top_p"]),
+        "--repeat-penalty", str(SAMPLING["repeat_penalty"]), "--repeat-last-n", str(SAMPLING["repeat_last_n"]),
         "--n-predict", str(n_predict),
         "-no-cnv",
         "--system-prompt", system_msg,
         "--prompt", user_msg,
     ]
 
-    cmd.extend([
-        "--stop", "CONTEXT_START",
-        "--stop", "CONTEXT_END",
-        "--stop", "QUESTION:",
-        "--stop", "Answer:",
-        "--stop", "Answers:",
-    ])
+    for stop in STOP_WORDS:
+        cmd.extend(["--stop", stop])
+
+    if prompt_cache is not None:
+        # The first run saves its evaluated prompt; later runs load it read-only and only
+        # evaluate the tokens after the longest matching prefix (the static part).
+        prompt_cache.parent.mkdir(parents=True, exist_ok=True)
+        cmd.extend(["--prompt-cache", str(prompt_cache)])
+        if prompt_cache.exists():
+            METRICS.count("llama.prompt_cache_hits")
+            cmd.append("--prompt-cache-ro")
 
 
     # Capture stdout+stderr; llama.cpp prints loader info to stderr
@@ -171,14 +404,16 @@ def query_llama(system_msg: str,
     else:
         _stderr = subprocess.DEVNULL
 
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=_stderr,
-        text=True,
-        bufsize=1,
-    )
-    out, err = proc.communicate(timeout=timeout_sec)
+    with METRICS.span("llama.subprocess"):
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=_stderr,
+            text=True,
+            bufsize=1,
+        )
+        out, err = proc.communicate(timeout=timeout_sec)
+    METRICS.count("llama.output_chars", len(out))
 
     if proc.returncode != 0:
         raise RuntimeError(f"llama.cpp exited with code {proc.returncode}\n{err}")
@@ -186,6 +421,10 @@ def query_llama(system_msg: str,
     return out.strip()
 
 def clean_answer(ans: str) -> str:
+    with METRICS.span("llama.clean"):
+        return _clean_answer(ans)
+
+def _clean_answer(ans: str) -> str:
     # remove special tokens if any slipped through
     for tok in ("<|eot_id|>", "<|end_of_text|>"):
         ans = ans.replace(tok, "")
@@ -220,11 +459,27 @@ def main():
         default="./rag_store_ultralight",
         help="Path to RAG store (default: ./rag_store_ultralight)"
     )
+    parser.add_argument(
+        "--rag-url",
+        default=None,
+        help="URL of a running `rag-ultralight.py serve` (e.g. http://127.0.0.1:8765) instead of loading the store here"
+    )
+    parser.add_argument(
+        "--rag-subprocess",
+        action="store_true",
+        help="Run `--rag-script query` in a child process instead of importing it (slower; isolates the RAG stack)"
+    )
     parser.add_argument(
         "--llama-bin",
         default="../llama.cpp/build/bin/llama-cli",
         help="Path to llama.cpp binary (default: ../llama.cpp/build/bin/llama-cli)"
     )
+    parser.add_argument(
+        "--llama-url",
+        default=None,
+        help="URL of a running llama-server (e.g. http://127.0.0.1:8080); keeps the model loaded. "
+             "Falls back to --llama-bin if it can't be reached"
+    )
     parser.add_argument(
         "--model-path",
         default="../ai-llmacpp/models/llama/meta-llama-3.1-8b-instruct-q5_k_m.gguf",
@@ -236,12 +491,56 @@ def main():
         default=5,
         help="Top k results to get from RAG"
     )
-    parser.add_argument(
+    questions = parser.add_mutually_exclusive_group(required=True)
+    questions.add_argument(
         "-q", "--q", "--question",
         dest="question",
-        required=True,
         help="The question you want to ask"
     )
+    questions.add_argument(
+        "--questions",
+        metavar="FILE",
+        help="JSONL of questions ('-' = stdin); answers stream out as JSONL, one per question"
+    )
+    parser.add_argument(
+        "--out",
+        default=None,
+        help="With --questions: write answers here instead of stdout"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="With --questions: llama requests in flight (default: 4 for --llama-url, cores/12 for llama-cli)"
+    )
+    parser.add_argument(
+        "--ctx-size",
+        type=int,
+        default=4096,
+        help="Model context window in tokens (passed to llama-cli; match llama-server's -c)"
+    )
+    parser.add_argument(
+        "--n-predict",
+        type=int,
+        default=512,
+        help="Max tokens to generate; reserved out of --ctx-size"
+    )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=None,
+        help="Token budget for the CONTEXT block (default: whatever --ctx-size leaves after prompt + --n-predict)"
+    )
+    parser.add_argument(
+        "--prompt-cache-dir",
+        default=None,
+        help="Where llama-cli prompt caches live (default: $ANTIFRAGILE_PROMPT_CACHE or ~/.cache/antifragile-tpm/prompt-cache)"
+    )
+    parser.add_argument(
+        "--no-prompt-cache",
+        action="store_true",
+        help="Re-evaluate the whole prompt on every llama-cli call"
+    )
     parser.add_argument("-v", "--verbose", 
         action="store_true",
         help="See debug and troubleshooting information")
@@ -251,6 +550,18 @@ def main():
         default=True,
         help="Do not include lesson titles in CONTEXT")
 
+    parser.add_argument("--timings",
+        action="store_true",
+        help="Print per-stage timings + counters as JSON to stderr")
+    parser.add_argument("--profile",
+        metavar="FILE",
+        default=None,
+        help="Write a cProfile dump of the whole run")
+    parser.add_argument("--metrics-file",
+        metavar="PATH",
+        default=None,
+        help="Write Prometheus text-format metrics to PATH on exit")
+
     args = parser.parse_args()
     
     # Configure logging based on --verbose
@@ -259,61 +570,277 @@ def main():
         format="%(levelname)s: %(name)s: %(message)s"
     )
 
+    if not args.verbose:
+        logging.getLogger("faiss").setLevel(logging.WARNING)  # in-process RAG: hide faiss' loader chatter
     log.debug("CLI args: %s", vars(args))   # only prints when -v/--verbose is set
 
+    questions = None
+    if args.questions:
+        # read the whole file before loading anything, so a bad line fails fast and cleanly
+        try:
+            questions = load_questions(args.questions)
+        except (OSError, ValueError) as e:
+            parser.error(f"--questions: {e}")
+
+    METRICS.enabled = bool(args.timings or args.profile or args.metrics_file)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    retriever = None
+    rc = 0
+    try:
+        with METRICS.span("total"):
+            if not (args.rag_url or args.rag_subprocess):
+                with METRICS.span("rag.load"):
+                    retriever = load_retriever(args.rag_script, args.store)
+            if args.questions:
+                rc = asyncio.run(run_questions(args, questions, retriever))
+            else:
+                run_pipeline(args, retriever)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            log.info("Wrote cProfile stats to %s", args.profile)
+        if args.metrics_file:
+            METRICS.write_prometheus(args.metrics_file)
+        if args.timings:
+            report = {"timings": METRICS.snapshot()}
+            if retriever is not None:
+                report["retriever"] = sys.modules[type(retriever).__module__].METRICS.snapshot()
+            print(json.dumps(report, ensure_ascii=False), file=sys.stderr)
+    if rc:
+        sys.exit(rc)
+
+
+SYSTEM_MSG = (
+    "You are an expert Technical Project Manager coach.\n"
+    "TASK: Produce exactly one section: 'What NOT to do'.\n"
+    "OUTPUT FORMAT:\n"
+    "- Write 3–5 bullet points.\n"
+    "- Each bullet MUST start with: Do not \n"
+    "- Order bullets by highest impact first.\n"
+    "STYLE:\n"
+    "- Phrase each bullet in natural coaching language.\n"
+    "- Each bullet MUST include a brief consequence after an em dash (—), no period before the dash.\n"
+    "- Keep it concrete (operations, timelines, data quality, compliance) but concise.\n"
+    "HARD RULES:\n"
+    "- Use the CONTEXT only for reasoning; never copy or quote it.\n"
+    "- Output ONLY plain-text bullets (no JSON/arrays/quotes/headers/prefix hyphens or numbering).\n"
+    "- Your FIRST character must be 'D' from 'Do not '.\n"
+    "QUALITY CHECK:\n"
+    "- If any bullet lacks an em dash consequence, add one.\n"
+    "- If any line does not start with 'Do not ', rewrite it.\n"
+)
+
+USER_INSTRUCTIONS = (
+    "From the CONTEXT below, output 3–5 plain-text bullets.\n"
+    "Each MUST start with 'Do not ' and include an em dash (—) followed by a short consequence.\n"
+    "Do not include any headings, labels, or leading hyphens. The first character must be 'D'.\n\n"
+)
+
+def user_prompt(context_json: str, question: str) -> str:
+    # Static instructions first, per-question parts last: llama.cpp reuses the KV cache for the
+    # longest unchanged prompt prefix, so only the QUESTION + CONTEXT tail is prefilled per call.
+    return (
+        USER_INSTRUCTIONS
+        + f"QUESTION:\n{question}\n\n"
+        "CONTEXT_START\n"
+        f"{context_json}\n"
+        "CONTEXT_END\n"
+    )
+
+def default_prompt_cache_dir() -> Path:
+    env = os.environ.get("ANTIFRAGILE_PROMPT_CACHE")
+    return Path(env) if env else Path.home() / ".cache" / "antifragile-tpm" / "prompt-cache"
+
+def prompt_cache_path(cache_dir: Path, model_path: str, static_prefix: str) -> Path:
+    """
+    llama-cli --prompt-cache file for one model + static prompt prefix. The model is keyed by
+    path, size and mtime (a re-downloaded GGUF gets a fresh cache), the prompt by its hash.
+    """
+    model = Path(model_path).resolve()
+    st = model.stat()
+    model_key = hashlib.sha256(f"{model}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8")).hexdigest()[:12]
+    prompt_key = hashlib.sha256(static_prefix.encode("utf-8")).hexdigest()[:12]
+    return Path(cache_dir) / f"{model.stem}-{model_key}-{prompt_key}.bin"
+
+def build_prompt(args, question: str, rag: Dict[str, Any], count_tokens: TokenCounter) -> Tuple[str, Dict[str, Any]]:
+    """
+    Compact CONTEXT packed into whatever the context window leaves after the fixed prompt
+    text and the answer (prefill time grows with every prompt token). Returns (user_msg, stats).
+    """
+    with METRICS.span("context"):
+        # the fixed text is counted once per run; the short question is estimated locally
+        # rather than costing each question a /tokenize round trip
+        overhead = count_tokens.fixed(SYSTEM_MSG) + count_tokens.fixed(user_prompt("", "")) + approx_tokens(question)
+        budget = args.context_tokens or args.ctx_size - args.n_predict - overhead
+        if budget <= 0:
+            raise ValueError(f"--ctx-size {args.ctx_size} leaves no room for CONTEXT "
+                             f"(prompt ≈ {overhead} tokens + --n-predict {args.n_predict})")
+        context_obj, used = pack_context(rag, budget, count_tokens, include_titles=not args.no_titles)
+        context_json = dumps_compact(context_obj)
+    METRICS.count("context.tokens", used)
+    log.debug("CONTEXT JSON: %s", context_json)
+    stats = {"lessons": len(context_obj["results"]), "retrieved": len(rag.get("results", [])),
+             "context_tokens": used, "budget": budget, "prompt_tokens": overhead + used,
+             "exact_tokens": count_tokens.exact}
+    return user_prompt(context_json, question), stats
+
+def llama_prompt_cache(args) -> Optional[Path]:
+    if args.no_prompt_cache or not Path(args.model_path).is_file():
+        return None
+    return prompt_cache_path(args.prompt_cache_dir or default_prompt_cache_dir(), args.model_path,
+                             SYSTEM_MSG + USER_INSTRUCTIONS)
+
+def run_pipeline(args, retriever=None):
     # 1) RAG
     log.info("Querying RAG…")
-    rag = run_rag(args.question, args.rag_script, args.store, args.k)
+    rag = run_rag(args.question, args.rag_script, args.store, args.k, rag_url=args.rag_url, retriever=retriever)
     results = rag.get("results", [])
     if not results:
         print("No RAG results found.")
         return
 
-    # 2) Compact CONTEXT
+    # 2) Compact CONTEXT + final prompt
     log.info("Building CONTEXT…")
-    context_obj = to_compact_context(rag, include_titles=not args.no_titles)
-    context_json = dumps_compact(context_obj)
-    log.debug("CONTEXT JSON: %s", context_json)
-    
-    # 3) final system prompt
-
-    system_msg = (
-        "You are an expert Technical Project Manager coach.\n"
-        "TASK: Produce exactly one section: 'What NOT to do'.\n"
-        "OUTPUT FORMAT:\n"
-        "- Write 3–5 bullet points.\n"
-        "- Each bullet MUST start with: Do not \n"
-        "- Order bullets by highest impact first.\n"
-        "STYLE:\n"
-        "- Phrase each bullet in natural coaching language.\n"
-        "- Each bullet MUST include a brief consequence after an em dash (—), no period before the dash.\n"
-        "- Keep it concrete (operations, timelines, data quality, compliance) but concise.\n"
-        "HARD RULES:\n"
-        "- Use the CONTEXT only for reasoning; never copy or quote it.\n"
-        "- Output ONLY plain-text bullets (no JSON/arrays/quotes/headers/prefix hyphens or numbering).\n"
-        "- Your FIRST character must be 'D' from 'Do not '.\n"
-        "QUALITY CHECK:\n"
-        "- If any bullet lacks an em dash consequence, add one.\n"
-        "- If any line does not start with 'Do not ', rewrite it.\n"
-    )
-
-    user_msg = (
-        "CONTEXT_START\n"
-        f"{context_json}\n"
-        "CONTEXT_END\n\n"
-        f"QUESTION:\n{args.question}\n\n"
-        "From the CONTEXT, output 3–5 plain-text bullets.\n"
-        "Each MUST start with 'Do not ' and include an em dash (—) followed by a short consequence.\n"
-        "Do not include any headings, labels, or leading hyphens. The first character must be 'D'.\n"
-    )
-
-
-    # 4) query llama.cpp
+    server = LlamaServer(args.llama_url) if args.llama_url else None
+    count_tokens = TokenCounter(server)
+    user_msg, stats = build_prompt(args, args.question, rag, count_tokens)
+    log.info("CONTEXT: %d/%d lessons, %d/%d tokens (%s); prompt ≈ %d tokens of --ctx-size %d",
+             stats["lessons"], stats["retrieved"], stats["context_tokens"], stats["budget"],
+             "model tokenizer" if stats["exact_tokens"] else "estimated", stats["prompt_tokens"], args.ctx_size)
+
+    # 3) query llama.cpp
     print("Querying llama.cpp ...")
-    answer = query_llama(system_msg, user_msg, args.llama_bin, args.model_path)
+    answer = query_llama(SYSTEM_MSG, user_msg, args.llama_bin, args.model_path, n_predict=args.n_predict,
+                         server=server, ctx_size=args.ctx_size, prompt_cache=llama_prompt_cache(args))
     answer = clean_answer(answer)
     log.info(answer)
 
 
+def load_questions(path: str) -> List[Dict[str, Any]]:
+    """
+    Read {"id": ..., "q": ...} items from a JSONL file ('-' = stdin). Lines may be objects
+    with "q"/"question"/"query" (+ optional "id", default = line number) or bare JSON strings.
+    """
+    items = []
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{n}: invalid JSON ({e})")
+            if isinstance(obj, str):
+                obj = {"q": obj}
+            q = (obj.get("q") or obj.get("question") or obj.get("query")) if isinstance(obj, dict) else None
+            if not q:
+                raise ValueError(f"{path}:{n}: expected a non-empty string or an object with a non-empty 'q'")
+            items.append({"id": obj.get("id", n), "q": q})
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return items
+
+def run_rag_many(questions: List[str], args, retriever=None) -> List[Dict[str, Any]]:
+    """All retrievals up front: one batched encode + search in-process, else one call per question."""
+    if retriever is not None and hasattr(retriever, "search_many"):
+        with METRICS.span("rag.in_process"):
+            out = retriever.search_many(questions, k=args.k)
+        METRICS.count("rag.results", sum(len(r["results"]) for r in out))
+        return out
+    return [run_rag(q, args.rag_script, args.store, args.k, rag_url=args.rag_url, retriever=retriever)
+            for q in questions]
+
+def default_concurrency(server: Optional[LlamaServer]) -> int:
+    # llama-server: one request per parallel slot (start it with -np N to match).
+    # llama-cli: each process runs 12 threads, so only a few fit on the machine.
+    cores = os.cpu_count() or 1
+    return min(4, cores) if server is not None else max(1, cores // 12)
+
+async def run_questions(args, items: List[Dict[str, Any]], retriever=None) -> int:
+    """
+    Answer every question in --questions (`items` from load_questions): retrieve all up front,
+    then run llama calls with bounded concurrency, writing one JSONL answer per question as
+    soon as it completes.
+    """
+    if not items:
+        log.warning("No questions in %s", args.questions)
+        return 0
+    t0 = time.perf_counter()
+    log.info("Querying RAG for %d questions…", len(items))
+    rags = run_rag_many([it["q"] for it in items], args, retriever)
+
+    server = LlamaServer(args.llama_url) if args.llama_url else None
+    count_tokens = TokenCounter(server)
+    prompt_cache = llama_prompt_cache(args)
+    concurrency = max(1, args.concurrency or default_concurrency(server))
+    sem = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    latencies: List[float] = []
+    failed = 0
+
+    def answer_sync(item: Dict[str, Any], rag: Dict[str, Any]) -> Dict[str, Any]:
+        # worker thread: tokenizer calls + llama request (each thread has its own keep-alive connection)
+        user_msg, stats = build_prompt(args, item["q"], rag, count_tokens)
+        out = query_llama(SYSTEM_MSG, user_msg, args.llama_bin, args.model_path, n_predict=args.n_predict,
+                          server=server, ctx_size=args.ctx_size, prompt_cache=prompt_cache)
+        return {"answer": clean_answer(out), "lessons": stats["lessons"], "context_tokens": stats["context_tokens"]}
+
+    async def answer(item: Dict[str, Any], rag: Dict[str, Any]) -> Dict[str, Any]:
+        res: Dict[str, Any] = {"id": item["id"], "question": item["q"]}
+        if not rag.get("results"):
+            res["error"] = "no RAG results"
+            return res
+        async with sem:
+            t = time.perf_counter()
+            try:
+                res.update(await loop.run_in_executor(executor, answer_sync, item, rag))
+            except Exception as e:
+                res["error"] = str(e)
+            res["seconds"] = round(time.perf_counter() - t, 3)
+        return res
+
+    out = sys.stdout if args.out in (None, "-") else open(args.out, "w", encoding="utf-8")
+    try:
+        pending = [answer(it, rag) for it, rag in zip(items, rags)]
+        if prompt_cache is not None and not prompt_cache.exists() and not server:
+            # the first llama-cli run writes the prompt cache; don't let several race on it
+            pending = [asyncio.ensure_future(pending[0])] + pending[1:]
+            await asyncio.wait([pending[0]])
+        log.info("Answering %d questions with concurrency %d…", len(items), concurrency)
+        for fut in asyncio.as_completed(pending):
+            res = await fut
+            if "error" in res:
+                failed += 1
+            else:
+                latencies.append(res["seconds"])
+            out.write(json.dumps(res, ensure_ascii=False) + "\n")
+            out.flush()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if out is not sys.stdout:
+            out.close()
+
+    wall = time.perf_counter() - t0
+    latencies.sort()
+    report = {
+        "questions": len(items), "answered": len(items) - failed, "failed": failed,
+        "concurrency": concurrency, "wall_s": round(wall, 3),
+        "questions_per_min": round(60 * len(items) / wall, 2) if wall else None,
+        "latency_p50_s": latencies[len(latencies) // 2] if latencies else None,
+        "latency_max_s": latencies[-1] if latencies else None,
+    }
+    print(json.dumps({"throughput": report}, ensure_ascii=False), file=sys.stderr)
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
     main()
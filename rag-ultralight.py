@@ -11,15 +11,41 @@ Ultra-light RAG for 'via negativa' lessons.
 Usage:
   python3 rag-ultralight.py validate --data ./data
   python3 rag-ultralight.py build-index --data ./data --out ./rag_store --write-back
+  python3 rag-ultralight.py build-index --data ./data --out ./rag_store --embedder onnx-int8 --check-agreement 32
+  python3 rag-ultralight.py build-index --data ./data --out ./rag_store --watch
   python3 rag-ultralight.py query --store ./rag_store --q "Kickoff alignment for healthcare POC" -k 5
+  python3 rag-ultralight.py query --store ./rag_store --q "HIPAA" --mode hybrid
+  python3 rag-ultralight.py query --store ./rag_store --batch questions.jsonl -k 5 > answers.jsonl
+  python3 rag-ultralight.py query --store ./rag_store_ultralight --store ./rag_store --q "Kickoff data checks" -k 5
+  python3 rag-ultralight.py dedupe --store ./rag_store --threshold 0.92 --out dedupe.json
+  python3 rag-ultralight.py serve --store ./rag_store --port 8765
 """
 import argparse
 import json
+import os
 import sys
 import shutil
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
 from datetime import datetime, timezone
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from rag_common import (
+    DEFAULT_MODEL, EMBEDDER_BACKENDS, EmbedPipeline, Embedder, EmbeddingCache, FileWriter, INDEX_DEFAULTS,
+    INDEX_TYPES, IndexBuilder, LexicalIndex, MANIFEST_FORMAT, METRICS, SEARCH_MODES, VECTOR_DTYPES, as_list,
+    check_file, check_recall, compare_embedders, compile_validator, configure_index, default_embed_cache_dir,
+    embed_cache_key, finish_instrumentation, index_spec, index_vectors, iter_batch_queries, iter_json_files,
+    lesson_json_bytes, load_chunks, load_json, load_manifest, map_files, new_build_id, onnx_model_dir,
+    prune_generations, publish_generation, read_store_index, resolve_store, rrf_fuse, save_json,
+    search_params, sha256_text, spec_matches, start_instrumentation, unchanged_files, validate_json,
+    write_lexical, write_metrics_periodically,
+)
 
 # ---------- UltraLight defaults ----------
 IMPACT_MAP = {
@@ -30,6 +56,10 @@ IMPACT_MAP = {
     5: "Critical – project failure or client loss",
 }
 
+# Full-schema lessons (rag.py) carry a P1..P4 severity instead of incident.impact.level;
+# mapped onto the same 1..5 scale so federated queries can re-rank both kinds together.
+SEVERITY_IMPACT = {"P1": 5, "P2": 4, "P3": 3, "P4": 2}
+
 # A permissive schema: we keep just the essentials and allow additionalProperties.
 DEFAULT_SCHEMA = {
     "$schema": "http://json-schema.org/draft-07/schema#",
@@ -93,65 +123,6 @@ DEFAULT_SCHEMA = {
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def iter_json_files(root: Path) -> List[Path]:
-    return sorted([p for p in root.rglob("*.json") if p.is_file()])
-
-def load_json(path: Path) -> Dict[str, Any]:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_json(path: Path, obj: Dict[str, Any]):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
-
-def append_jsonl(path: Path, obj: Dict[str, Any]):
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
-
-def validate_json(doc: Dict[str, Any], schema: Dict[str, Any]) -> Tuple[bool, str]:
-    try:
-        from jsonschema import Draft7Validator
-    except ImportError:
-        return False, "jsonschema not installed (pip install jsonschema)"
-    v = Draft7Validator(schema)
-    errors = sorted(v.iter_errors(doc), key=lambda e: e.path)
-    if not errors:
-        return True, ""
-    msgs = []
-    for e in errors:
-        where = "/".join(map(str, e.path))
-        msgs.append(f" - {where or '$'}: {e.message}")
-    return False, "\n".join(msgs)
-
-def _as_list(x):
-    if x is None:
-        return []
-    return x if isinstance(x, list) else [x]
-
-
-    impact = incident.get("impact")
-    impact_desc = incident.get("impact_description")
-
-    if isinstance(impact, int):
-        level = max(1, min(5, impact))
-        desc = impact_desc or IMPACT_MAP.get(level, "")
-        incident["impact"] = {"level": level, "description": desc}
-    elif isinstance(impact, dict):
-        level = impact.get("level")
-        if isinstance(level, int) and 1 <= level <= 5:
-            if not impact.get("description"):
-                impact["description"] = impact_desc or IMPACT_MAP.get(level, "")
-        else:
-            # If invalid level, try to coerce from impact_desc keywords; else default to 3
-            level = 3
-            impact["level"] = level
-            impact["description"] = impact.get("description") or impact_desc or IMPACT_MAP[level]
-        incident["impact"] = impact
-    else:
-        # No impact provided -> default moderate
-        incident["impact"] = {"level": 3, "description": IMPACT_MAP[3]}
-    return incident
-
 def ensure_provenance(d: Dict[str, Any]) -> Dict[str, Any]:
     if "created_at" not in d or not isinstance(d["created_at"], str) or len(d["created_at"]) < 10:
         d["created_at"] = now_iso()
@@ -167,7 +138,7 @@ def build_rag_text(d: Dict[str, Any]) -> str:
     summary = d.get("summary", "")
     phase = d.get("phase", "")
     client = d.get("client_name", "")
-    industries = ", ".join(_as_list(d.get("industries")))
+    industries = ", ".join(as_list(d.get("industries")))
     proj_type = d.get("project_type", "")
     incident = d.get("incident", {}) if isinstance(d.get("incident"), dict) else {}
     what = incident.get("what_happened", "")
@@ -227,43 +198,473 @@ def ensure_rag(d: Dict[str, Any]) -> Dict[str, Any]:
     # Light meta (kept very small)
     meta = {
         "phase": c.get("phase", ""),
-        "industries": _as_list(c.get("industries")),
-        "tags": _as_list(c.get("tags")),
+        "industries": as_list(c.get("industries")),
+        "tags": as_list(c.get("tags")),
         "created_at": c.get("created_at"),
         "author": c.get("author", ""),
     }
     c["rag"] = {"text": text, "meta": meta}
     return c
 
-def write_sidecar(json_path: Path, text: str):
-    with open(json_path.with_suffix(".rag"), "w", encoding="utf-8") as f:
-        f.write(text)
+# ---------- columnar metadata ----------
+# build-index writes everything query needs per row as memory-mappable columns, so the
+# re-rank and payload never open lesson JSONs (or need data/ mounted next to the store):
+#   rows.npy (int64, sorted FAISS ids), impact.npy (int8),
+#   <dict col>.npy (int16 codes into columns.json), <str col>.bin + <str col>.off.npy
+DICT_COLUMNS = ("phase", "root_cause_category")
+STR_COLUMNS = ("id", "title", "path", "do_not_do", "do_instead")
 
-# ---------- index ----------
-class Embedder:
-    def __init__(self, model: str):
-        self.model_name = model
-        try:
-            from sentence_transformers import SentenceTransformer  # type: ignore
-        except ImportError:
-            raise RuntimeError("Please install sentence-transformers")
-        self.model = SentenceTransformer(model)
+class StringColumn:
+    """Offset-indexed UTF-8 blob: value i is blob[off[i]:off[i+1]]."""
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
 
-    def embed(self, texts: List[str]):
-        return self.model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+    @classmethod
+    def from_list(cls, values: List[str]) -> "StringColumn":
+        import numpy as np
+        encoded = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype="uint64")
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype="uint8"), offsets)
 
-def build_faiss_index(vectors, out_dir: Path):
+    @classmethod
+    def load(cls, base: Path) -> "StringColumn":
+        import numpy as np
+        offsets = np.load(f"{base}.off.npy", mmap_mode="r")
+        blob_path = Path(f"{base}.bin")
+        if blob_path.stat().st_size:
+            blob = np.memmap(blob_path, dtype="uint8", mode="r")
+        else:
+            blob = np.zeros(0, dtype="uint8")  # np.memmap refuses empty files
+        return cls(blob, offsets)
+
+    def save(self, base: Path):
+        import numpy as np
+        with open(f"{base}.bin", "wb") as f:
+            f.write(self.blob.tobytes())
+        np.save(f"{base}.off.npy", self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes().decode("utf-8")
+
+def impact_level(doc: Dict[str, Any]) -> int:
     try:
-        import faiss  # type: ignore
-    except ImportError:
-        raise RuntimeError("Please install faiss-cpu")
+        level = (doc.get("incident", {}).get("impact", {}) or {}).get("level")
+        if level is None:
+            return SEVERITY_IMPACT.get(str(doc.get("severity", "")).upper(), 3)
+        return int(level)
+    except Exception:
+        return 3
+
+def write_columns(col_dir: Path, records: List[Dict[str, Any]]):
+    """Write per-row columns for `records` (already in row order)."""
     import numpy as np
-    vecs = vectors.astype("float32")
-    d = vecs.shape[1]
-    faiss.normalize_L2(vecs)
-    index = faiss.IndexFlatIP(d)
-    index.add(vecs)
-    faiss.write_index(index, str(out_dir / "index.faiss"))
+    col_dir.mkdir(parents=True, exist_ok=True)
+    np.save(col_dir / "rows.npy", np.asarray([r["row"] for r in records], dtype="int64"))
+    np.save(col_dir / "impact.npy", np.asarray([r.get("impact", 3) for r in records], dtype="int8"))
+    dicts: Dict[str, List[str]] = {}
+    for name in DICT_COLUMNS:
+        values = sorted({r.get(name, "") for r in records})
+        code = {v: i for i, v in enumerate(values)}
+        np.save(col_dir / f"{name}.npy", np.asarray([code[r.get(name, "")] for r in records], dtype="int16"))
+        dicts[name] = values
+    for name in STR_COLUMNS:
+        StringColumn.from_list([str(r.get(name, "")) for r in records]).save(col_dir / name)
+    save_json(col_dir / "columns.json", {"num_rows": len(records), "dicts": dicts})
+
+# ---------- query cache ----------
+# Finished query payloads, keyed by everything that shapes them. The build id pins an entry
+# to one store generation, so a rebuild can never serve stale results. `serve` keeps them in
+# memory; `query --query-cache` also persists them inside that generation (query_cache/),
+# where they are pruned together with it.
+def normalize_query(q: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", q).split())
+
+def query_cache_key(meta: Dict[str, Any], q: str, k: int, pool: int, impact_slope: float, mode: str,
+                    model: Optional[str] = None, nprobe: Optional[int] = None,
+                    ef_search: Optional[int] = None) -> Optional[str]:
+    """Cache key for one query against a store generation; None for stores without a build id."""
+    if not meta.get("build_id"):
+        return None
+    parts = {
+        "q": normalize_query(q), "k": int(k), "pool": int(pool), "impact_slope": float(impact_slope),
+        "mode": mode, "build_id": meta["build_id"],
+        "model": None if mode == "lexical" else (model or meta.get("model", DEFAULT_MODEL)),
+        "embedder": None if mode == "lexical" else meta.get("embedder", "sbert"),
+        "nprobe": nprobe, "ef_search": ef_search,
+    }
+    return sha256_text(json.dumps(parts, sort_keys=True))
+
+class QueryCache:
+    """In-process LRU; with persist, in front of one JSON file per entry under <generation>/query_cache/."""
+    def __init__(self, max_items: int = 1024, persist: bool = False):
+        self.max_items = max(1, int(max_items))
+        self.persist = persist
+        self._mem: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, gen_dir: Path, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            res = self._mem.get(key)
+            if res is not None:
+                self._mem.move_to_end(key)
+                return res
+        if not self.persist:
+            return None
+        try:
+            res = load_json(gen_dir / "query_cache" / f"{key}.json")
+        except (OSError, ValueError):
+            return None
+        self._remember(key, res)
+        return res
+
+    def put(self, gen_dir: Path, key: str, res: Dict[str, Any]):
+        self._remember(key, res)
+        if not self.persist:
+            return
+        # best effort: a read-only store still gets the in-memory cache
+        cache_dir = gen_dir / "query_cache"
+        tmp = cache_dir / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            cache_dir.mkdir(exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(res, f, ensure_ascii=False)
+            os.replace(tmp, cache_dir / f"{key}.json")
+        except OSError:
+            pass
+
+    def _remember(self, key: str, res: Dict[str, Any]):
+        with self._lock:
+            self._mem[key] = res
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+
+# ---------- near-duplicate lessons ----------
+# `dedupe` (and build-index --dedupe) finds lesson pairs whose stored vectors have cosine
+# >= a threshold with FAISS range search: exact (flat) up to DEDUPE_EXACT_MAX vectors, a
+# temporary IVF above that. Pairs are grouped with a vectorized union-find; each cluster
+# keeps its highest-impact lesson. build-index --dedupe writes the other rows to
+# collapsed.npy, and queries skip them, so the store keeps every vector (and incremental
+# builds keep working) while near-identical lessons stop crowding the top-k.
+DEDUPE_THRESHOLD = 0.92
+DEDUPE_EXACT_MAX = 20_000  # exact range search is O(n^2 * dim)
+DEDUPE_NPROBE = 8
+
+def union_find(n: int, a, b):
+    """
+    Connected components of n items joined by edges (a[i], b[i]): the smallest member
+    position of each item's component. Hook + pointer jumping over whole arrays, so the
+    cost is a few numpy passes over the edges rather than a Python loop per pair.
+    """
+    import numpy as np
+    labels = np.arange(n, dtype="int64")
+    a, b = np.asarray(a, dtype="int64"), np.asarray(b, dtype="int64")
+    while len(a):
+        la, lb = labels[a], labels[b]
+        low = np.minimum(la, lb)
+        hooked = labels.copy()
+        np.minimum.at(hooked, la, low)  # union: each root points at the smaller root
+        np.minimum.at(hooked, lb, low)
+        while True:  # find, with full path compression
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            break
+        labels = hooked
+    return labels
+
+def near_duplicate_pairs(vecs, threshold: float, exact_max: int = DEDUPE_EXACT_MAX, nprobe: int = DEDUPE_NPROBE,
+                         batch_size: int = 4096):
+    """
+    All pairs (i < j, positions into `vecs`) with cosine >= threshold, as arrays (i, j, cosine).
+    Above exact_max vectors the range search goes through an IVF index of sqrt(n) cells
+    (nprobe of them searched per lesson): near-duplicates nearly always share a cell, so
+    this trades very little recall for roughly n * sqrt(n) work instead of n^2.
+    """
+    import faiss  # type: ignore
+    import numpy as np
+    xb = np.ascontiguousarray(vecs, dtype="float32")
+    faiss.normalize_L2(xb)
+    n, d = xb.shape
+    if n <= exact_max:
+        index = faiss.IndexFlatIP(d)
+    else:
+        nlist = int(np.sqrt(n))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, nlist, faiss.METRIC_INNER_PRODUCT)
+        # k-means only needs a few dozen points per cell; training dominates otherwise
+        sample = np.random.default_rng(0).choice(n, size=min(n, 40 * nlist), replace=False)
+        with METRICS.span("dedupe.train"):
+            index.train(xb[np.sort(sample)])
+        index.nprobe = nprobe
+    index.add(xb)
+
+    found_i, found_j, found_s = [], [], []
+    radius = float(np.nextafter(np.float32(threshold), np.float32(-1)))  # FAISS keeps scores > radius
+    with METRICS.span("dedupe.range_search"):
+        for start in range(0, n, batch_size):
+            lims, D, I = index.range_search(xb[start:start + batch_size], radius)
+            qi = np.repeat(np.arange(start, start + len(lims) - 1, dtype="int64"), np.diff(lims).astype("int64"))
+            keep = I > qi  # each pair once, never an item with itself
+            found_i.append(qi[keep])
+            found_j.append(I[keep])
+            found_s.append(D[keep])
+    if not found_i:
+        empty = np.zeros(0, dtype="int64")
+        return empty, empty, np.zeros(0, dtype="float32")
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_s)
+
+def duplicate_clusters(index, threshold: float, impact_of, exact_max: int = DEDUPE_EXACT_MAX,
+                       nprobe: int = DEDUPE_NPROBE) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Near-duplicate clusters among an index's vectors: [{"keep": row, "duplicates": [(row, cosine
+    to the kept lesson), ...]}], largest first, plus the number of pairs found. `impact_of` maps
+    an array of FAISS rows to their impact levels; ties keep the lowest (oldest) row.
+    """
+    import faiss  # type: ignore
+    import numpy as np
+    rows, vecs = index_vectors(index)
+    if vecs is None or len(rows) < 2:
+        return [], 0
+    vecs = np.ascontiguousarray(vecs, dtype="float32")
+    faiss.normalize_L2(vecs)  # compressed / PCA stores reconstruct only approximately unit vectors
+    pi, pj, _ = near_duplicate_pairs(vecs, threshold, exact_max=exact_max, nprobe=nprobe)
+    with METRICS.span("dedupe.union_find"):
+        labels = union_find(len(rows), pi, pj)
+    sizes = np.bincount(labels, minlength=len(rows))
+    members = np.flatnonzero(sizes[labels] > 1)
+    if not len(members):
+        return [], len(pi)
+    members = members[np.argsort(labels[members], kind="stable")]
+    impacts = np.asarray(impact_of(rows[members]), dtype="int64")
+    clusters = []
+    for group in np.split(np.arange(len(members)), np.flatnonzero(np.diff(labels[members])) + 1):
+        pos, imp = members[group], impacts[group]
+        best = np.lexsort((rows[pos], -imp))[0]  # highest impact, then lowest row
+        keep = pos[best]
+        cos = vecs[pos] @ vecs[keep]
+        dups = sorted(((int(rows[p]), float(c)) for p, c in zip(pos, cos) if p != keep), key=lambda d: -d[1])
+        clusters.append({"keep": int(rows[keep]), "duplicates": dups})
+    clusters.sort(key=lambda c: -len(c["duplicates"]))
+    return clusters, len(pi)
+
+def dedupe_report(clusters: List[Dict[str, Any]], describe, **info) -> Dict[str, Any]:
+    """JSON-ready report; `describe` maps a FAISS row to {"id", "title", "path", "impact"}."""
+    return {
+        **info,
+        "num_clusters": len(clusters),
+        "num_duplicates": sum(len(c["duplicates"]) for c in clusters),
+        "clusters": [{
+            "size": len(c["duplicates"]) + 1,
+            "keep": describe(c["keep"]),
+            "duplicates": [{**describe(row), "cosine": round(cos, 4)} for row, cos in c["duplicates"]],
+        } for c in clusters],
+    }
+
+# ---------- parallel file processing ----------
+# One lesson per call, fanned out over --jobs processes by map_files
+def _prepare_lesson(p: Path, write_back: bool = False) -> Tuple[Dict[str, Any], int, List[Tuple[Path, bytes]]]:
+    """
+    Load + normalize one lesson; returns (doc, mtime_ns, writes). `writes` holds the .rag
+    sidecar and, with write_back, the normalized JSON first; the caller's FileWriter does them.
+    """
+    mtime_ns = p.stat().st_mtime_ns
+    doc = ensure_rag(load_json(p))
+    writes = [(p, lesson_json_bytes(doc))] if write_back else []  # persists normalized impact + rag
+    writes.append((p.with_suffix(".rag"), doc["rag"]["text"].encode("utf-8")))
+    return doc, mtime_ns, writes
+
+# ---------- watch ----------
+# build-index --watch: filesystem events (inotify on Linux, mtime polling elsewhere) are
+# debounced into one incremental build; publishing the new generation is what makes
+# running `serve` / Retriever processes hot-swap to it on their next search.
+class _Inotify:
+    """Linux inotify through ctypes (no extra dependency): one watch per directory under `root`."""
+    IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_Q_OVERFLOW, IN_ISDIR = 0x100, 0x200, 0x4000, 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    kind = "inotify"
+
+    def __init__(self, root: Path):
+        import ctypes
+        import ctypes.util
+        self.root = root
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)  # AttributeError off Linux
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs: Dict[int, Path] = {}
+        try:
+            self._add_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_tree(self, top: Path) -> set:
+        """Watch `top` and every directory below it; returns the lesson files already there."""
+        found = set()
+        for d, _, names in os.walk(top):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), self.MASK)
+            if wd < 0:
+                raise OSError(self._ctypes.get_errno(), f"inotify_add_watch failed for {d}")
+            self.dirs[wd] = Path(d)
+            found.update(Path(d) / n for n in names if n.endswith(".json"))
+        return found
+
+    def changes(self, timeout: Optional[float]) -> set:
+        """Paths touched since the last call (blocks up to `timeout`; None = until something happens)."""
+        import select
+        import struct
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        buf = os.read(self.fd, 1 << 16)
+        touched, pos = set(), 0
+        while pos < len(buf):
+            wd, mask, _, size = struct.unpack_from("iIII", buf, pos)
+            name = buf[pos + 16:pos + 16 + size].rstrip(b"\0")
+            pos += 16 + size
+            if mask & self.IN_Q_OVERFLOW:  # events were dropped: treat everything as touched
+                touched.update(iter_json_files(self.root))
+                continue
+            if wd not in self.dirs or not name:
+                continue
+            path = self.dirs[wd] / os.fsdecode(name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    touched |= self._add_tree(path)
+                else:
+                    touched.add(path)  # a directory went away with its lessons
+            elif path.suffix == ".json" and mask != self.IN_CREATE:  # wait for the write, not the open
+                touched.add(path)
+        return touched
+
+    def close(self):
+        os.close(self.fd)
+
+class _Poller:
+    """Fallback watcher: rescans *.json (mtime, size) every `interval` seconds."""
+    kind = "polling"
+
+    def __init__(self, root: Path, interval: float):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self) -> Dict[Path, Tuple[int, int]]:
+        snap = {}
+        for p in iter_json_files(self.root):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            snap[p] = (st.st_mtime_ns, st.st_size)
+        return snap
+
+    def changes(self, timeout: Optional[float]) -> set:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = self.interval if deadline is None else max(0.0, deadline - time.monotonic())
+            time.sleep(min(self.interval, left))
+            snap = self._scan()
+            touched = {p for p in snap.keys() | self.snapshot.keys() if snap.get(p) != self.snapshot.get(p)}
+            self.snapshot = snap
+            if touched or (deadline is not None and time.monotonic() >= deadline):
+                return touched
+
+    def close(self):
+        pass
+
+def open_watcher(root: Path, poll_interval: float, poll: bool = False):
+    if not poll:
+        try:
+            return _Inotify(root)
+        except (OSError, AttributeError) as e:
+            print(f"⚠️  inotify unavailable ({e}); polling every {poll_interval}s instead.", file=sys.stderr)
+    return _Poller(root, poll_interval)
+
+def _stale_paths(store: Path, touched: set) -> List[Path]:
+    """Touched paths whose content may differ from what the published generation indexed."""
+    indexed = {e["path"]: e.get("mtime_ns") for e in load_manifest(resolve_store(store)).values()}
+    stale = []
+    for p in sorted(touched):
+        try:
+            if indexed.get(str(p)) != p.stat().st_mtime_ns:  # new or edited (not our own write-back)
+                stale.append(p)
+        except FileNotFoundError:
+            prefix = str(p) + os.sep
+            if str(p) in indexed or any(q.startswith(prefix) for q in indexed):
+                stale.append(p)  # removed lesson (or a directory of them)
+    return stale
+
+def reindex_touched(args, embedder: Embedder, touched: set, validator, invalid: set,
+                    term_cache: Optional[Dict[Tuple[int, str], Any]] = None) -> int:
+    """
+    Validate the touched lessons, then publish an incremental build if they all pass.
+    `invalid` carries the lessons that failed across cycles: they are re-checked every
+    time, and nothing is published while any of them is still broken (a build reads the
+    whole data dir, so it would index them too).
+    """
+    stale = _stale_paths(Path(args.out), touched)
+    if not stale and not invalid:
+        return 0
+    for p in sorted(set(stale) | invalid):
+        invalid.discard(p)
+        if not p.is_file():
+            continue
+        try:
+            ok, msg = validate_json(load_json(p), DEFAULT_SCHEMA, validator)
+        except ValueError as e:
+            ok, msg = False, f"invalid JSON: {e}"
+        if not ok:
+            print(f"⚠️  {p}\n{msg}\n")
+            invalid.add(p)
+    if invalid:
+        print(f"⚠️  {len(invalid)} file(s) failed validation; the published index is unchanged until they are fixed.")
+        return 2
+    t0 = time.perf_counter()
+    rc = build_store(args, embedder, term_cache=term_cache)
+    print(f"♻️  Re-indexed {len(stale)} touched file(s) in {(time.perf_counter() - t0) * 1000:.0f} ms.", flush=True)
+    return rc
+
+def watch_store(args) -> int:
+    data_dir = Path(args.data)
+    embedder = build_embedder(args)  # kept warm across rebuilds
+    embedder.model  # load it now, not on the first changed lesson
+    term_cache: Dict[Tuple[int, str], Any] = {}
+    build_store(args, embedder, term_cache=term_cache)
+    # Later rebuilds are incremental and quiet: never wipe the store, skip the one-off reports
+    args.reset = False
+    args.check_agreement = args.check_recall = 0
+    validator = compile_validator(DEFAULT_SCHEMA)
+    invalid: set = set()  # lessons that failed validation, re-checked every cycle
+
+    watcher = open_watcher(data_dir, args.poll_interval, poll=args.poll)
+    print(f"👀 Watching {data_dir} ({watcher.kind}); changes are published to {args.out}. Ctrl+C to stop.", flush=True)
+    try:
+        while True:
+            touched = watcher.changes(None)
+            while True:  # debounce: wait until the burst of events settles
+                more = watcher.changes(args.debounce)
+                if not more:
+                    break
+                touched |= more
+            try:
+                with METRICS.span("watch.reindex"):
+                    reindex_touched(args, embedder, touched, validator, invalid, term_cache=term_cache)
+            except Exception as e:
+                print(f"❌ Re-index failed (still watching): {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("✅ Stopped watching.")
+    finally:
+        watcher.close()
+    return 0
 
 # ---------- commands ----------
 def cmd_validate(args):
@@ -274,9 +675,7 @@ def cmd_validate(args):
         print(f"No JSON files found under {data_dir}")
         return 1
     bad = 0
-    for p in files:
-        doc = load_json(p)
-        ok, msg = validate_json(doc, schema)
+    for p, (ok, msg) in zip(files, map_files(check_file, files, args.jobs, schema)):
         if ok:
             print(f"✅ {p}")
         else:
@@ -287,7 +686,31 @@ def cmd_validate(args):
         return 2
     return 0
 
+def build_embedder(args) -> Embedder:
+    """The embedder (and embedding cache) build-index encodes lesson texts with."""
+    cache = None
+    if not args.no_embed_cache:
+        cache = EmbeddingCache(Path(args.embed_cache) if args.embed_cache else default_embed_cache_dir(),
+                               embed_cache_key(args.model, args.embedder), max_items=args.embed_cache_max)
+    return Embedder(model=args.model, cache=cache, backend=args.embedder,
+                    onnx_dir=onnx_model_dir(Path(args.out), args.model), threads=args.threads)
+
 def cmd_build_index(args):
+    if args.watch:
+        return watch_store(args)
+    return build_store(args)
+
+def build_store(args, embedder: Optional[Embedder] = None,
+                term_cache: Optional[Dict[Tuple[int, str], Any]] = None) -> int:
+    """
+    One (incremental) build of args.data into a new published generation of args.out.
+    --watch passes a warm embedder and write_lexical's term cache on every rebuild.
+    """
+    try:
+        import faiss  # type: ignore
+    except ImportError:
+        raise RuntimeError("Please install faiss-cpu")
+
     data_dir = Path(args.data)
     out_dir = Path(args.out)
 
@@ -295,164 +718,630 @@ def cmd_build_index(args):
         shutil.rmtree(out_dir)
 
     out_dir.mkdir(parents=True, exist_ok=True)
-    chunks_path = out_dir / "chunks.jsonl"
-    ids_path = out_dir / "ids.jsonl"
+    prev_dir = resolve_store(out_dir)
+    index_path = prev_dir / "index.faiss"
 
     files = iter_json_files(data_dir)
     if not files:
         print(f"No JSON files found under {data_dir}")
         return 1
 
-    texts, ids, titles, paths = [], [], [], []
-    for p in files:
-        doc = load_json(p)
-        doc = ensure_rag(doc)
+    # Reuse the previous build only when it was made with a manifest and the same model;
+    # anything else (legacy store, model switch) falls back to a full rebuild.
+    prev_meta = load_json(prev_dir / "meta.json") if (prev_dir / "meta.json").exists() else {}
+    prev = load_manifest(prev_dir)
+    index = None
+    spec = index_spec(args)
+    reusable = (prev and index_path.exists() and prev_meta.get("model") == args.model
+                and prev_meta.get("embedder", "sbert") == args.embedder and spec_matches(spec, prev_meta))
+    if reusable:
+        index = faiss.read_index(str(index_path))
+    else:
+        prev = {}
+    prev_chunks = load_chunks(prev_dir) if prev else {}
+    prev_by_path = {e["path"]: (lid, e) for lid, e in prev.items()}
+    next_row = max((e["row"] for e in prev.values()), default=-1) + 1
 
-        # optional write-back to persist normalized impact + rag
-        if args.write_back:
-            try:
-                save_json(p, doc)
-            except Exception as e:
-                print(f"⚠️  Write-back failed for {p}: {e}")
-
-        # sidecar .rag
-        write_sidecar(p, doc["rag"]["text"])
-
-        rec = {
-            "id": doc.get("id", ""),
-            "path": str(p),
-            "title": doc.get("title", ""),
-            "phase": doc.get("phase", ""),
-            "industries": doc.get("industries", []),
-            "tags": doc.get("tags", []),
-            "rag_text": doc["rag"]["text"],
-        }
-        append_jsonl(chunks_path, rec)
-        append_jsonl(ids_path, {"id": rec["id"], "path": rec["path"], "title": rec["title"]})
-
-        texts.append(doc["rag"]["text"])
-        ids.append(rec["id"])
-        titles.append(rec["title"])
-        paths.append(rec["path"])
-
-    # Embed + index
-    embedder = Embedder(model=args.model)
-    vecs = embedder.embed(texts)
-    build_faiss_index(vecs, out_dir)
+    # Everything below goes into a fresh generation dir; readers keep using the
+    # published one until CURRENT is swapped at the very end.
+    build_id = new_build_id()
+    gen_dir = out_dir / "generations" / build_id
+    gen_dir.mkdir(parents=True)
+
+    # Streaming pipeline: lessons are read/normalized (across --jobs processes) while new
+    # or changed texts are embedded in --embed-batch-size batches on a background thread
+    # and added to the id-mapped index; chunk metadata is written as each lesson is seen.
+    embedder = embedder or build_embedder(args)
+    builder = IndexBuilder(spec, index=index, expected=len(files))
+    pipeline = EmbedPipeline(embedder, builder, batch_size=args.embed_batch_size, queue_size=args.queue_size)
+
+    manifest: Dict[str, Dict[str, Any]] = {}
+    records: Dict[int, Dict[str, Any]] = {}  # column fields only; rag_text goes straight to chunks.jsonl
+    stale_rows: List[int] = []
+    sample: List[str] = []  # first texts, for --check-agreement
+    unchanged = 0
+
+    def emit(rec: Dict[str, Any]):
+        cf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        idf.write(json.dumps({"row": rec["row"], "id": rec["id"], "path": rec["path"], "title": rec["title"]},
+                             ensure_ascii=False) + "\n")
+        if len(sample) < args.check_agreement:
+            sample.append(rec["rag_text"])
+        records[rec["row"]] = {k: v for k, v in rec.items() if k != "rag_text"}
+
+    # Untouched files (sidecar present, no --write-back) keep their row without being read; the
+    # rest are normalized (ensure_rag) across --jobs worker processes, and their write-back/sidecar
+    # bytes go to the FileWriter.
+    fresh = unchanged_files(files, prev_by_path, prev_chunks, read_all=args.write_back)
+    prepare = partial(_prepare_lesson, write_back=args.write_back)
+    prepared = map_files(prepare, [p for p in files if p not in fresh], args.jobs, {})
+    writer = FileWriter()
+    written_back: Dict[str, Any] = {}  # lesson id -> write-back future (new mtime for the manifest)
+
+    try:
+        with METRICS.span("build.scan"), \
+             open(gen_dir / "chunks.jsonl", "w", encoding="utf-8") as cf, \
+             open(gen_dir / "ids.jsonl", "w", encoding="utf-8") as idf:
+            for p in files:
+                # Fast path: file untouched since the last build -> keep its row as-is
+                if p in fresh:
+                    lid, entry = prev_by_path[str(p)]
+                    if lid in manifest:
+                        print(f"⚠️  Duplicate id {lid} in {p}; already indexed from {manifest[lid]['path']}. Skipping.")
+                        continue
+                    manifest[lid] = entry
+                    emit(prev_chunks.pop(entry["row"]))
+                    METRICS.count("build.fast_path")
+                    unchanged += 1
+                    continue
+
+                doc, mtime_ns, writes = next(prepared)
+                futures = [writer.submit(path, data) for path, data in writes]
+
+                lid = doc.get("id", "")
+                if lid in manifest:
+                    print(f"⚠️  Duplicate id {lid} in {p}; already indexed from {manifest[lid]['path']}. Skipping.")
+                    continue
+
+                text = doc["rag"]["text"]
+                digest = sha256_text(text)
+                old = prev.get(lid)
+                if old and old["sha256"] == digest:
+                    row = old["row"]  # same text -> same vector, no re-embed
+                    unchanged += 1
+                else:
+                    row = next_row
+                    next_row += 1
+                    pipeline.put(row, text)
+                    if old:
+                        stale_rows.append(old["row"])
+
+                manifest[lid] = {"path": str(p), "mtime_ns": mtime_ns, "sha256": digest, "row": row}
+                if args.write_back:
+                    written_back[lid] = futures[0]
+                incident = doc.get("incident", {}) if isinstance(doc.get("incident"), dict) else {}
+                guidance = doc.get("guidance", {}) if isinstance(doc.get("guidance"), dict) else {}
+                emit({
+                    "row": row,
+                    "id": lid,
+                    "path": str(p),
+                    "title": doc.get("title", ""),
+                    "phase": doc.get("phase", ""),
+                    "industries": doc.get("industries", []),
+                    "tags": doc.get("tags", []),
+                    "impact": impact_level(doc),
+                    "root_cause_category": incident.get("root_cause_category", ""),
+                    "do_not_do": guidance.get("do_not_do", ""),
+                    "do_instead": guidance.get("do_instead", ""),
+                    "rag_text": text,
+                })
+        with METRICS.span("build.write_files"):
+            writer.close()
+        # A rewritten lesson gets a new mtime; record it so the next build's fast path holds
+        for lid, fut in written_back.items():
+            if fut.exception() is None and fut.result() is not None:
+                manifest[lid]["mtime_ns"] = fut.result()
+        with METRICS.span("build.embed_drain"):
+            pipeline.close()
+    except BaseException:
+        pipeline.abort()
+        writer.close()
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        raise
+
+    # Lessons that disappeared from the data dir
+    stale_rows.extend(e["row"] for lid, e in prev.items() if lid not in manifest)
+
+    if (index is not None and not pipeline.count and not stale_rows and manifest == prev
+            and prev_meta.get("dedupe_threshold") == args.dedupe):
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        print(f"✅ Store at {out_dir} is up to date ({len(records)} items).")
+        return 0
+
+    METRICS.count("build.files", len(files))
+    METRICS.count("build.embedded", pipeline.count)
+    METRICS.count("build.removed", len(set(stale_rows)))
+    with METRICS.span("build.index_finish"):
+        builder.finish(gen_dir, remove_ids=stale_rows)
+    with METRICS.span("build.write_lexical"):
+        write_lexical(gen_dir, term_cache=term_cache)
+    save_json(gen_dir / "manifest.json", {"format": MANIFEST_FORMAT, "model": args.model, "lessons": manifest})
+    with METRICS.span("build.write_columns"):
+        write_columns(gen_dir / "columns", [records[row] for row in sorted(records)])
+
+    dedupe = None
+    if args.dedupe:
+        import numpy as np
+        with METRICS.span("build.dedupe"):
+            clusters, pairs = duplicate_clusters(builder.index, args.dedupe,
+                                                 lambda rows: [records[int(r)].get("impact", 3) for r in rows])
+        hidden = [row for c in clusters for row, _ in c["duplicates"]]
+        np.save(gen_dir / "collapsed.npy", np.asarray(hidden, dtype="int64"))
+        dedupe = dedupe_report(clusters, lambda row: {k: records[row].get(k) for k in ("id", "title", "path", "impact")},
+                               threshold=args.dedupe, num_items=len(records), num_pairs=pairs)
+        save_json(gen_dir / "dedupe.json", dedupe)
 
     meta = {
         "created_at": now_iso(),
-        "num_items": len(texts),
-        "embedder": "sbert",
+        "build_id": build_id,
+        "num_items": len(records),
+        "embedder": args.embedder,
         "model": args.model,
+        **spec,
     }
-    save_json(out_dir / "meta.json", meta)
-    print(f"✅ Built store at {out_dir} with {len(texts)} items.")
+    if args.dedupe:
+        meta["dedupe_threshold"] = args.dedupe
+    save_json(gen_dir / "meta.json", meta)
+
+    with METRICS.span("build.publish"):
+        publish_generation(out_dir, build_id)
+        prune_generations(out_dir, args.keep_generations)
+
+    if args.check_agreement and args.embedder != "sbert":
+        rep = compare_embedders(args.model, sample, onnx_model_dir(out_dir, args.model), threads=args.threads)
+        print(f"🔎 {args.embedder} vs sbert fp32 on {rep['n']} texts: cosine mean={rep['cosine_mean']:.4f} "
+              f"min={rep['cosine_min']:.4f}; {rep['speedup']:.2f}x encode throughput "
+              f"({rep['onnx-int8_texts_per_sec']:.1f} vs {rep['sbert_texts_per_sec']:.1f} texts/s)")
+    if args.check_recall:
+        rep = check_recall(gen_dir, builder.index, embedder, n_queries=args.check_recall)
+        size = (gen_dir / "index.faiss").stat().st_size
+        raw = len(records) * rep["dim"] * 4
+        print(f"🔎 recall@{rep['k']} vs exact float32 search: {rep['recall']:.4f} over {rep['queries']} title "
+              f"queries; index.faiss {size / 2**20:.1f} MB vs {raw / 2**20:.1f} MB of float32 vectors "
+              f"({raw / max(size, 1):.1f}x smaller)")
+
+    if dedupe is not None:
+        print(f"🔎 Collapsed {dedupe['num_duplicates']} near-duplicate lesson(s) into {dedupe['num_clusters']} "
+              f"cluster(s) (cosine >= {args.dedupe}); report: {gen_dir / 'dedupe.json'}")
+    print(f"✅ Built store at {out_dir} with {len(records)} items "
+          f"({pipeline.count} embedded, {len(set(stale_rows))} removed, {unchanged} unchanged).")
     return 0
 
-def cmd_query(args):
-    try:
+class StoreView:
+    """One store generation loaded in memory: per-row columns, meta and the FAISS index."""
+    def __init__(self, path: Path, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
         import faiss  # type: ignore
-    except ImportError:
-        raise RuntimeError("Please install faiss-cpu")
-    import numpy as np
+        import numpy as np
+        self.path = path
+        index_path = path / "index.faiss"
+        if not index_path.exists():
+            raise RuntimeError(f"Missing index at {index_path}. Run build-index first.")
 
-    store = Path(args.store)
-    index_path = store / "index.faiss"
-    ids_path = store / "ids.jsonl"
-    if not index_path.exists():
-        raise RuntimeError(f"Missing index at {index_path}. Run build-index first.")
-
-    # Load ids/titles/paths
-    ids, titles, paths = [], [], []
-    with open(ids_path, "r", encoding="utf-8") as f:
-        for line in f:
-            rec = json.loads(line)
-            ids.append(rec.get("id", ""))
-            titles.append(rec.get("title", ""))
-            paths.append(rec.get("path", ""))
-
-    # Embed query
-    embedder = Embedder(model=args.model)
-    xq = embedder.embed([args.q]).astype("float32")
-    faiss.normalize_L2(xq)
-
-    index = faiss.read_index(str(index_path))
-    k = max(1, args.k)
+        col_dir = path / "columns"
+        if (col_dir / "columns.json").exists():
+            self.rows = np.load(col_dir / "rows.npy", mmap_mode="r")
+            self.impact = np.load(col_dir / "impact.npy", mmap_mode="r")
+            cols = {name: StringColumn.load(col_dir / name) for name in STR_COLUMNS}
+        else:
+            # Older stores and rag.py (full-schema) stores: read ids.jsonl and each lesson
+            # once, at load time (not per query)
+            recs = []
+            with open(path / "ids.jsonl", "r", encoding="utf-8") as f:
+                for pos, line in enumerate(f):
+                    rec = json.loads(line)
+                    rec.setdefault("row", pos)
+                    METRICS.count("store.lesson_reads")
+                    try:
+                        doc = load_json(Path(rec.get("path", "")))
+                    except Exception:
+                        doc = {}
+                    g = doc.get("guidance", {}) or {}
+                    rec.update(impact=impact_level(doc), do_not_do=g.get("do_not_do", ""),
+                               do_instead=g.get("do_instead", ""))
+                    recs.append(rec)
+            recs.sort(key=lambda r: int(r["row"]))
+            self.rows = np.asarray([int(r["row"]) for r in recs], dtype="int64")
+            self.impact = np.asarray([r["impact"] for r in recs], dtype="int8")
+            cols = {name: StringColumn.from_list([str(r.get(name, "")) for r in recs]) for name in STR_COLUMNS}
+        self.ids, self.titles, self.paths = cols["id"], cols["title"], cols["path"]
+        self.do_not_do, self.do_instead = cols["do_not_do"], cols["do_instead"]
+
+        self.meta = load_json(path / "meta.json") if (path / "meta.json").exists() else {}
+        with METRICS.span("store.read_index"):
+            self.index = read_store_index(index_path, self.meta)
+        configure_index(self.index, self.meta, nprobe=nprobe, ef_search=ef_search)
+        self.lexical = LexicalIndex(path) if (path / "lexical" / "vocab.json").exists() else None
+
+        # Near-duplicates hidden by build-index --dedupe are excluded inside the search (an
+        # IDSelector for FAISS, a doc mask for BM25), so they never take candidate-pool slots.
+        # None = search every row.
+        self.params = self.lexical_allowed = None
+        if (path / "collapsed.npy").exists():
+            collapsed = np.load(path / "collapsed.npy").astype("int64")
+            if len(collapsed):
+                sel = faiss.IDSelectorNot(faiss.IDSelectorBatch(len(collapsed), faiss.swig_ptr(collapsed)))
+                self.params = search_params(self.index, self.meta, sel, keepalive=(collapsed,))
+                if self.lexical is not None:
+                    self.lexical_allowed = ~np.isin(np.asarray(self.lexical.rows), collapsed)
 
-    # If user sent --pool, fall back to heuristic max(k*4, 20).
-    # Else, if there's no --pool, respect their choice but ensure it's never < k.
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def positions(self, faiss_ids):
+        """Map FAISS ids (manifest rows) to column positions."""
+        import numpy as np
+        return np.searchsorted(self.rows, faiss_ids)
+
+class Retriever:
+    """
+    Loads a store once (ids, FAISS index, embedder) and answers queries with the
+    same payload as `query --json-response`. Used by `serve` and by callers that
+    want to skip per-query model + index load.
+
+    Every search first checks the store's CURRENT pointer and hot-swaps to a newly
+    published generation; searches already running finish on the old one.
+    With a QueryCache, repeated queries skip embedding, search and re-rank entirely.
+    """
+    def __init__(self, store: Path, model: Optional[str] = None,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 threads: Optional[int] = None, cache: Optional[QueryCache] = None):
+        self.store = Path(store)
+        self.index_overrides = {"nprobe": nprobe, "ef_search": ef_search}
+        self.view = StoreView(resolve_store(self.store), **self.index_overrides)
+        # Embed queries with the model + backend the store was built with
+        model = model or self.view.meta.get("model", DEFAULT_MODEL)
+        self.embedder = Embedder(model=model, backend=self.view.meta.get("embedder", "sbert"),
+                                 onnx_dir=onnx_model_dir(self.store, model), threads=threads)
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def reload(self) -> bool:
+        """Switch to the published generation if it changed; returns True when swapped."""
+        path = resolve_store(self.store)
+        if path == self.view.path:
+            return False
+        with self._reload_lock:
+            if path != self.view.path:
+                self.view = StoreView(path, **self.index_overrides)
+                return True
+        return False
+
+    def search(self, q: str, k: int = 5, pool: Optional[int] = None,
+               impact_slope: float = 0.10, mode: str = "dense") -> Dict[str, Any]:
+        return self.search_many([q], k=k, pool=pool, impact_slope=impact_slope, mode=mode)[0]
+
+    def embed_queries(self, queries: List[str]):
+        """Unit-length query vectors, as searched against the index."""
+        import faiss  # type: ignore
+        # The model is shared across server threads
+        with self._lock, METRICS.span("query.embed"):
+            xq = self.embedder.embed(list(queries)).astype("float32")
+        faiss.normalize_L2(xq)
+        return xq
+
+    def search_many(self, queries: List[str], k: int = 5, pool: Optional[int] = None,
+                    impact_slope: float = 0.10, mode: str = "dense", xq=None) -> List[Dict[str, Any]]:
+        """
+        Answer a batch of queries with one encode call and one FAISS search.
+        mode: dense (embeddings), lexical (BM25 only; never loads the model) or
+        hybrid (both candidate pools merged with reciprocal-rank fusion).
+        xq: query vectors from embed_queries(), when the caller already has them.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown mode {mode!r}; expected one of {', '.join(SEARCH_MODES)}")
+        self.reload()
+        view = self.view
+        k = max(1, k)
+        pool = pool_size(k, pool)
+        if self.cache is None:
+            return self._search_many(view, queries, k, pool, impact_slope, mode, xq=xq)
+
+        keys = [query_cache_key(view.meta, q, k, pool, impact_slope, mode, model=self.embedder.model_name,
+                                **self.index_overrides) for q in queries]
+        out: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        for qi, key in enumerate(keys):
+            hit = self.cache.get(view.path, key) if key else None
+            if hit is not None:
+                out[qi] = {**hit, "query": queries[qi]}
+        misses = [qi for qi, res in enumerate(out) if res is None]
+        METRICS.count("query.cache_hits", len(queries) - len(misses))
+        METRICS.count("query.cache_misses", len(misses))
+        if misses:
+            fresh = self._search_many(view, [queries[qi] for qi in misses], k, pool, impact_slope, mode,
+                                      xq=None if xq is None else xq[misses])
+            for qi, res in zip(misses, fresh):
+                out[qi] = res
+                if keys[qi]:
+                    self.cache.put(view.path, keys[qi], res)
+        return out
+
+    def _search_many(self, view: StoreView, queries: List[str], k: int, pool: int,
+                     impact_slope: float, mode: str, xq=None) -> List[Dict[str, Any]]:
+        import numpy as np
+
+        if not len(view):
+            return [{"query": q, "k": k, "results": []} for q in queries]
+        if mode != "dense" and view.lexical is None:
+            raise RuntimeError(f"Store at {view.path} has no lexical index; rebuild it to use --mode {mode}.")
+
+        # Candidate rows I and base scores D per query (-1 = empty slot)
+        cos = bm25 = None
+        if mode != "lexical":
+            if xq is None:
+                xq = self.embed_queries(queries)
+            with METRICS.span("query.search"):
+                D, I = view.index.search(xq, pool, params=view.params)
+            cos = D
+        if mode != "dense":
+            with METRICS.span("query.lexical"):
+                hits = [view.lexical.search(q, pool, allowed=view.lexical_allowed) for q in queries]
+            if mode == "lexical":
+                I = np.full((len(queries), pool), -1, dtype="int64")
+                D = np.zeros((len(queries), pool), dtype="float32")
+                for qi, (rows, scores) in enumerate(hits):
+                    I[qi, :len(rows)], D[qi, :len(rows)] = rows, scores
+                bm25 = D
+            else:
+                dense_I, dense_D = I, D
+                I = np.full((len(queries), 2 * pool), -1, dtype="int64")
+                D = np.zeros((len(queries), 2 * pool), dtype="float32")
+                cos = np.full(I.shape, np.nan, dtype="float32")
+                bm25 = np.full(I.shape, np.nan, dtype="float32")
+                for qi, (rows, scores) in enumerate(hits):
+                    fused, fused_scores = rrf_fuse(dense_I[qi], rows, 2 * pool)
+                    I[qi, :len(fused)], D[qi, :len(fused)] = fused, fused_scores
+                    dense_score = dict(zip(dense_I[qi].tolist(), dense_D[qi].tolist()))
+                    lexical_score = dict(zip(rows.tolist(), scores.tolist()))
+                    for j, row in enumerate(fused):
+                        cos[qi, j] = dense_score.get(row, np.nan)
+                        bm25[qi, j] = lexical_score.get(row, np.nan)
+
+        # Impact-aware re-ranking: semantic first, impact as a gentle nudge.
+        # Done for the whole (queries x pool) matrix at once; empty slots (-1) sink to the end.
+        METRICS.count("query.queries", len(queries))
+        with METRICS.span("query.rerank"):
+            slope = float(impact_slope)
+            valid = I != -1
+            pos = np.minimum(view.positions(I), len(view) - 1)
+            impacts = np.where(valid, np.asarray(view.impact, dtype="int64")[pos], 3)
+            adjusted = np.where(valid, D * (1.0 + slope * (impacts - 3)), -np.inf)
+
+            # Re-rank by adjusted score (stable on ties) and keep top-k
+            order = np.argsort(-adjusted, axis=1, kind="stable")[:, :k]
+
+        def score(m, qi, j):
+            v = float(m[qi, j])
+            return None if v != v else v  # NaN -> null: row came from the other list only
+
+        # Create the JSON payload responses
+        out = []
+        for qi, q in enumerate(queries):
+            payload = []
+            for j in order[qi]:
+                if not valid[qi, j]:
+                    break
+                i = int(pos[qi, j])
+                item: Dict[str, Any] = {
+                    "rank": len(payload) + 1,
+                    "id": view.ids[i],
+                    "title": view.titles[i],
+                    "path": view.paths[i],
+                    "impact": int(impacts[qi, j]),
+                }
+                if cos is not None:
+                    item["cosine"] = score(cos, qi, j)
+                if bm25 is not None:
+                    item["bm25"] = score(bm25, qi, j)
+                if mode == "hybrid":
+                    item["rrf"] = float(D[qi, j])
+                item["adjusted"] = float(adjusted[qi, j])
+                item["guidance"] = {
+                    "do_not_do": view.do_not_do[i],
+                    "do_instead": view.do_instead[i]
+                }
+                payload.append(item)
+            out.append({"query": q, "k": k, "results": payload})
+        return out
+
+def normalize_shard_scores(results: List[Dict[str, Any]], comparable: bool) -> List[float]:
+    """
+    Merge scores for one shard's ranked results. Adjusted cosines from stores that share
+    an embedding model are already on one scale and are kept; anything else (BM25, RRF,
+    different models) is min-max scaled to [0, 1] within the shard.
+    """
+    raw = [float(r["adjusted"]) for r in results]
+    if comparable or not raw:
+        return raw
+    lo, hi = min(raw), max(raw)
+    return [1.0 if hi == lo else (v - lo) / (hi - lo) for v in raw]
+
+class FederatedRetriever:
+    """
+    Several stores (shards) behind one search_many(): each query is embedded once per
+    distinct embedding model, every shard is searched in its own thread (FAISS and the
+    encoder release the GIL), and the per-shard top-k lists are merged with a heap.
+    Stores may mix schemas: rag.py lessons are re-ranked by their severity (SEVERITY_IMPACT).
+    Results carry the store they came from; a lesson file indexed by several stores is
+    returned once, from its best-scoring store.
+    """
+    def __init__(self, stores: List[Path], model: Optional[str] = None,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 threads: Optional[int] = None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.stores = [Path(s) for s in stores]
+        self._pool = ThreadPoolExecutor(max_workers=len(self.stores))
+        with METRICS.span("federated.load_shards"):
+            self.shards = list(self._pool.map(
+                lambda store: Retriever(store, model=model, nprobe=nprobe, ef_search=ef_search, threads=threads),
+                self.stores))
+        # Shards built with the same model + backend share one embedder (and its lock)
+        self.groups: Dict[Tuple[str, str], List[int]] = {}
+        for i, shard in enumerate(self.shards):
+            key = (shard.embedder.model_name, shard.embedder.backend)
+            if key in self.groups:
+                first = self.shards[self.groups[key][0]]
+                shard.embedder, shard._lock = first.embedder, first._lock
+            self.groups.setdefault(key, []).append(i)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def search(self, q: str, k: int = 5, pool: Optional[int] = None,
+               impact_slope: float = 0.10, mode: str = "dense") -> Dict[str, Any]:
+        return self.search_many([q], k=k, pool=pool, impact_slope=impact_slope, mode=mode)[0]
+
+    def search_many(self, queries: List[str], k: int = 5, pool: Optional[int] = None,
+                    impact_slope: float = 0.10, mode: str = "dense") -> List[Dict[str, Any]]:
+        import heapq
+
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown mode {mode!r}; expected one of {', '.join(SEARCH_MODES)}")
+        k = max(1, k)
+        if not queries:
+            return []
+        xq: List[Any] = [None] * len(self.shards)
+        if mode != "lexical":
+            for members in self.groups.values():
+                vecs = self.shards[members[0]].embed_queries(queries)
+                for i in members:
+                    xq[i] = vecs
+        comparable = mode == "dense" and len(self.groups) == 1
+
+        with METRICS.span("federated.search"):
+            futures = [self._pool.submit(shard.search_many, queries, k=k, pool=pool,
+                                         impact_slope=impact_slope, mode=mode, xq=xq[i])
+                       for i, shard in enumerate(self.shards)]
+            per_shard = [f.result() for f in futures]
+        METRICS.count("federated.shard_searches", len(self.shards))
+
+        out = []
+        with METRICS.span("federated.merge"):
+            for qi, q in enumerate(queries):
+                lists = []
+                for store, res in zip(self.stores, (shard_res[qi] for shard_res in per_shard)):
+                    scores = normalize_shard_scores(res["results"], comparable)
+                    lists.append([{**item, "store": str(store), "score": score}
+                                  for item, score in zip(res["results"], scores)])
+                # Each shard's list is already sorted by score: a k-way heap merge
+                merged, seen = [], set()
+                for item in heapq.merge(*lists, key=lambda r: -r["score"]):
+                    if item["path"] in seen:
+                        continue
+                    seen.add(item["path"])
+                    merged.append({**item, "rank": len(merged) + 1})
+                    if len(merged) == k:
+                        break
+                out.append({"query": q, "k": k, "stores": [str(s) for s in self.stores], "results": merged})
+        return out
+
+def pool_size(k: int, pool: Optional[int]) -> int:
+    # If user sent no --pool, fall back to heuristic max(k*4, 20).
+    # Else, respect their choice but ensure it's never < k.
     # (We do NOT force k*4 here because an explicit --pool is considered intentional.)
-    if args.pool is None:
-        pool = max(k * 4, 20)
-    else:
-        pool = max(k, args.pool)
+    if pool is None:
+        return max(k * 4, 20)
+    return max(k, pool)
+
+def run_batch(retriever: "Retriever", path: str, out, k: int, pool: Optional[int],
+              impact_slope: float, batch_size: int = 256, mode: str = "dense") -> int:
+    """Stream JSONL results (one line per query, same payload as --json-response)."""
+    n = 0
+    batch: List[Dict[str, Any]] = []
+
+    def flush():
+        for item, res in zip(batch, retriever.search_many([b["q"] for b in batch], k=k, pool=pool,
+                                                          impact_slope=impact_slope, mode=mode)):
+            if "id" in item:
+                res = {"id": item["id"], **res}
+            out.write(json.dumps(res, ensure_ascii=False) + "\n")
+        out.flush()
+        batch.clear()
+
+    for item in iter_batch_queries(path):
+        batch.append(item)
+        n += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return n
 
-    D, I = index.search(xq, pool)
+def cached_query(store: Path, cache: QueryCache, q: str, k: int, pool: int, impact_slope: float, mode: str,
+                 model: Optional[str] = None, nprobe: Optional[int] = None,
+                 ef_search: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Look a query up using only CURRENT + meta.json: a hit never loads the FAISS index or the model."""
+    gen_dir = resolve_store(store)
+    meta_path = gen_dir / "meta.json"
+    meta = load_json(meta_path) if meta_path.exists() else {}
+    key = query_cache_key(meta, q, k, pool, impact_slope, mode, model=model, nprobe=nprobe, ef_search=ef_search)
+    hit = cache.get(gen_dir, key) if key else None
+    return {**hit, "query": q} if hit is not None else None
 
-    # Impact-aware re-ranking: semantic first, impact as a gentle nudge
+def cmd_query(args):
+    k = max(1, args.k)
+    pool = pool_size(k, args.pool)
     slope = float(args.impact_slope)
-    candidates = []
-    for dist, idx in zip(D[0], I[0]):
-        if idx == -1:
-            continue
-        try:
-            with open(paths[idx], "r", encoding="utf-8") as f:
-                doc = json.load(f)
-            impact_level = int(doc.get("incident", {}).get("impact", {}).get("level", 3))
-        except Exception:
-            impact_level = 3
-
-        adjusted = float(dist) * (1.0 + slope * (impact_level - 3))
-        candidates.append({
-            "idx": int(idx),
-            "title": titles[idx],
-            "id": ids[idx],
-            "path": paths[idx],
-            "cosine": float(dist),
-            "impact": impact_level,
-            "adjusted": adjusted,
-        })
-
-    # Re-rank by adjusted score and keep top-k
-    candidates.sort(key=lambda r: r["adjusted"], reverse=True)
-    top = candidates[:k]
-
-    # Create the JSON payload response
-    payload = []
-    for r in top:
-        try:
-            with open(r["path"], "r", encoding="utf-8") as f:
-                doc = json.load(f)
-        except Exception:
-            doc = {}
-        g = doc.get("guidance", {}) or {}
-        payload.append({
-            "rank": len(payload) + 1,
-            "id": r["id"],
-            "title": r["title"],
-            "path": r["path"],
-            "impact": r["impact"],
-            "cosine": r["cosine"],
-            "adjusted": r["adjusted"],
-            "guidance": {
-                "do_not_do": g.get("do_not_do", ""),
-                "do_instead": g.get("do_instead", "")
-            }
-        })
+    federated = len(args.store) > 1
+    # Opt-in: the on-disk cache writes into the store, which a plain lookup must not do.
+    # Batches are throughput runs over mostly unique queries: no per-query cache files.
+    # Federated queries search every shard anyway, so they skip the cache too.
+    cache = QueryCache(persist=True) if args.query_cache and not args.batch and not federated else None
+
+    res = None
+    if cache is not None:
+        with METRICS.span("query.cache_lookup"):
+            res = cached_query(Path(args.store[0]), cache, args.q, k, pool, slope, args.mode, model=args.model,
+                               nprobe=args.nprobe, ef_search=args.ef_search)
+    if res is not None:
+        METRICS.count("query.cache_hits")
+    else:
+        with METRICS.span("query.load_store"):
+            if federated:
+                retriever = FederatedRetriever([Path(s) for s in args.store], model=args.model, nprobe=args.nprobe,
+                                               ef_search=args.ef_search, threads=args.threads)
+            else:
+                retriever = Retriever(Path(args.store[0]), model=args.model, nprobe=args.nprobe,
+                                      ef_search=args.ef_search, threads=args.threads, cache=cache)
+        if args.batch:
+            run_batch(retriever, args.batch, sys.stdout, k, pool, slope, batch_size=args.batch_size, mode=args.mode)
+            return 0
+        res = retriever.search(args.q, k=k, pool=pool, impact_slope=slope, mode=args.mode)
+    payload = res["results"]
 
     if args.json_response:
-        print(json.dumps({"query": args.q, "k": k, "results": payload}, ensure_ascii=False, indent=2))
+        print(json.dumps(res, ensure_ascii=False, indent=2))
         return 0
     
     # default: human-readable response
     print(f"\nTop {k} results for: {args.q}")
-    print(f"(using impact-slope={slope}, pool={pool})\n")
+    print(f"(using impact-slope={slope}, pool={pool}{'' if args.mode == 'dense' else f', mode={args.mode}'})\n")
     for item in payload:
-        print(f"{item['rank']}. {item['title']}  "
-            f"(adj={item['adjusted']:.4f} | cos={item['cosine']:.4f} | impact={item['impact']})")
+        scores = [f"adj={item['adjusted']:.4f}"]
+        for name, short in (("cosine", "cos"), ("bm25", "bm25")):
+            if item.get(name) is not None:
+                scores.append(f"{short}={item[name]:.4f}")
+        print(f"{item['rank']}. {item['title']}  ({' | '.join(scores)} | impact={item['impact']})")
         print(f"   id: {item['id']}")
         print(f"   file: {item['path']}")
+        if "store" in item:
+            print(f"   store: {item['store']}  (merge score={item['score']:.4f})")
         if item["guidance"]["do_not_do"]:
             print(f"   ❌ Do NOT: {item['guidance']['do_not_do']}")
         if item["guidance"]["do_instead"]:
@@ -460,41 +1349,283 @@ def cmd_query(args):
         print() # blank line on purpose after each result
     return 0
 
+def cmd_dedupe(args):
+    import numpy as np
+    with METRICS.span("dedupe.load_store"):
+        view = StoreView(resolve_store(Path(args.store)))
+    impact = np.asarray(view.impact, dtype="int64")
+
+    def describe(row: int) -> Dict[str, Any]:
+        i = int(view.positions([row])[0])
+        return {"id": view.ids[i], "title": view.titles[i], "path": view.paths[i], "impact": int(impact[i])}
+
+    t0 = time.perf_counter()
+    clusters, pairs = duplicate_clusters(view.index, args.threshold, lambda rows: impact[view.positions(rows)],
+                                         exact_max=args.exact_max, nprobe=args.nprobe)
+    report = dedupe_report(
+        clusters, describe, store=str(args.store), build_id=view.meta.get("build_id"), threshold=args.threshold,
+        num_items=len(view), num_pairs=pairs,
+        search="exact" if len(view) <= args.exact_max else f"ivf (nprobe={args.nprobe})",
+        elapsed_s=round(time.perf_counter() - t0, 3),
+    )
+    if not args.out:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+
+    save_json(Path(args.out), report)
+    print(f"✅ {report['num_duplicates']} near-duplicate lesson(s) in {report['num_clusters']} cluster(s) "
+          f"among {len(view)} (cosine >= {args.threshold}, {report['search']} search, {report['elapsed_s']}s); "
+          f"report saved to {args.out}")
+    for c in report["clusters"][:args.show]:
+        print(f"\n{c['keep']['title']}  (keep, impact={c['keep']['impact']})\n   file: {c['keep']['path']}")
+        for d in c["duplicates"]:
+            print(f"   ≈ {d['title']}  (cos={d['cosine']:.4f})\n     file: {d['path']}")
+    return 0
+
+# ---------- serve ----------
+class _QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET  /query?q=...&k=5&pool=20&impact_slope=0.1&mode=hybrid
+    POST /query  {"q": "...", "k": 5, "pool": 20, "impact_slope": 0.1, "mode": "hybrid"}
+    GET  /health
+    GET  /metrics   Prometheus text format (spans + counters)
+    Responses match `query --json-response`.
+    """
+    retriever: "Retriever" = None  # set by cmd_serve
+    defaults: Dict[str, Any] = {}
+
+    def _send_json(self, code: int, obj: Dict[str, Any]):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, params: Dict[str, Any]):
+        METRICS.count("serve.requests")
+        with METRICS.span("serve.request"):
+            self._answer_inner(params)
+
+    def _answer_inner(self, params: Dict[str, Any]):
+        q = params.get("q")
+        if not q:
+            self._send_json(400, {"error": "missing 'q'"})
+            return
+        try:
+            k = int(params.get("k", self.defaults.get("k", 5)))
+            pool = params.get("pool", self.defaults.get("pool"))
+            pool = int(pool) if pool not in (None, "") else None
+            slope = float(params.get("impact_slope", self.defaults.get("impact_slope", 0.10)))
+        except (TypeError, ValueError) as e:
+            self._send_json(400, {"error": f"bad parameter: {e}"})
+            return
+        mode = params.get("mode") or self.defaults.get("mode", "dense")
+        try:
+            self._send_json(200, self.retriever.search(q, k=k, pool=pool, impact_slope=slope, mode=mode))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            METRICS.count("serve.errors")
+            self._send_json(500, {"error": str(e)})
+
+    def _send_metrics(self):
+        body = METRICS.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self.retriever.reload()
+            self._send_json(200, {"status": "ok", "num_items": len(self.retriever),
+                                  "build_id": self.retriever.view.meta.get("build_id")})
+        elif url.path == "/query":
+            self._answer({k: v[-1] for k, v in parse_qs(url.query).items()})
+        elif url.path == "/metrics":
+            self._send_metrics()
+        else:
+            self._send_json(404, {"error": f"unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/query":
+            self._send_json(404, {"error": f"unknown path {url.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON body: {e}"})
+            return
+        if not isinstance(params, dict):
+            self._send_json(400, {"error": "JSON body must be an object"})
+            return
+        self._answer(params)
+
+    def log_message(self, fmt, *args):
+        if self.defaults.get("verbose"):
+            super().log_message(fmt, *args)
+
+def cmd_serve(args):
+    # Long-running: always collect so /metrics has data (spans are a couple of perf_counter calls)
+    METRICS.enabled = True
+    cache = None if args.no_query_cache else QueryCache(max_items=args.query_cache_size)
+    retriever = Retriever(Path(args.store), model=args.model, nprobe=args.nprobe, ef_search=args.ef_search,
+                          threads=args.threads, cache=cache)
+    # Warm up so the first real request doesn't pay lazy init costs
+    retriever.search("warm up", k=1, mode=args.mode)
+
+    _QueryHandler.retriever = retriever
+    _QueryHandler.defaults = {
+        "k": args.k,
+        "pool": args.pool,
+        "impact_slope": args.impact_slope,
+        "mode": args.mode,
+        "verbose": args.verbose,
+    }
+    server = ThreadingHTTPServer((args.host, args.port), _QueryHandler)
+    print(f"✅ Serving {args.store} ({len(retriever)} items) on http://{args.host}:{server.server_port}/query",
+          flush=True)
+    stop = threading.Event()
+    if args.metrics_file:
+        threading.Thread(target=write_metrics_periodically, args=(args.metrics_file, args.metrics_interval, stop),
+                         daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+    return 0
+
 # ---------- main ----------
 def main():
     p = argparse.ArgumentParser(description="UltraLight Lessons RAG")
     sub = p.add_subparsers(dest="cmd", required=True)
 
-    v = sub.add_parser("validate", help="Validate (permissively) UltraLight JSON files")
+    # Instrumentation flags shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--timings", action="store_true", help="Print per-stage timings + counters as JSON to stderr")
+    common.add_argument("--profile", metavar="FILE", default=None, help="Write a cProfile dump of the whole command")
+    common.add_argument("--metrics-file", metavar="PATH", default=None,
+                        help="Write Prometheus text-format metrics to PATH on exit (serve: periodically)")
+
+    v = sub.add_parser("validate", help="Validate (permissively) UltraLight JSON files", parents=[common])
     v.add_argument("--data", required=True, help="Directory with *.json lesson files")
+    v.add_argument("--jobs", type=int, default=1, help="Worker processes (files are validated in parallel)")
     v.add_argument("--schema", help="Optional: path to a custom schema JSON")
     v.set_defaults(func=cmd_validate)
 
-    b = sub.add_parser("build-index", help="Build FAISS index from UltraLight JSON files")
+    b = sub.add_parser("build-index", help="Build FAISS index from UltraLight JSON files", parents=[common])
     b.add_argument("--data", required=True, help="Directory with *.json lesson files")
     b.add_argument("--out", required=True, help="Output directory for store")
-    b.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2", help="SBERT model")
+    b.add_argument("--model", default=DEFAULT_MODEL, help="SBERT model")
+    b.add_argument("--jobs", type=int, default=1, help="Worker processes for loading/normalizing lessons")
+    b.add_argument("--embed-batch-size", type=int, default=256, help="Texts per embedding batch (bounds build memory)")
+    b.add_argument("--queue-size", type=int, default=4, help="Batches buffered between reading and embedding")
     b.add_argument("--write-back", action="store_true", help="Persist normalized impact + rag back to source JSONs")
     b.add_argument("--reset", action="store_true", help="Reset (delete + rebuild) the output folder before building index")
+    b.add_argument("--embedder", choices=EMBEDDER_BACKENDS, default="sbert",
+                   help="sbert = PyTorch fp32; onnx-int8 = quantized ONNX Runtime (exported once into <out>/onnx/)")
+    b.add_argument("--threads", type=int, default=None, help="CPU threads for encoding (default: library default)")
+    b.add_argument("--check-agreement", type=int, default=0, metavar="N",
+                   help="With --embedder onnx-int8: compare N texts against fp32 SBERT (cosine + speedup)")
+    b.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                   help="flat = exact search; ivf / hnsw = approximate, for large corpora (default: flat)")
+    b.add_argument("--vector-dtype", choices=VECTOR_DTYPES, default="float32",
+                   help="flat: store vectors as float32, float16 (2x smaller) or int8 scalar-quantized (4x)")
+    b.add_argument("--pca-dim", type=int, default=None,
+                   help="flat: PCA-reduce vectors to this many dimensions before storing (recorded in meta.json)")
+    b.add_argument("--check-recall", type=int, default=0, metavar="N",
+                   help="After building, report recall@10 of the index vs exact float32 search over N title queries")
+    b.add_argument("--nlist", type=int, default=None, help="IVF: number of cells (default: 4*sqrt(n))")
+    b.add_argument("--nprobe", type=int, default=None, help=f"IVF: cells searched per query, stored in meta.json (default: {INDEX_DEFAULTS['nprobe']})")
+    b.add_argument("--train-size", type=int, default=None, help=f"IVF / int8 / PCA: max training sample (default: {INDEX_DEFAULTS['train_size']})")
+    b.add_argument("--hnsw-m", type=int, default=None, help=f"HNSW: graph degree (default: {INDEX_DEFAULTS['hnsw_m']})")
+    b.add_argument("--ef-search", type=int, default=None, help=f"HNSW: search breadth, stored in meta.json (default: {INDEX_DEFAULTS['ef_search']})")
+    b.add_argument("--keep-generations", type=int, default=3, help="Published store generations to keep on disk")
+    b.add_argument("--embed-cache", default=None,
+                   help="Embedding cache dir shared across stores (default: $ANTIFRAGILE_EMBED_CACHE or ~/.cache/antifragile-tpm/embeddings)")
+    b.add_argument("--embed-cache-max", type=int, default=200_000, help="Max cached vectors per model before LRU eviction")
+    b.add_argument("--no-embed-cache", action="store_true", help="Always re-encode instead of using the embedding cache")
+    b.add_argument("--dedupe", type=float, nargs="?", const=DEDUPE_THRESHOLD, default=None, metavar="COS",
+                   help=f"Hide near-duplicate lessons (cosine >= COS, default {DEDUPE_THRESHOLD}) from query results, "
+                        "keeping the highest-impact one per cluster; report in <generation>/dedupe.json")
+    b.add_argument("--watch", action="store_true",
+                   help="After building, keep watching --data and publish an incremental build on every change")
+    b.add_argument("--debounce", type=float, default=0.2, help="--watch: seconds of quiet before re-indexing a burst of changes")
+    b.add_argument("--poll", action="store_true", help="--watch: poll file mtimes instead of using inotify")
+    b.add_argument("--poll-interval", type=float, default=1.0, help="--watch: seconds between polls (polling fallback)")
     b.set_defaults(func=cmd_build_index)
 
-    q = sub.add_parser("query", help="Query the store with a natural-language prompt")
-    q.add_argument("--store", required=True, help="Path to store directory created by build-index")
-    q.add_argument("--q", required=True, help="Natural language query")
+    q = sub.add_parser("query", help="Query the store with a natural-language prompt", parents=[common])
+    q.add_argument("--store", required=True, action="append",
+                   help="Path to store directory created by build-index (rag.py or ultralight); repeat to "
+                        "search several stores in parallel and merge their top-k")
+    qg = q.add_mutually_exclusive_group(required=True)
+    qg.add_argument("--q", help="Natural language query")
+    qg.add_argument("--batch", help="JSONL file of queries ('-' = stdin); streams one JSON result per line")
+    q.add_argument("--batch-size", type=int, default=256, help="Queries embedded + searched together in --batch mode")
     q.add_argument("-k", type=int, default=5, help="Top-k results")
-    q.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    q.add_argument("--model", default=None, help="Embedding model (default: the one recorded in the store's meta.json)")
+    q.add_argument("--threads", type=int, default=None, help="CPU threads for query encoding")
+    q.add_argument("--nprobe", type=int, default=None, help="IVF stores: override the stored nprobe")
+    q.add_argument("--ef-search", type=int, default=None, help="HNSW stores: override the stored efSearch")
     q.add_argument("--impact-slope", type=float, default=0.10, help="Re-ranking slope for impact weighting (e.g., 0.1)")
     q.add_argument("--pool", type=int, default=None, help="Candidate pool size for re-ranking (default = max(k*4, 20))")
+    q.add_argument("--mode", choices=SEARCH_MODES, default="dense",
+                   help="dense = embeddings; lexical = BM25 only (no model load); hybrid = both, fused by reciprocal rank")
     q.add_argument("--json-response", action="store_true", help="JSON response with the top-k results")
+    q.add_argument("--query-cache", action="store_true",
+                   help="Read and write the store's on-disk query result cache (<generation>/query_cache/)")
 
     q.set_defaults(func=cmd_query)
 
+    d = sub.add_parser("dedupe", help="Report near-duplicate lessons in a store (FAISS range search + union-find)",
+                       parents=[common])
+    d.add_argument("--store", required=True, help="Path to store directory created by build-index (rag.py or ultralight)")
+    d.add_argument("--threshold", type=float, default=DEDUPE_THRESHOLD, help=f"Cosine similarity cut-off (default: {DEDUPE_THRESHOLD})")
+    d.add_argument("--out", default=None, help="Write the JSON report here and print a summary (default: JSON to stdout)")
+    d.add_argument("--show", type=int, default=10, help="Clusters printed with --out")
+    d.add_argument("--exact-max", type=int, default=DEDUPE_EXACT_MAX,
+                   help=f"Largest store searched exactly; bigger ones use a temporary IVF index (default: {DEDUPE_EXACT_MAX})")
+    d.add_argument("--nprobe", type=int, default=DEDUPE_NPROBE, help="IVF cells searched per lesson above --exact-max")
+    d.set_defaults(func=cmd_dedupe)
+
+    s = sub.add_parser("serve", help="Load the store once and answer queries over local HTTP", parents=[common])
+    s.add_argument("--store", required=True, help="Path to store directory created by build-index")
+    s.add_argument("--model", default=None, help="Embedding model (default: the one recorded in the store's meta.json)")
+    s.add_argument("--threads", type=int, default=None, help="CPU threads for query encoding")
+    s.add_argument("--nprobe", type=int, default=None, help="IVF stores: override the stored nprobe")
+    s.add_argument("--ef-search", type=int, default=None, help="HNSW stores: override the stored efSearch")
+    s.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1)")
+    s.add_argument("--port", type=int, default=8765, help="Port (default: 8765; 0 = pick a free one)")
+    s.add_argument("-k", type=int, default=5, help="Default top-k when a request omits it")
+    s.add_argument("--impact-slope", type=float, default=0.10, help="Default impact slope when a request omits it")
+    s.add_argument("--pool", type=int, default=None, help="Default candidate pool when a request omits it")
+    s.add_argument("--mode", choices=SEARCH_MODES, default="dense", help="Default search mode when a request omits it")
+    s.add_argument("--query-cache-size", type=int, default=1024, help="Query results kept in memory (LRU; never written to the store)")
+    s.add_argument("--no-query-cache", action="store_true", help="Disable the query result cache")
+    s.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    s.add_argument("--metrics-interval", type=float, default=15.0, help="Seconds between --metrics-file rewrites")
+    s.set_defaults(func=cmd_serve)
+
     args = p.parse_args()
+    METRICS.prefix = "rag_ultralight"  # Prometheus series names; rag.py keeps the default "rag"
+    profiler = start_instrumentation(args)
     try:
-        rc = args.func(args)
+        with METRICS.span(f"cmd.{args.cmd}"):
+            rc = args.func(args)
     except Exception as e:
         print(f"ERROR: {e}", file=sys.stderr)
         rc = 1
+    finally:
+        finish_instrumentation(args, profiler)
     sys.exit(rc)
 
 if __name__ == "__main__":
@@ -5,22 +5,43 @@ Ultra-light RAG POC for "via negativa" lessons.
 - Validates JSON files against the lesson_case schema (embedded here as DEFAULT_SCHEMA).
 - Ensures a canonical rag.text is present (auto-composes if missing).
 - Writes a .rag text file NEXT TO each JSON lesson (same basename, .rag extension).
-- Appends normalized records to a JSONL ("chunks.jsonl").
+- Writes normalized records to a JSONL ("chunks.jsonl") and a manifest for incremental rebuilds,
+  publishing each build as a new store generation (atomic CURRENT pointer swap).
 - Builds a FAISS vector index over rag.text using sentence-transformers (local).
 - Provides a simple `query` command to retrieve top-k similar lessons.
+- Provides a `serve` command that keeps the store loaded and answers queries over local HTTP.
 
 Usage examples:
   python antifragile_build_index.py validate --data ./data
   python antifragile_build_index.py build-index --data ./data --out ./rag_store
+  python antifragile_build_index.py build-index --data ./data --out ./rag_store --embedder onnx-int8 --check-agreement 32
   python antifragile_build_index.py query --store ./rag_store --q "Kickoff for a biotech client; avoid data mistakes" -k 5
+  python antifragile_build_index.py query --store ./rag_store --q "data mistakes" --where phase=Kickoff --where confidentiality!=Restricted
+  python antifragile_build_index.py query --store ./rag_store --q "HIPAA" --mode hybrid
+  python antifragile_build_index.py query --store ./rag_store --batch questions.jsonl -k 5 > answers.jsonl
+  python antifragile_build_index.py serve --store ./rag_store --port 8766
 """
 import argparse
 import json
 import sys
 import shutil
+import threading
 from datetime import date, datetime, UTC
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from rag_common import (
+    DEFAULT_MODEL, EMBEDDER_BACKENDS, EmbedPipeline, Embedder, EmbeddingCache, FileWriter, INDEX_DEFAULTS,
+    INDEX_TYPES, IndexBuilder, LexicalIndex, MANIFEST_FORMAT, METRICS, SEARCH_MODES, VECTOR_DTYPES, as_list,
+    check_file, check_recall, compare_embedders, configure_index, default_embed_cache_dir, embed_cache_key,
+    finish_instrumentation, index_spec, iter_batch_queries, iter_json_files, lesson_json_bytes, load_chunks,
+    load_json, load_manifest, map_files, new_build_id, onnx_model_dir, prune_generations, publish_generation,
+    read_store_index, resolve_store, rrf_fuse, search_params, sha256_text, spec_matches,
+    start_instrumentation, unchanged_files, validate_in_worker, write_lexical, write_metrics_periodically,
+)
 
 # --- Embedded default JSON Schema (draft-07) ---
 DEFAULT_SCHEMA = {
@@ -101,34 +122,6 @@ DEFAULT_SCHEMA = {
   "additionalProperties": False
 }
 
-# --- utilities ---
-def iter_json_files(root: Path) -> List[Path]:
-    return sorted([p for p in root.rglob("*.json") if p.is_file()])
-
-def load_json(path: Path) -> Dict[str, Any]:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def append_jsonl(path: Path, obj: Dict[str, Any]):
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
-
-def validate_json(doc: Dict[str, Any], schema: Dict[str, Any]) -> Tuple[bool, str]:
-    try:
-        from jsonschema import Draft7Validator
-    except ImportError:
-        print("Please install jsonschema: pip install jsonschema")
-        return False, "jsonschema not installed"
-    v = Draft7Validator(schema)
-    errors = sorted(v.iter_errors(doc), key=lambda e: e.path)
-    if not errors:
-        return True, ""
-    msgs = []
-    for e in errors:
-        where = "/".join(map(str, e.path))
-        msgs.append(f" - {where or '$'}: {e.message}")
-    return False, "\n".join(msgs)
-
 # --- RAG text builder (existing logic you already had) ---
 def build_rag_text(d: Dict[str, Any]) -> str:
     """Compose a narrative rag.text from canonical fields."""
@@ -187,11 +180,6 @@ def ensure_rag_text(d: Dict[str, Any]) -> Dict[str, Any]:
     """
     return ensure_rag(d, force=False)
 
-def _as_list(x):
-    if x is None:
-        return []
-    return x if isinstance(x, list) else [x]
-
 def ensure_rag(case: Dict[str, Any], force: bool = False) -> Dict[str, Any]:
     """
     Ensure a retrieval-ready rag block exists and meets schema:
@@ -208,7 +196,7 @@ def ensure_rag(case: Dict[str, Any], force: bool = False) -> Dict[str, Any]:
         text = build_rag_text(c)
     if len(text) < 200:
         # pad with a compact recap to meet the schema + help embeddings
-        industries = ", ".join(_as_list(c.get("industries")))
+        industries = ", ".join(as_list(c.get("industries")))
         recap = (
             f" This lesson emphasizes preventing recurrence via clear stakeholder alignment, "
             f"early risk surfacing, and explicit definitions of done. Applicable to "
@@ -231,9 +219,9 @@ def ensure_rag(case: Dict[str, Any], force: bool = False) -> Dict[str, Any]:
     new_meta = {
         "phase": c.get("phase", ""),
         "area": c.get("area", ""),
-        "industries": _as_list(c.get("industries")),
+        "industries": as_list(c.get("industries")),
         "severity": c.get("severity", ""),
-        "tags": _as_list(c.get("tags")),
+        "tags": as_list(c.get("tags")),
         "first_validated": first,
         "last_validated": today,
         # helpful (optional) extras:
@@ -245,38 +233,98 @@ def ensure_rag(case: Dict[str, Any], force: bool = False) -> Dict[str, Any]:
     c["rag"] = {"text": text, "meta": new_meta}
     return c
 
-# --- sidecar writer ---
-def _write_rag_sidecar(json_path: Path, text: str):
-    sidecar = json_path.with_suffix(".rag")
-    with open(sidecar, "w", encoding="utf-8") as f:
-        f.write(text)
+# --- filter bitmaps ---
+# One packed bitmap per (field, value) over FAISS ids, built at index time. Query-time
+# --where filters combine them and hand the result to FAISS as an IDSelectorBitmap, so
+# filtering happens inside the search instead of by over-fetching and discarding.
+FILTER_FIELDS = ("phase", "area", "industries", "severity", "lesson_type", "confidentiality")
+FILTER_ALIASES = {"industry": "industries", "type": "lesson_type"}
 
-# --- minimal embedder + FAISS index ---
-class Embedder:
-    def __init__(self, model: str):
-        self.model_name = model
-        try:
-            from sentence_transformers import SentenceTransformer
-        except ImportError:
-            raise RuntimeError("Please install sentence-transformers")
-        self.model = SentenceTransformer(model)
+def write_bitmaps(out_dir: Path, records: List[Dict[str, Any]]):
+    import numpy as np
+    nbits = max((r["row"] for r in records), default=-1) + 1
+    members: Dict[str, List[int]] = {}
+    for r in records:
+        for field in FILTER_FIELDS:
+            for value in as_list(r.get(field)):
+                members.setdefault(f"{field}={str(value).lower()}", []).append(r["row"])
+    keys = sorted(members)
+    mat = np.zeros((len(keys), (nbits + 7) // 8), dtype="uint8")
+    for i, key in enumerate(keys):
+        bits = np.zeros(nbits, dtype=bool)
+        bits[members[key]] = True
+        mat[i] = np.packbits(bits, bitorder="little")
+    np.save(out_dir / "bitmaps.npy", mat)
+    with open(out_dir / "bitmaps.json", "w", encoding="utf-8") as f:
+        json.dump({"nbits": nbits, "keys": {k: i for i, k in enumerate(keys)}}, f, ensure_ascii=False)
+
+def parse_where(clauses: List[str]) -> List[Tuple[str, str, str]]:
+    """['phase=Kickoff', 'confidentiality!=Restricted'] -> [(field, op, value), ...]"""
+    out = []
+    for c in clauses or []:
+        op = "!=" if "!=" in c else "="
+        field, sep, value = c.partition(op)
+        field = FILTER_ALIASES.get(field.strip().lower(), field.strip().lower())
+        if not sep or not value.strip():
+            raise ValueError(f"Bad --where {c!r}; expected field=value or field!=value")
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter field {field!r}; available: {', '.join(FILTER_FIELDS)}")
+        out.append((field, op, value.strip().lower()))
+    return out
+
+class Bitmaps:
+    """Per-(field, value) bitmaps of a store generation (memory-mapped)."""
+    def __init__(self, path: Path):
+        import numpy as np
+        info = load_json(path / "bitmaps.json")
+        self.nbits = int(info["nbits"])
+        self.keys: Dict[str, int] = info["keys"]
+        self.mat = np.load(path / "bitmaps.npy", mmap_mode="r")
+
+    def select(self, where: List[Tuple[str, str, str]]):
+        """
+        Combine filters into one packed bitmap: values of the same field are OR'ed,
+        different fields AND'ed, and `!=` clauses removed.
+        """
+        import numpy as np
+        nbytes = (self.nbits + 7) // 8
+        empty = np.zeros(nbytes, dtype="uint8")
+        acc = np.full(nbytes, 0xFF, dtype="uint8")
+        include: Dict[str, Any] = {}
+        for field, op, value in where:
+            i = self.keys.get(f"{field}={value}")
+            bm = self.mat[i] if i is not None else empty
+            if op == "!=":
+                acc &= ~bm
+            else:
+                include[field] = include.get(field, empty) | bm
+        for bm in include.values():
+            acc &= bm
+        return acc
+
+# --- parallel file processing ---
+# One lesson per call, fanned out over --jobs processes by map_files
+def _prepare_lesson(p: Path, force: bool = False,
+                    write_back: bool = False) -> Tuple[Dict[str, Any], int, List[Tuple[Path, bytes]], bool, str]:
+    """
+    Ensure rag and validate one lesson. Returns (doc, mtime_ns, writes, valid, validation
+    message); `writes` holds the .rag sidecar and, with write_back, the enriched JSON first,
+    for the caller's FileWriter.
+    """
+    mtime_ns = p.stat().st_mtime_ns
 
-    def embed(self, texts: List[str]):
-        return self.model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+    # 1) Build/refresh the rag block before validating
+    doc = ensure_rag(load_json(p), force=force)
 
-def build_faiss_index(vectors, out_dir: Path):
-    try:
-        import faiss
-    except ImportError:
-        raise RuntimeError("Please install faiss-cpu")
-    import numpy as np
-    vecs = vectors.astype("float32")
-    d = vecs.shape[1]
-    index = faiss.IndexFlatIP(d)
-    # normalize for cosine
-    faiss.normalize_L2(vecs)
-    index.add(vecs)
-    faiss.write_index(index, str(out_dir / "index.faiss"))
+    # 2) Optionally write back the enriched JSON so source stays consistent
+    writes = [(p, lesson_json_bytes(doc))] if write_back else []
+
+    # 3) Validate after rag is present
+    ok, msg = validate_in_worker(doc)
+
+    # .rag sidecar next to the lesson JSON
+    writes.append((p.with_suffix(".rag"), doc["rag"]["text"].encode("utf-8")))
+    return doc, mtime_ns, writes, ok, msg
 
 # --- commands ---
 def cmd_validate(args):
@@ -287,9 +335,7 @@ def cmd_validate(args):
         print(f"No JSON files found under {data_dir}")
         return 1
     bad = 0
-    for p in files:
-        doc = load_json(p)
-        ok, msg = validate_json(doc, schema)
+    for p, (ok, msg) in zip(files, map_files(check_file, files, args.jobs, schema)):
         if ok:
             print(f"✅ {p}")
         else:
@@ -301,6 +347,11 @@ def cmd_validate(args):
     return 0
 
 def cmd_build_index(args):
+    try:
+        import faiss
+    except ImportError:
+        raise RuntimeError("Please install faiss-cpu")
+
     data_dir = Path(args.data)
     out_dir = Path(args.out)
 
@@ -308,9 +359,8 @@ def cmd_build_index(args):
         shutil.rmtree(out_dir)
 
     out_dir.mkdir(parents=True, exist_ok=True)
-
-    chunks_path = out_dir / "chunks.jsonl"
-    ids_path = out_dir / "ids.jsonl"
+    prev_dir = resolve_store(out_dir)
+    index_path = prev_dir / "index.faiss"
 
     schema = DEFAULT_SCHEMA if not args.schema else load_json(Path(args.schema))
     files = iter_json_files(data_dir)
@@ -318,150 +368,623 @@ def cmd_build_index(args):
         print(f"No JSON files found under {data_dir}")
         return 1
 
-    # load, ENSURE RAG (so TPMs never need to author it), validate, collect texts
-    texts = []
-    ids = []
-    titles = []
-    paths = []
-
-    for p in files:
-        doc = load_json(p)
-
-        # 1) Build/refresh the rag block before validating
-        doc = ensure_rag(doc, force=getattr(args, "force_autogen", False))
-
-        # 2) Optionally write back the enriched JSON so source stays consistent
-        if getattr(args, "write_back", False):
-            try:
-                with open(p, "w", encoding="utf-8") as wf:
-                    json.dump(doc, wf, ensure_ascii=False, indent=2)
-            except Exception as e:
-                print(f"⚠️  Failed to write-back {p}: {e}")
-
-        # 3) Validate after rag is present
-        ok, msg = validate_json(doc, schema)
-        if not ok:
-            if args.strict:
-                print(f"❌ {p} failed validation (strict mode).")
-                print(msg)
-                return 2
-            else:
-                print(f"⚠️  {p} failed validation; continuing (non-strict).\n{msg}\n")
-
-        # write .rag sidecar next to the lesson JSON
-        _write_rag_sidecar(p, doc["rag"]["text"])
-
-        # normalized record for JSONL
-        rec = {
-            "id": doc["id"],
-            "path": str(p),
-            "title": doc["title"],
-            "phase": doc["phase"],
-            "area": doc["area"],
-            "industries": doc["industries"],
-            "severity": doc["severity"],
-            "tags": doc["tags"],
-            "rag_text": doc["rag"]["text"]
-        }
-        append_jsonl(chunks_path, rec)
-        append_jsonl(ids_path, {"id": doc["id"], "path": str(p), "title": doc["title"]})
-        texts.append(doc["rag"]["text"])
-        ids.append(doc["id"])
-        titles.append(doc["title"])
-        paths.append(str(p))
-
-    # embed & build FAISS
-    embedder = Embedder(model=args.model)
-    vecs = embedder.embed(texts)
-    build_faiss_index(vecs, out_dir)
+    force = getattr(args, "force_autogen", False)
+
+    # Reuse the previous build only when it has a manifest and the same model;
+    # legacy stores and model switches fall back to a full rebuild.
+    prev_meta = load_json(prev_dir / "meta.json") if (prev_dir / "meta.json").exists() else {}
+    prev = load_manifest(prev_dir)
+    index = None
+    spec = index_spec(args)
+    reusable = (prev and index_path.exists() and prev_meta.get("model") == args.model
+                and prev_meta.get("embedder", "sbert") == args.embedder and spec_matches(spec, prev_meta))
+    if reusable:
+        index = faiss.read_index(str(index_path))
+    else:
+        prev = {}
+    prev_chunks = load_chunks(prev_dir) if prev else {}
+    prev_by_path = {e["path"]: (lid, e) for lid, e in prev.items()}
+    next_row = max((e["row"] for e in prev.values()), default=-1) + 1
+
+    # write everything into a fresh generation dir; readers keep the published
+    # one until CURRENT is swapped at the very end
+    build_id = new_build_id()
+    gen_dir = out_dir / "generations" / build_id
+    gen_dir.mkdir(parents=True)
+
+    # streaming pipeline: lessons are loaded/validated (across --jobs processes) while
+    # new/changed texts are embedded in --embed-batch-size batches on a background thread
+    # and added to the id-mapped FAISS index; chunk records are written as they are made
+    cache = None
+    if not args.no_embed_cache:
+        cache = EmbeddingCache(Path(args.embed_cache) if args.embed_cache else default_embed_cache_dir(),
+                               embed_cache_key(args.model, args.embedder), max_items=args.embed_cache_max)
+    embedder = Embedder(model=args.model, cache=cache, backend=args.embedder,
+                        onnx_dir=onnx_model_dir(out_dir, args.model), threads=args.threads)
+    builder = IndexBuilder(spec, index=index, expected=len(files))
+    pipeline = EmbedPipeline(embedder, builder, batch_size=args.embed_batch_size, queue_size=args.queue_size)
+
+    # load, ENSURE RAG (so TPMs never need to author it), validate, stream texts
+    manifest: Dict[str, Dict[str, Any]] = {}
+    records: Dict[int, Dict[str, Any]] = {}  # filter fields only; rag_text goes straight to chunks.jsonl
+    stale_rows: List[int] = []
+    sample: List[str] = []  # first texts, for --check-agreement
+    unchanged = 0
+
+    def emit(rec: Dict[str, Any]):
+        cf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        idf.write(json.dumps({"row": rec["row"], "id": rec["id"], "path": rec["path"], "title": rec["title"]},
+                             ensure_ascii=False) + "\n")
+        if len(sample) < args.check_agreement:
+            sample.append(rec["rag_text"])
+        records[rec["row"]] = {k: v for k, v in rec.items() if k != "rag_text"}
+
+    # Files untouched since the last build (and rag not being regenerated or written back)
+    # keep their row without being read; everything else is prepared across --jobs processes.
+    write_back = getattr(args, "write_back", False)
+    fresh = unchanged_files(files, prev_by_path, prev_chunks, read_all=force or write_back)
+    prepare = partial(_prepare_lesson, force=force, write_back=write_back)
+    prepared = map_files(prepare, [p for p in files if p not in fresh], args.jobs, schema)
+    writer = FileWriter()
+    written_back: Dict[str, Any] = {}  # lesson id -> write-back future (new mtime for the manifest)
+
+    try:
+        with METRICS.span("build.scan"), \
+             open(gen_dir / "chunks.jsonl", "w", encoding="utf-8") as cf, \
+             open(gen_dir / "ids.jsonl", "w", encoding="utf-8") as idf:
+            for p in files:
+                # 0) Untouched since the last build -> keep its row
+                if p in fresh:
+                    lid, entry = prev_by_path[str(p)]
+                    if lid in manifest:
+                        print(f"⚠️  Duplicate id {lid} in {p}; already indexed from {manifest[lid]['path']}. Skipping.")
+                        continue
+                    manifest[lid] = entry
+                    emit(prev_chunks.pop(entry["row"]))
+                    METRICS.count("build.fast_path")
+                    unchanged += 1
+                    continue
+
+                # 1-3) rag ensured and validated by _prepare_lesson; write-back/sidecar queued
+                # after the strict check, so a lesson that aborts the build is never rewritten
+                doc, mtime_ns, writes, ok, msg = next(prepared)
+                if not ok:
+                    if args.strict:
+                        print(f"❌ {p} failed validation (strict mode).")
+                        print(msg)
+                        prepared.close()
+                        writer.close()
+                        pipeline.abort()
+                        shutil.rmtree(gen_dir, ignore_errors=True)
+                        return 2
+                    else:
+                        print(f"⚠️  {p} failed validation; continuing (non-strict).\n{msg}\n")
+                futures = [writer.submit(path, data) for path, data in writes]
+
+                lid = doc["id"]
+                if lid in manifest:
+                    print(f"⚠️  Duplicate id {lid} in {p}; already indexed from {manifest[lid]['path']}. Skipping.")
+                    continue
+
+                # 4) Re-embed only when rag.text actually changed
+                text = doc["rag"]["text"]
+                digest = sha256_text(text)
+                old = prev.get(lid)
+                if old and old["sha256"] == digest:
+                    row = old["row"]
+                    unchanged += 1
+                else:
+                    row = next_row
+                    next_row += 1
+                    pipeline.put(row, text)
+                    if old:
+                        stale_rows.append(old["row"])
+
+                manifest[lid] = {"path": str(p), "mtime_ns": mtime_ns, "sha256": digest, "row": row}
+                if write_back:
+                    written_back[lid] = futures[0]
+
+                # normalized record for JSONL
+                emit({
+                    "row": row,
+                    "id": lid,
+                    "path": str(p),
+                    "title": doc["title"],
+                    "phase": doc["phase"],
+                    "area": doc["area"],
+                    "industries": doc["industries"],
+                    "severity": doc["severity"],
+                    "tags": doc["tags"],
+                    "lesson_type": doc.get("lesson_type", "Other"),
+                    "confidentiality": doc.get("confidentiality", "Internal"),
+                    "rag_text": text
+                })
+        with METRICS.span("build.write_files"):
+            writer.close()
+        # a rewritten lesson gets a new mtime; record it so the next build's fast path holds
+        for lid, fut in written_back.items():
+            if fut.exception() is None and fut.result() is not None:
+                manifest[lid]["mtime_ns"] = fut.result()
+        with METRICS.span("build.embed_drain"):
+            pipeline.close()
+    except BaseException:
+        pipeline.abort()
+        writer.close()
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        raise
+
+    # lessons that disappeared from the data dir
+    stale_rows.extend(e["row"] for lid, e in prev.items() if lid not in manifest)
+
+    if index is not None and not pipeline.count and not stale_rows and manifest == prev:
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        print(f"✅ Store at {out_dir} is up to date ({len(records)} items).")
+        return 0
+
+    METRICS.count("build.files", len(files))
+    METRICS.count("build.embedded", pipeline.count)
+    METRICS.count("build.removed", len(set(stale_rows)))
+    with METRICS.span("build.index_finish"):
+        builder.finish(gen_dir, remove_ids=stale_rows)
+    with METRICS.span("build.write_lexical"):
+        write_lexical(gen_dir)
+    with open(gen_dir / "manifest.json", "w", encoding="utf-8") as f:
+        json.dump({"format": MANIFEST_FORMAT, "model": args.model, "lessons": manifest}, f, ensure_ascii=False, indent=2)
+    with METRICS.span("build.write_bitmaps"):
+        write_bitmaps(gen_dir, [records[row] for row in sorted(records)])
 
     # save metadata
     meta = {
         "created_at": datetime.now(UTC).isoformat(),
-        "num_items": len(texts),
-        "embedder": "sbert",
+        "build_id": build_id,
+        "num_items": len(records),
+        "embedder": args.embedder,
         "model": args.model,
+        **spec,
     }
-    with open(out_dir / "meta.json", "w", encoding="utf-8") as f:
+    with open(gen_dir / "meta.json", "w", encoding="utf-8") as f:
         json.dump(meta, f, ensure_ascii=False, indent=2)
 
-    print(f"✅ Built store at {out_dir} with {len(texts)} items.")
+    with METRICS.span("build.publish"):
+        publish_generation(out_dir, build_id)
+        prune_generations(out_dir, args.keep_generations)
+
+    if args.check_agreement and args.embedder != "sbert":
+        rep = compare_embedders(args.model, sample, onnx_model_dir(out_dir, args.model), threads=args.threads)
+        print(f"🔎 {args.embedder} vs sbert fp32 on {rep['n']} texts: cosine mean={rep['cosine_mean']:.4f} "
+              f"min={rep['cosine_min']:.4f}; {rep['speedup']:.2f}x encode throughput "
+              f"({rep['onnx-int8_texts_per_sec']:.1f} vs {rep['sbert_texts_per_sec']:.1f} texts/s)")
+
+    if args.check_recall:
+        rep = check_recall(gen_dir, builder.index, embedder, n_queries=args.check_recall)
+        size = (gen_dir / "index.faiss").stat().st_size
+        raw = len(records) * rep["dim"] * 4
+        print(f"🔎 recall@{rep['k']} vs exact float32 search: {rep['recall']:.4f} over {rep['queries']} title "
+              f"queries; index.faiss {size / 2**20:.1f} MB vs {raw / 2**20:.1f} MB of float32 vectors "
+              f"({raw / max(size, 1):.1f}x smaller)")
+
+    print(f"✅ Built store at {out_dir} with {len(records)} items "
+          f"({pipeline.count} embedded, {len(set(stale_rows))} removed, {unchanged} unchanged).")
     return 0
 
-def cmd_query(args):
-    import numpy as np
-    try:
+class StoreView:
+    """One store generation loaded in memory: ids/titles/paths, meta and the FAISS index."""
+    def __init__(self, path: Path, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        self.path = path
+        index_path = path / "index.faiss"
+        ids_path = path / "ids.jsonl"
+        if not index_path.exists():
+            raise RuntimeError(f"Missing index at {index_path}. Run build-index first.")
+
+        # load ids + titles + paths; FAISS returns manifest rows (line number on legacy stores)
+        self.ids: List[str] = []
+        self.titles: List[str] = []
+        self.paths: List[str] = []
+        self.row_pos: Dict[int, int] = {}
+        with open(ids_path, "r", encoding="utf-8") as f:
+            for pos, line in enumerate(f):
+                rec = json.loads(line)
+                self.row_pos[int(rec.get("row", pos))] = pos
+                self.ids.append(rec["id"])
+                self.titles.append(rec["title"])
+                self.paths.append(rec["path"])
+
+        self.meta = load_json(path / "meta.json") if (path / "meta.json").exists() else {}
+        with METRICS.span("store.read_index"):
+            self.index = read_store_index(index_path, self.meta)
+        configure_index(self.index, self.meta, nprobe=nprobe, ef_search=ef_search)
+        self.bitmaps = Bitmaps(path) if (path / "bitmaps.json").exists() else None
+        self.lexical = LexicalIndex(path) if (path / "lexical" / "vocab.json").exists() else None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search_params(self, where: List[Tuple[str, str, str]]):
+        """FAISS SearchParameters restricting the search to rows matching `where` (None = no filter)."""
         import faiss
-    except ImportError:
-        raise RuntimeError("Please install faiss-cpu")
+        if not where:
+            return None
+        if self.bitmaps is None:
+            raise RuntimeError(f"Store at {self.path} has no filter bitmaps; rebuild it to use --where.")
+        bitmap = self.bitmaps.select(where)
+        sel = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))  # n is the bitmap's length in bytes
+        return search_params(self.index, self.meta, sel, keepalive=(bitmap,))
+
+    def lexical_mask(self, where: List[Tuple[str, str, str]]):
+        """Bool mask over the lexical index docs matching `where` (None = no filter)."""
+        import numpy as np
+        if not where:
+            return None
+        if self.bitmaps is None:
+            raise RuntimeError(f"Store at {self.path} has no filter bitmaps; rebuild it to use --where.")
+        bits = np.unpackbits(self.bitmaps.select(where), bitorder="little")[:self.bitmaps.nbits]
+        rows = np.asarray(self.lexical.rows)
+        return (rows < len(bits)) & bits[np.minimum(rows, len(bits) - 1)].astype(bool)
+
+class Retriever:
+    """
+    Loads a store once (ids, FAISS index, embedder) so repeated queries only pay
+    for the query embedding + search. Used by `query` and `serve`.
+    Each search hot-swaps to a newly published generation (see CURRENT);
+    searches already running finish on the old one.
+    """
+    def __init__(self, store: Path, model: Optional[str] = None,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 threads: Optional[int] = None):
+        self.store = Path(store)
+        self.index_overrides = {"nprobe": nprobe, "ef_search": ef_search}
+        self.view = StoreView(resolve_store(self.store), **self.index_overrides)
+        # Embed queries with the model + backend the store was built with
+        model = model or self.view.meta.get("model", DEFAULT_MODEL)
+        self.embedder = Embedder(model=model, backend=self.view.meta.get("embedder", "sbert"),
+                                 onnx_dir=onnx_model_dir(self.store, model), threads=threads)
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def reload(self) -> bool:
+        """Switch to the published generation if it changed; returns True when swapped."""
+        path = resolve_store(self.store)
+        if path == self.view.path:
+            return False
+        with self._reload_lock:
+            if path != self.view.path:
+                self.view = StoreView(path, **self.index_overrides)
+                return True
+        return False
+
+    def search(self, q: str, k: int = 5, where: Optional[List[str]] = None,
+               mode: str = "dense") -> Dict[str, Any]:
+        return self.search_many([q], k, where=where, mode=mode)[0]
+
+    def search_many(self, queries: List[str], k: int = 5,
+                    where: Optional[List[str]] = None, mode: str = "dense") -> List[Dict[str, Any]]:
+        """
+        Answer a batch of queries with one encode call and one FAISS search.
+        `where` takes 'field=value' / 'field!=value' filters (see FILTER_FIELDS).
+        mode: dense (embeddings), lexical (BM25 only; never loads the model) or
+        hybrid (both rankings merged with reciprocal-rank fusion).
+        """
+        import faiss
+
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown mode {mode!r}; expected one of {', '.join(SEARCH_MODES)}")
+        self.reload()
+        view = self.view
+        k = max(1, k)
+        if not queries:
+            return []
+        if mode != "dense" and view.lexical is None:
+            raise RuntimeError(f"Store at {view.path} has no lexical index; rebuild it to use --mode {mode}.")
+        filters = parse_where(where)
+        # hybrid fuses two deeper rankings, then keeps k
+        depth = k if mode != "hybrid" else max(k * 4, 20)
+
+        if mode != "lexical":
+            # embed queries (the model is shared across server threads)
+            with self._lock, METRICS.span("query.embed"):
+                xq = self.embedder.embed(list(queries)).astype("float32")
+            faiss.normalize_L2(xq)
+            # search
+            with METRICS.span("query.search"):
+                D, I = view.index.search(xq, depth, params=view.search_params(filters))
+        if mode != "dense":
+            with METRICS.span("query.lexical"):
+                mask = view.lexical_mask(filters)
+                hits = [view.lexical.search(q, depth, allowed=mask) for q in queries]
+        METRICS.count("query.queries", len(queries))
+
+        out = []
+        for qi, q in enumerate(queries):
+            if mode == "dense":
+                ranked = [(int(row), float(dist), {}) for dist, row in zip(D[qi], I[qi]) if row != -1]
+            elif mode == "lexical":
+                rows, scores = hits[qi]
+                ranked = [(int(row), float(score), {}) for row, score in zip(rows, scores)]
+            else:
+                rows, scores = hits[qi]
+                dense_score = {int(r): float(d) for d, r in zip(D[qi], I[qi]) if r != -1}
+                lexical_score = {int(r): float(s) for r, s in zip(rows, scores)}
+                fused, fused_scores = rrf_fuse(I[qi], rows, k)
+                ranked = [(row, score, {"cosine": dense_score.get(row), "bm25": lexical_score.get(row)})
+                          for row, score in zip(fused, fused_scores)]
+            results = []
+            for row, score, extra in ranked[:k]:
+                idx = view.row_pos[row]
+                results.append({
+                    "rank": len(results) + 1,
+                    "id": view.ids[idx],
+                    "title": view.titles[idx],
+                    "path": view.paths[idx],
+                    "score": score,
+                    **extra,
+                })
+            out.append({"query": q, "k": k, "results": results})
+        return out
+
+def run_batch(retriever: "Retriever", path: str, out, k: int, batch_size: int = 256,
+              where: Optional[List[str]] = None, mode: str = "dense") -> int:
+    """Stream JSONL results (one line per query, same payload as --json-response)."""
+    n = 0
+    batch: List[Dict[str, Any]] = []
+
+    def flush():
+        for item, res in zip(batch, retriever.search_many([b["q"] for b in batch], k, where=where, mode=mode)):
+            if "id" in item:
+                res = {"id": item["id"], **res}
+            out.write(json.dumps(res, ensure_ascii=False) + "\n")
+        out.flush()
+        batch.clear()
+
+    for item in iter_batch_queries(path):
+        batch.append(item)
+        n += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return n
+
+def cmd_query(args):
+    with METRICS.span("query.load_store"):
+        retriever = Retriever(Path(args.store), model=args.model, nprobe=args.nprobe, ef_search=args.ef_search,
+                              threads=args.threads)
+
+    if args.batch:
+        run_batch(retriever, args.batch, sys.stdout, args.k, batch_size=args.batch_size, where=args.where,
+                  mode=args.mode)
+        return 0
+
+    res = retriever.search(args.q, args.k, where=args.where, mode=args.mode)
+
+    if args.json_response:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+        return 0
 
-    store = Path(args.store)
-    index_path = store / "index.faiss"
-    ids_path = store / "ids.jsonl"
-    chunks_path = store / "chunks.jsonl"
-    if not index_path.exists():
-        raise RuntimeError(f"Missing index at {index_path}. Run build-index first.")
-
-    # load ids + titles + paths
-    ids: List[str] = []
-    titles: List[str] = []
-    paths: List[str] = []
-    with open(ids_path, "r", encoding="utf-8") as f:
-        for line in f:
-            rec = json.loads(line)
-            ids.append(rec["id"])
-            titles.append(rec["title"])
-            paths.append(rec["path"])
-
-    # embed query
-    embedder = Embedder(model=args.model)
-    xq = embedder.embed([args.q]).astype("float32")
-    faiss.normalize_L2(xq)
-
-    # search
-    index = faiss.read_index(str(index_path))
-    D, I = index.search(xq, args.k)
     print(f"\nTop {args.k} results for: {args.q}\n")
-    for rank, (dist, idx) in enumerate(zip(D[0], I[0]), start=1):
-        if idx == -1:
-            continue
-        print(f"{rank}. {titles[idx]}  (score={float(dist):.4f})")
-        print(f"   id: {ids[idx]}")
-        print(f"   file: {paths[idx]}\n")
+    for r in res["results"]:
+        extra = "".join(f" | {name}={r[name]:.4f}" for name in ("cosine", "bm25") if r.get(name) is not None)
+        print(f"{r['rank']}. {r['title']}  (score={r['score']:.4f}{extra})")
+        print(f"   id: {r['id']}")
+        print(f"   file: {r['path']}\n")
+    return 0
+
+# --- serve ---
+class _QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET  /query?q=...&k=5&where=phase=Kickoff&mode=hybrid
+    POST /query  {"q": "...", "k": 5, "where": ["phase=Kickoff"], "mode": "hybrid"}
+    GET  /health
+    GET  /metrics   Prometheus text format (spans + counters)
+    Responses match `query --json-response`.
+    """
+    retriever: "Retriever" = None  # set by cmd_serve
+    defaults: Dict[str, Any] = {}
+
+    def _send_json(self, code: int, obj: Dict[str, Any]):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, params: Dict[str, Any]):
+        METRICS.count("serve.requests")
+        with METRICS.span("serve.request"):
+            self._answer_inner(params)
+
+    def _answer_inner(self, params: Dict[str, Any]):
+        q = params.get("q")
+        if not q:
+            self._send_json(400, {"error": "missing 'q'"})
+            return
+        try:
+            k = int(params.get("k", self.defaults.get("k", 5)))
+        except (TypeError, ValueError) as e:
+            self._send_json(400, {"error": f"bad parameter: {e}"})
+            return
+        where = params.get("where") or []
+        if isinstance(where, str):
+            where = [where]
+        try:
+            mode = params.get("mode") or self.defaults.get("mode", "dense")
+            self._send_json(200, self.retriever.search(q, k, where=where, mode=mode))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            METRICS.count("serve.errors")
+            self._send_json(500, {"error": str(e)})
+
+    def _send_metrics(self):
+        body = METRICS.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self.retriever.reload()
+            self._send_json(200, {"status": "ok", "num_items": len(self.retriever),
+                                  "build_id": self.retriever.view.meta.get("build_id")})
+        elif url.path == "/query":
+            params: Dict[str, Any] = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            params["where"] = parse_qs(url.query).get("where", [])
+            self._answer(params)
+        elif url.path == "/metrics":
+            self._send_metrics()
+        else:
+            self._send_json(404, {"error": f"unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/query":
+            self._send_json(404, {"error": f"unknown path {url.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON body: {e}"})
+            return
+        if not isinstance(params, dict):
+            self._send_json(400, {"error": "JSON body must be an object"})
+            return
+        self._answer(params)
+
+    def log_message(self, fmt, *args):
+        if self.defaults.get("verbose"):
+            super().log_message(fmt, *args)
+
+def cmd_serve(args):
+    # Long-running: always collect so /metrics has data (spans are a couple of perf_counter calls)
+    METRICS.enabled = True
+    retriever = Retriever(Path(args.store), model=args.model, nprobe=args.nprobe, ef_search=args.ef_search,
+                          threads=args.threads)
+    # warm up so the first real request doesn't pay lazy init costs
+    retriever.search("warm up", 1, mode=args.mode)
+
+    _QueryHandler.retriever = retriever
+    _QueryHandler.defaults = {"k": args.k, "mode": args.mode, "verbose": args.verbose}
+    server = ThreadingHTTPServer((args.host, args.port), _QueryHandler)
+    print(f"✅ Serving {args.store} ({len(retriever)} items) on http://{args.host}:{server.server_port}/query",
+          flush=True)
+    stop = threading.Event()
+    if args.metrics_file:
+        threading.Thread(target=write_metrics_periodically, args=(args.metrics_file, args.metrics_interval, stop),
+                         daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+    return 0
 
 def main():
     p = argparse.ArgumentParser(description="Antifragile Lessons RAG POC")
     sub = p.add_subparsers(dest="cmd", required=True)
 
-    v = sub.add_parser("validate", help="Validate JSON files against the schema")
+    # Instrumentation flags shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--timings", action="store_true", help="Print per-stage timings + counters as JSON to stderr")
+    common.add_argument("--profile", metavar="FILE", default=None, help="Write a cProfile dump of the whole command")
+    common.add_argument("--metrics-file", metavar="PATH", default=None,
+                        help="Write Prometheus text-format metrics to PATH on exit (serve: periodically)")
+
+    v = sub.add_parser("validate", help="Validate JSON files against the schema", parents=[common])
     v.add_argument("--data", required=True, help="Directory with *.json lesson files")
+    v.add_argument("--jobs", type=int, default=1, help="Worker processes (files are validated in parallel)")
     v.add_argument("--schema", help="Path to a schema file (optional; default: embedded)")
     v.set_defaults(func=cmd_validate)
 
-    b = sub.add_parser("build-index", help="Build FAISS index from JSON files")
+    b = sub.add_parser("build-index", help="Build FAISS index from JSON files", parents=[common])
     b.add_argument("--data", required=True, help="Directory with *.json lesson files")
     b.add_argument("--out", required=True, help="Output directory for store")
     b.add_argument("--schema", help="Path to a schema file (optional; default: embedded)")
-    b.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2", help="Embedding model (SBERT)")
+    b.add_argument("--model", default=DEFAULT_MODEL, help="Embedding model (SBERT)")
     b.add_argument("--strict", action="store_true", help="Fail on first validation error")
     b.add_argument("--force-autogen", action="store_true", help="Always regenerate rag from canonical fields.")
+    b.add_argument("--jobs", type=int, default=1, help="Worker processes for loading/normalizing lessons")
+    b.add_argument("--embed-batch-size", type=int, default=256, help="Texts per embedding batch (bounds build memory)")
+    b.add_argument("--queue-size", type=int, default=4, help="Batches buffered between reading and embedding")
     b.add_argument("--write-back", action="store_true", help="Persist auto-generated rag into the source JSONs.")
     b.add_argument("--reset", action="store_true", help="Reset (delete + rebuild) the output folder before building index")
+    b.add_argument("--embedder", choices=EMBEDDER_BACKENDS, default="sbert",
+                   help="sbert = PyTorch fp32; onnx-int8 = quantized ONNX Runtime (exported once into <out>/onnx/)")
+    b.add_argument("--threads", type=int, default=None, help="CPU threads for encoding (default: library default)")
+    b.add_argument("--check-agreement", type=int, default=0, metavar="N",
+                   help="With --embedder onnx-int8: compare N texts against fp32 SBERT (cosine + speedup)")
+    b.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                   help="flat = exact search; ivf / hnsw = approximate, for large corpora (default: flat)")
+    b.add_argument("--vector-dtype", choices=VECTOR_DTYPES, default="float32",
+                   help="flat: store vectors as float32, float16 (2x smaller) or int8 scalar-quantized (4x)")
+    b.add_argument("--pca-dim", type=int, default=None,
+                   help="flat: PCA-reduce vectors to this many dimensions before storing (recorded in meta.json)")
+    b.add_argument("--check-recall", type=int, default=0, metavar="N",
+                   help="After building, report recall@10 of the index vs exact float32 search over N title queries")
+    b.add_argument("--nlist", type=int, default=None, help="IVF: number of cells (default: 4*sqrt(n))")
+    b.add_argument("--nprobe", type=int, default=None, help=f"IVF: cells searched per query, stored in meta.json (default: {INDEX_DEFAULTS['nprobe']})")
+    b.add_argument("--train-size", type=int, default=None, help=f"IVF / int8 / PCA: max training sample (default: {INDEX_DEFAULTS['train_size']})")
+    b.add_argument("--hnsw-m", type=int, default=None, help=f"HNSW: graph degree (default: {INDEX_DEFAULTS['hnsw_m']})")
+    b.add_argument("--ef-search", type=int, default=None, help=f"HNSW: search breadth, stored in meta.json (default: {INDEX_DEFAULTS['ef_search']})")
+    b.add_argument("--keep-generations", type=int, default=3, help="Published store generations to keep on disk")
+    b.add_argument("--embed-cache", default=None,
+                   help="Embedding cache dir shared across stores (default: $ANTIFRAGILE_EMBED_CACHE or ~/.cache/antifragile-tpm/embeddings)")
+    b.add_argument("--embed-cache-max", type=int, default=200_000, help="Max cached vectors per model before LRU eviction")
+    b.add_argument("--no-embed-cache", action="store_true", help="Always re-encode instead of using the embedding cache")
     b.set_defaults(func=cmd_build_index)
 
-    q = sub.add_parser("query", help="Query the store with a natural-language prompt")
+    q = sub.add_parser("query", help="Query the store with a natural-language prompt", parents=[common])
     q.add_argument("--store", required=True, help="Path to store directory created by build-index")
-    q.add_argument("--q", required=True, help="Natural language query")
+    qg = q.add_mutually_exclusive_group(required=True)
+    qg.add_argument("--q", help="Natural language query")
+    qg.add_argument("--batch", help="JSONL file of queries ('-' = stdin); streams one JSON result per line")
+    q.add_argument("--batch-size", type=int, default=256, help="Queries embedded + searched together in --batch mode")
     q.add_argument("-k", type=int, default=5, help="Top-k results")
-    q.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    q.add_argument("--model", default=None, help="Embedding model (default: the one recorded in the store's meta.json)")
+    q.add_argument("--threads", type=int, default=None, help="CPU threads for query encoding")
+    q.add_argument("--nprobe", type=int, default=None, help="IVF stores: override the stored nprobe")
+    q.add_argument("--ef-search", type=int, default=None, help="HNSW stores: override the stored efSearch")
+    q.add_argument("--mode", choices=SEARCH_MODES, default="dense",
+                   help="dense = embeddings; lexical = BM25 only (no model load); hybrid = both, fused by reciprocal rank")
+    q.add_argument("--json-response", action="store_true", help="JSON response with the top-k results")
+    q.add_argument("--where", action="append", default=[], metavar="FIELD=VALUE",
+                   help="Filter on phase/area/industries/severity/lesson_type/confidentiality; repeatable. "
+                        "Same field = OR, different fields = AND, FIELD!=VALUE excludes "
+                        "(e.g. --where phase=Kickoff --where confidentiality!=Restricted)")
     q.set_defaults(func=cmd_query)
 
+    s = sub.add_parser("serve", help="Load the store once and answer queries over local HTTP", parents=[common])
+    s.add_argument("--store", required=True, help="Path to store directory created by build-index")
+    s.add_argument("--model", default=None, help="Embedding model (default: the one recorded in the store's meta.json)")
+    s.add_argument("--threads", type=int, default=None, help="CPU threads for query encoding")
+    s.add_argument("--nprobe", type=int, default=None, help="IVF stores: override the stored nprobe")
+    s.add_argument("--ef-search", type=int, default=None, help="HNSW stores: override the stored efSearch")
+    s.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1)")
+    s.add_argument("--port", type=int, default=8766, help="Port (default: 8766; 0 = pick a free one)")
+    s.add_argument("-k", type=int, default=5, help="Default top-k when a request omits it")
+    s.add_argument("--mode", choices=SEARCH_MODES, default="dense", help="Default search mode when a request omits it")
+    s.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    s.add_argument("--metrics-interval", type=float, default=15.0, help="Seconds between --metrics-file rewrites")
+    s.set_defaults(func=cmd_serve)
+
     args = p.parse_args()
+    profiler = start_instrumentation(args)
     try:
-        rc = args.func(args)
+        with METRICS.span(f"cmd.{args.cmd}"):
+            rc = args.func(args)
     except Exception as e:
         print(f"ERROR: {e}", file=sys.stderr)
         rc = 1
+    finally:
+        finish_instrumentation(args, profiler)
     sys.exit(rc)
 
 if __name__ == "__main__":
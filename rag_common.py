@@ -0,0 +1,1155 @@
+"""
+rag_common.py
+Infrastructure shared by rag.py and rag-ultralight.py (llama_rag_prompt.py uses its metrics).
+
+- Embedding model wrapper, on-disk embedding cache and the background embed pipeline.
+- FAISS index building/loading, store generations and the incremental-build manifest.
+- BM25 lexical index and reciprocal-rank fusion.
+- Parallel file processing and skip-if-unchanged writes into the data dir.
+- Spans/counters instrumentation (--timings / --profile / --metrics-file).
+
+Both scripts import it from their own directory; it has no command line of its own.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sys
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl  # POSIX; elsewhere the embedding cache runs without a cross-process lock
+except ImportError:
+    fcntl = None
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# ---------- utils ----------
+def iter_json_files(root: Path) -> List[Path]:
+    # os.walk instead of rglob + is_file: one directory listing, no stat per file
+    return sorted(Path(d) / n for d, _, names in os.walk(root) for n in names if n.endswith(".json"))
+
+def sha256_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_json(path: Path) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_json(path: Path, obj: Dict[str, Any]):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+
+def compile_validator(schema: Dict[str, Any]):
+    """Build the Draft7Validator once per run (or per worker); None if jsonschema is missing."""
+    try:
+        from jsonschema import Draft7Validator
+    except ImportError:
+        return None
+    return Draft7Validator(schema)
+
+def validate_json(doc: Dict[str, Any], schema: Dict[str, Any], validator=None) -> Tuple[bool, str]:
+    v = validator or compile_validator(schema)
+    if v is None:
+        return False, "jsonschema not installed (pip install jsonschema)"
+    errors = list(v.iter_errors(doc))
+    if not errors:
+        return True, ""
+    errors.sort(key=lambda e: e.path)
+    msgs = []
+    for e in errors:
+        where = "/".join(map(str, e.path))
+        msgs.append(f" - {where or '$'}: {e.message}")
+    return False, "\n".join(msgs)
+
+def as_list(x):
+    if x is None:
+        return []
+    return x if isinstance(x, list) else [x]
+
+# ---------- data dir writes ----------
+def lesson_json_bytes(doc: Dict[str, Any]) -> bytes:
+    """A lesson serialized exactly as --write-back stores it."""
+    return json.dumps(doc, ensure_ascii=False, indent=2).encode("utf-8")
+
+def write_if_changed(path: Path, data: bytes) -> Optional[int]:
+    """
+    Replace `path` with `data` via a temp file + rename, unless it already holds exactly
+    those bytes (compared by SHA-256). Returns the new mtime_ns, or None when skipped.
+    """
+    try:
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                return None
+    except FileNotFoundError:
+        pass
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with contextlib.suppress(FileNotFoundError):
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return path.stat().st_mtime_ns
+
+IO_THREADS = 4
+
+class FileWriter:
+    """
+    build-index's writes into the data dir (--write-back JSON, .rag sidecars), each through
+    write_if_changed on a small thread pool, so reading and embedding never wait on fsync
+    and a rebuild that changes nothing writes nothing.
+    """
+    def __init__(self, threads: int = IO_THREADS):
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="io")
+        self._futures: List[Tuple[Path, Any]] = []
+
+    def submit(self, path: Path, data: bytes):
+        """Queue one write; the future resolves to write_if_changed's result."""
+        fut = self._pool.submit(write_if_changed, path, data)
+        self._futures.append((path, fut))
+        return fut
+
+    def close(self):
+        """Wait for every queued write and report the ones that failed."""
+        self._pool.shutdown(wait=True)
+        written = skipped = 0
+        for path, fut in self._futures:
+            if fut.exception() is not None:
+                print(f"⚠️  Write failed for {path}: {fut.exception()}")
+            elif fut.result() is None:
+                skipped += 1
+            else:
+                written += 1
+        METRICS.count("build.files_written", written)
+        METRICS.count("build.writes_skipped", skipped)
+        self._futures = []
+
+# ---------- instrumentation ----------
+# Lightweight spans + counters. Disabled unless --timings / --profile / --metrics-file is
+# given: span() then hands back one shared no-op context manager and count() returns early.
+class _Span:
+    __slots__ = ("metrics", "name", "t0")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.t0)
+        return False
+
+class Metrics:
+    """Spans + counters; `prefix` names the Prometheus series (each script sets its own)."""
+    def __init__(self, prefix: str = "rag"):
+        self.enabled = False
+        self.prefix = prefix
+        self.spans: Dict[str, List[float]] = {}  # name -> [count, total_s, max_s]
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        return _Span(self, name) if self.enabled else _NO_SPAN
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            s = self.spans.setdefault(name, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += seconds
+            s[2] = max(s[2], seconds)
+
+    def count(self, name: str, n: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "spans": {k: {"count": int(c), "total_ms": round(t * 1000, 3), "max_ms": round(m * 1000, 3)}
+                          for k, (c, t, m) in sorted(self.spans.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self, prefix: Optional[str] = None) -> str:
+        """Prometheus text exposition format (spans as summary-style _count/_sum, plus _max)."""
+        prefix = prefix or self.prefix
+        snap = self.snapshot()
+        lines = [f"# TYPE {prefix}_span_seconds summary"]
+        for name, s in snap["spans"].items():
+            label = f'{{span="{name}"}}'
+            lines.append(f"{prefix}_span_seconds_count{label} {s['count']}")
+            lines.append(f"{prefix}_span_seconds_sum{label} {s['total_ms'] / 1000:.6f}")
+            lines.append(f"{prefix}_span_seconds_max{label} {s['max_ms'] / 1000:.6f}")
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, v in snap["counters"].items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {v}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        # tmp + rename so a scraper (e.g. node_exporter textfile collector) never reads half a file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+_NO_SPAN = contextlib.nullcontext()
+# One instance for the shared code below and the script that imports it
+METRICS = Metrics()
+
+def start_instrumentation(args):
+    """Enable METRICS when any instrumentation flag is set; returns a running cProfile.Profile or None."""
+    METRICS.enabled = bool(args.timings or args.profile or args.metrics_file or METRICS.enabled)
+    if not args.profile:
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_instrumentation(args, profiler):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"✅ Wrote cProfile stats to {args.profile} (inspect with: python -m pstats {args.profile})",
+              file=sys.stderr)
+    if args.metrics_file:
+        METRICS.write_prometheus(args.metrics_file)
+    if args.timings:
+        # stderr, so --json-response / --batch output on stdout stays machine-readable
+        print(json.dumps({"timings": METRICS.snapshot()}, ensure_ascii=False), file=sys.stderr)
+
+def write_metrics_periodically(path: str, interval: float, stop: threading.Event):
+    """`serve --metrics-file`: rewrite the Prometheus file every `interval` seconds until `stop`."""
+    while not stop.wait(interval):
+        try:
+            METRICS.write_prometheus(path)
+        except OSError as e:
+            print(f"⚠️  Could not write metrics file {path}: {e}", file=sys.stderr)
+
+# ---------- embeddings + FAISS index ----------
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by (model, output dimension, sha256 of text), shared by
+    every store. Vectors live in a memory-mapped .npy matrix; keys.json maps text hash ->
+    [slot, last_used]. Once max_items is reached the least recently used slots are recycled.
+
+    Builds running at the same time coordinate through an flock on <dir>/lock: lookups hold
+    it shared, and the first write takes it exclusively until save(), so slot allocation and
+    the keys.json rewrite never interleave (a second build's lookups wait meanwhile).
+    Whoever takes the lock re-reads keys.json if another process has rewritten it.
+    """
+    def __init__(self, root: Path, model: str, max_items: int = 200_000, dtype: str = "float16"):
+        self.root = Path(root)
+        self.model = model
+        self.max_items = max(1, int(max_items))
+        self.dtype = dtype
+        self.dir: Optional[Path] = None
+        self.keys: Dict[str, List[int]] = {}
+        self.tick = 0
+        self.dim: Optional[int] = None
+        self._mat = None
+        self._stamp = None  # (inode, mtime_ns, size) of the keys.json we last read or wrote
+        self._lock_fd: Optional[int] = None
+        self._writing = False
+        self._mu = threading.RLock()
+
+    def bind(self, dim: int):
+        """Select the cache for this model's output dimension (another dimension is another cache)."""
+        if self.dir is None:
+            self.dim = int(dim)
+            self.dir = self.root / f"{self.model.replace('/', '__')}__d{self.dim}"
+        elif int(dim) != self.dim:
+            raise RuntimeError(f"Embedding cache bound to dim {self.dim}, got {dim}")
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool):
+        """Shared/exclusive flock, then pick up whatever another process saved meanwhile."""
+        with self._mu:
+            if self._writing:
+                yield  # already exclusive until save()
+                return
+            self.dir.mkdir(parents=True, exist_ok=True)
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.dir / "lock", os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._refresh(exclusive)
+                if exclusive:
+                    self._writing = True
+                yield
+            finally:
+                if not self._writing and fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _release(self):
+        self._writing = False
+        if fcntl is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _refresh(self, exclusive: bool):
+        keys_path = self.dir / "keys.json"
+        try:
+            st = keys_path.stat()
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp:
+            return
+        mine = self.keys
+        self.keys, self.tick, self._mat, self._stamp = {}, 0, None, stamp
+        if stamp is not None:
+            try:
+                state = load_json(keys_path)
+                if state.get("dtype") == self.dtype and int(state["dim"]) == self.dim:
+                    self.keys = state["keys"]
+                    self.tick = int(state["tick"])
+            except Exception:
+                self.keys = {}
+        # keep our own recency for entries that still sit in the same slot
+        for d, (slot, used) in mine.items():
+            entry = self.keys.get(d)
+            if entry is not None and entry[0] == slot and used > entry[1]:
+                entry[1] = used
+                self.tick = max(self.tick, used)
+        if exclusive and not self.keys and (self.dir / "vectors.npy").exists():
+            os.remove(self.dir / "vectors.npy")  # unreadable/incompatible index -> start cold
+
+    def _open(self, capacity: int = 0):
+        """Map vectors.npy, growing it (copy + swap) when it holds fewer than `capacity` rows."""
+        import numpy as np
+        path = self.dir / "vectors.npy"
+        if self._mat is None and path.exists():
+            self._mat = np.load(path, mmap_mode="r+")
+            if self._mat.shape[1:] != (self.dim,) or self._mat.dtype != np.dtype(self.dtype):
+                self._mat = None  # left by an incompatible writer: replaced below
+        cur = self._mat.shape[0] if self._mat is not None else 0
+        if self._mat is not None and cur >= capacity:
+            return
+        tmp = self.dir / "vectors.npy.tmp"
+        new = np.lib.format.open_memmap(tmp, mode="w+", dtype=self.dtype, shape=(capacity, self.dim))
+        if cur:
+            new[:cur] = self._mat
+        new.flush()
+        del new
+        self._mat = None
+        os.replace(tmp, path)
+        self._mat = np.load(path, mmap_mode="r+")
+
+    def get_many(self, digests: List[str]) -> Dict[str, Any]:
+        import numpy as np
+        hits: Dict[str, Any] = {}
+        with self._locked(exclusive=False):
+            found = [d for d in dict.fromkeys(digests) if d in self.keys]
+            if not found:
+                return hits
+            self._open()
+            for d in found:
+                self.tick += 1
+                entry = self.keys[d]
+                entry[1] = self.tick
+                hits[d] = np.asarray(self._mat[entry[0]], dtype="float32")
+        return hits
+
+    def put_many(self, digests: List[str], vecs, persist: bool = True):
+        """Store new vectors; with persist=False the write lock is held until save()."""
+        if not digests:
+            return
+        if int(vecs.shape[1]) != self.dim:
+            return  # filled by a model with another output size; don't mix
+        digests, vecs = digests[-self.max_items:], vecs[-self.max_items:]
+        with self._locked(exclusive=True):
+            fresh = [d for d in digests if d not in self.keys]
+            # evict least recently used entries to make room
+            overflow = len(self.keys) + len(fresh) - self.max_items
+            if overflow > 0:
+                keep = set(digests)
+                victims = sorted((d for d in self.keys if d not in keep), key=lambda d: self.keys[d][1])
+                for d in victims[:overflow]:
+                    del self.keys[d]
+            need = len(self.keys) + len(fresh)
+            self._open(min(self.max_items, max(1024, 2 * need)) if need > self._rows() else 0)
+            used = {e[0] for e in self.keys.values()}
+            slots = (i for i in range(self._mat.shape[0]) if i not in used)
+            for d, v in zip(digests, vecs):
+                if d not in self.keys:
+                    self.keys[d] = [next(slots), 0]
+                self.tick += 1
+                self.keys[d][1] = self.tick
+                self._mat[self.keys[d][0]] = v
+            self._mat.flush()
+        if persist:
+            self.save()
+
+    def _rows(self) -> int:
+        if self._mat is None and (self.dir / "vectors.npy").exists():
+            self._open()
+        return self._mat.shape[0] if self._mat is not None else 0
+
+    def save(self):
+        """Write keys.json (slots + last_used ticks) and release the write lock."""
+        if self.dir is None:
+            return
+        with self._mu:
+            with self._locked(exclusive=True):
+                tmp = self.dir / "keys.json.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype, "tick": self.tick, "keys": self.keys}, f)
+                os.replace(tmp, self.dir / "keys.json")
+                st = (self.dir / "keys.json").stat()
+                self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self._release()
+
+EMBEDDER_BACKENDS = ("sbert", "onnx-int8")
+# sentence-transformers dynamic quantization preset ("arm64", "avx2", "avx512", "avx512_vnni")
+ONNX_QUANT_CONFIG = os.environ.get("ANTIFRAGILE_ONNX_QUANT", "avx2")
+
+class Embedder:
+    """
+    Text -> vectors. `backend` is "sbert" (PyTorch fp32) or "onnx-int8" (dynamically
+    quantized ONNX Runtime graph, exported once into `onnx_dir` and reused).
+    """
+    def __init__(self, model: str, cache: Optional[EmbeddingCache] = None, backend: str = "sbert",
+                 onnx_dir: Optional[Path] = None, threads: Optional[int] = None):
+        if backend not in EMBEDDER_BACKENDS:
+            raise RuntimeError(f"Unknown embedder {backend!r}; expected one of {', '.join(EMBEDDER_BACKENDS)}")
+        if backend != "sbert" and onnx_dir is None:
+            raise RuntimeError(f"The {backend} embedder needs a directory for its exported model")
+        self.model_name = model
+        self.cache = cache
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.threads = threads
+        self._model = None
+        self._dim: Optional[int] = None
+
+    @property
+    def model(self):
+        # Loaded lazily: queries in --mode lexical never pay for the torch/SBERT import
+        if self._model is None:
+            try:
+                from sentence_transformers import SentenceTransformer  # type: ignore
+            except ImportError:
+                raise RuntimeError("Please install sentence-transformers")
+            with METRICS.span("embed.model_load"):
+                if self.backend == "onnx-int8":
+                    self._model = self._load_onnx_int8(SentenceTransformer)
+                else:
+                    if self.threads:
+                        import torch  # type: ignore
+                        torch.set_num_threads(self.threads)
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def _load_onnx_int8(self, SentenceTransformer):
+        try:
+            import onnxruntime as ort  # type: ignore
+            from sentence_transformers import export_dynamic_quantized_onnx_model  # type: ignore
+        except ImportError:
+            raise RuntimeError("The onnx-int8 embedder needs: pip install 'sentence-transformers[onnx]>=3.2'")
+        file_name = f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+        if not (self.onnx_dir / file_name).exists():
+            # one-time export: fp32 ONNX graph, then dynamic int8 quantization next to it
+            print(f"⏳ Exporting {self.model_name} to ONNX int8 in {self.onnx_dir} (one time)…", file=sys.stderr)
+            fp32 = SentenceTransformer(self.model_name, backend="onnx")
+            fp32.save_pretrained(str(self.onnx_dir))
+            export_dynamic_quantized_onnx_model(fp32, ONNX_QUANT_CONFIG, str(self.onnx_dir))
+        opts = ort.SessionOptions()
+        if self.threads:
+            opts.intra_op_num_threads = self.threads
+        return SentenceTransformer(str(self.onnx_dir), backend="onnx", model_kwargs={
+            "file_name": file_name,
+            "provider": "CPUExecutionProvider",
+            "session_options": opts,
+        })
+
+    @property
+    def dim(self) -> int:
+        """Output dimension of the loaded model (part of the embedding cache key)."""
+        if self._dim is None:
+            self._dim = self.model.get_sentence_embedding_dimension() or len(self._encode([""])[0])
+        return self._dim
+
+    def _encode(self, texts: List[str]):
+        model = self.model  # the lazy load is timed separately
+        METRICS.count("embed.texts_encoded", len(texts))
+        with METRICS.span("embed.encode"):
+            return model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+
+    def embed(self, texts: List[str], persist: bool = True):
+        """Vectors for `texts`; with persist=False the caller saves the cache (once) itself."""
+        if self.cache is None:
+            return self._encode(texts)
+        import numpy as np
+        self.cache.bind(self.dim)
+        digests = [sha256_text(t) for t in texts]
+        found = self.cache.get_many(digests)
+        METRICS.count("embed.cache_hits", len(found))
+        missing = {d: t for d, t in zip(digests, texts) if d not in found}
+        if missing:
+            vecs = self._encode(list(missing.values()))
+            self.cache.put_many(list(missing), vecs, persist=persist)
+            found.update(zip(missing, vecs))
+        elif persist:
+            self.cache.save()  # persist last_used ticks for LRU
+        return np.stack([np.asarray(found[d], dtype="float32") for d in digests])
+
+def embed_cache_key(model: str, backend: str) -> str:
+    # quantized vectors differ slightly from fp32 ones; never mix them in one cache
+    return model if backend == "sbert" else f"{model}@{backend}"
+
+def onnx_model_dir(store: Path, model: str) -> Path:
+    """Where a store keeps its exported ONNX model (shared by all generations)."""
+    return store / "onnx" / model.replace("/", "__")
+
+def compare_embedders(model: str, texts: List[str], onnx_dir: Path, threads: Optional[int] = None) -> Dict[str, float]:
+    """Encode `texts` with fp32 SBERT and onnx-int8; report cosine agreement and throughput."""
+    import time
+    import numpy as np
+    out: Dict[str, float] = {"n": len(texts)}
+    vecs = {}
+    for backend in ("sbert", "onnx-int8"):
+        emb = Embedder(model, backend=backend, onnx_dir=onnx_dir, threads=threads)
+        emb.model  # load outside the timed section
+        t0 = time.perf_counter()
+        v = emb.embed(texts).astype("float32")
+        out[f"{backend}_texts_per_sec"] = len(texts) / max(time.perf_counter() - t0, 1e-9)
+        vecs[backend] = v / np.maximum(np.linalg.norm(v, axis=1, keepdims=True), 1e-12)
+    cos = np.sum(vecs["sbert"] * vecs["onnx-int8"], axis=1)
+    out.update(cosine_mean=float(cos.mean()), cosine_min=float(cos.min()),
+               speedup=out["onnx-int8_texts_per_sec"] / max(out["sbert_texts_per_sec"], 1e-9))
+    return out
+
+def default_embed_cache_dir() -> Path:
+    env = os.environ.get("ANTIFRAGILE_EMBED_CACHE")
+    return Path(env) if env else Path.home() / ".cache" / "antifragile-tpm" / "embeddings"
+
+# Index types: flat = exact inner product (fine up to ~10^5 rows), ivf = inverted lists
+# over k-means cells (trained on a sample; `nprobe` cells searched), hnsw = graph search
+# (`efSearch` candidates explored). All are keyed by manifest row ids.
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+INDEX_DEFAULTS = {"nprobe": 8, "ef_search": 64, "hnsw_m": 32, "train_size": 100_000}
+
+# Flat indexes can store compressed vectors: float16 (2x smaller) or int8 (4x; per-dimension
+# ranges trained on a sample) via faiss' scalar quantizer, optionally after a PCA projection
+# to --pca-dim. Flat stores are loaded with IO_FLAG_MMAP_IFC, so the vector codes are searched
+# straight from the page cache and shared by every process serving the same generation.
+VECTOR_DTYPES = ("float32", "float16", "int8")
+
+def index_spec(args) -> Dict[str, Any]:
+    """Index settings from build-index args (recorded in meta.json)."""
+    spec = {"index_type": getattr(args, "index_type", "flat") or "flat"}
+    dtype = getattr(args, "vector_dtype", None) or "float32"
+    pca_dim = getattr(args, "pca_dim", None)
+    if spec["index_type"] == "flat":
+        spec["vector_dtype"] = dtype
+        if pca_dim:
+            spec["pca_dim"] = int(pca_dim)
+        if dtype == "int8" or pca_dim:
+            spec["train_size"] = getattr(args, "train_size", None) or INDEX_DEFAULTS["train_size"]
+    elif dtype != "float32" or pca_dim:
+        raise ValueError("--vector-dtype / --pca-dim apply to --index-type flat only")
+    if spec["index_type"] == "ivf":
+        spec["nlist"] = getattr(args, "nlist", None)
+        spec["nprobe"] = getattr(args, "nprobe", None) or INDEX_DEFAULTS["nprobe"]
+        spec["train_size"] = getattr(args, "train_size", None) or INDEX_DEFAULTS["train_size"]
+    elif spec["index_type"] == "hnsw":
+        spec["hnsw_m"] = getattr(args, "hnsw_m", None) or INDEX_DEFAULTS["hnsw_m"]
+        spec["ef_search"] = getattr(args, "ef_search", None) or INDEX_DEFAULTS["ef_search"]
+    return spec
+
+def spec_matches(spec: Dict[str, Any], meta: Dict[str, Any]) -> bool:
+    """Can an index described by `meta` be updated in place under `spec`?"""
+    if meta.get("index_type", "flat") != spec["index_type"]:
+        return False
+    if spec["index_type"] == "ivf" and spec.get("nlist") and spec["nlist"] != meta.get("nlist"):
+        return False
+    if spec["index_type"] == "hnsw" and spec["hnsw_m"] != meta.get("hnsw_m"):
+        return False
+    if spec["index_type"] == "flat" and (spec.get("vector_dtype", "float32") != meta.get("vector_dtype", "float32")
+                                         or spec.get("pca_dim") != meta.get("pca_dim")):
+        return False
+    return True
+
+def needs_training(spec: Dict[str, Any]) -> bool:
+    return spec["index_type"] == "ivf" or spec.get("vector_dtype") == "int8" or bool(spec.get("pca_dim"))
+
+def read_store_index(path: Path, meta: Dict[str, Any]):
+    """Load a published index for searching: flat stores are memory-mapped (zero-copy, shared pages)."""
+    import faiss  # type: ignore
+    flags = 0
+    if meta.get("index_type", "flat") == "flat":
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)  # faiss >= 1.9
+    return faiss.read_index(str(path), flags)
+
+def new_faiss_index(vecs, spec: Dict[str, Any], expected: int = 0):
+    """
+    Empty index for `spec`; IVF / int8 / PCA indexes are trained here on a sample of `vecs`.
+    `expected` is the total number of vectors the index will hold (default: len(vecs)).
+    """
+    import faiss  # type: ignore
+    import numpy as np
+    d = vecs.shape[1]
+    kind = spec["index_type"]
+    if kind == "ivf":
+        n = len(vecs)
+        # default nlist ~ 4*sqrt(total), capped so each cell gets ~39 training points
+        nlist = spec.get("nlist") or min(int(4 * np.sqrt(max(n, expected))), n // 39)
+        nlist = max(1, min(nlist, n))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, nlist, faiss.METRIC_INNER_PRODUCT)
+        sample = vecs
+        if n > spec["train_size"]:
+            sample = vecs[np.random.default_rng(0).choice(n, spec["train_size"], replace=False)]
+        index.train(sample)
+        # hashtable direct map: lets remove_ids/reconstruct work on arbitrary row ids
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        spec["nlist"] = nlist
+        return index
+    if kind == "hnsw":
+        return faiss.IndexIDMap2(faiss.IndexHNSWFlat(d, spec["hnsw_m"], faiss.METRIC_INNER_PRODUCT))
+    dtype, pca_dim = spec.get("vector_dtype", "float32"), spec.get("pca_dim")
+    if dtype == "float32" and not pca_dim:
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    dim = min(int(pca_dim), d) if pca_dim else d
+    if dtype == "float32":
+        base = faiss.IndexFlatIP(dim)
+    else:
+        qtype = faiss.ScalarQuantizer.QT_fp16 if dtype == "float16" else faiss.ScalarQuantizer.QT_8bit
+        base = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+    pca = None
+    if pca_dim:
+        pca = faiss.PCAMatrix(d, dim)
+        base = faiss.IndexPreTransform(pca, base)
+    index = faiss.IndexIDMap2(base)
+    if not index.is_trained:
+        sample = vecs
+        if len(vecs) > spec["train_size"]:
+            sample = vecs[np.random.default_rng(0).choice(len(vecs), spec["train_size"], replace=False)]
+        index.train(sample)
+    if pca is not None:
+        # Project without centering: inner products in the reduced space then approximate
+        # the original cosine scores instead of covariances around the corpus mean.
+        faiss.copy_array_to_vector(np.zeros(dim, dtype="float32"), pca.b)
+    return index
+
+def index_vectors(index):
+    """All (row ids, float32 vectors) stored in an index built by build_faiss_index."""
+    import faiss  # type: ignore
+    import numpy as np
+    if isinstance(index, faiss.IndexIDMap2):
+        ids = faiss.vector_to_array(index.id_map).astype("int64")
+        vecs = index.index.reconstruct_n(0, index.ntotal) if index.ntotal else None
+        return ids, vecs
+    ivf = faiss.extract_index_ivf(index)
+    invlists = ivf.invlists
+    ids = np.concatenate([faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+                          for l in range(ivf.nlist)] or [np.zeros(0, dtype="int64")]).astype("int64")
+    vecs = index.reconstruct_batch(ids) if len(ids) else None
+    return ids, vecs
+
+def configure_index(index, meta: Dict[str, Any], nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Apply stored (or overridden) search knobs to a freshly loaded index."""
+    import faiss  # type: ignore
+    kind = meta.get("index_type", "flat")
+    if kind == "ivf":
+        faiss.extract_index_ivf(index).nprobe = nprobe or meta.get("nprobe", INDEX_DEFAULTS["nprobe"])
+    elif kind == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efSearch = ef_search or meta.get("ef_search", INDEX_DEFAULTS["ef_search"])
+
+def search_params(index, meta: Dict[str, Any], sel, keepalive=()):
+    """
+    FAISS SearchParameters that restrict a search of `index` to ids accepted by `sel`.
+    IVF/HNSW reject plain SearchParameters, so their search knobs are carried along;
+    `keepalive` holds buffers the selector only borrows (e.g. a bitmap).
+    """
+    import faiss  # type: ignore
+    kind = meta.get("index_type", "flat")
+    if kind == "ivf":
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=faiss.extract_index_ivf(index).nprobe)
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=faiss.downcast_index(index.index).hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    params._keepalive = (sel, *keepalive)
+    return params
+
+class IndexBuilder:
+    """
+    Streams (row ids, vectors) batches into a FAISS index keyed by manifest rows, so a
+    build never holds the whole embedding matrix. A new IVF / int8 / PCA index buffers the
+    first `train_size` vectors to train on, then adds the rest as they arrive.
+    """
+    def __init__(self, spec: Dict[str, Any], index=None, expected: int = 0):
+        self.spec = spec
+        self.index = index
+        self.expected = expected
+        self._pending: List[Tuple[Any, Any]] = []  # until trained (see needs_training)
+        self._buffered = 0
+
+    def add(self, vectors, ids):
+        import faiss  # type: ignore
+        import numpy as np
+        vecs = np.array(vectors, dtype="float32")
+        faiss.normalize_L2(vecs)
+        ids = np.asarray(list(ids), dtype="int64")
+        if self.index is None and needs_training(self.spec):
+            self._pending.append((vecs, ids))
+            self._buffered += len(vecs)
+            if self._buffered >= self.spec["train_size"]:
+                self._train()
+            return
+        if self.index is None:
+            self.index = new_faiss_index(vecs, self.spec)
+        self.index.add_with_ids(vecs, ids)
+
+    def _train(self):
+        import numpy as np
+        vecs = np.vstack([v for v, _ in self._pending])
+        ids = np.concatenate([i for _, i in self._pending])
+        self._pending, self._buffered = [], 0
+        self.index = new_faiss_index(vecs, self.spec, expected=self.expected)
+        self.index.add_with_ids(vecs, ids)
+
+    def finish(self, out_dir: Path, remove_ids=None):
+        """
+        Drop `remove_ids` and write index.faiss to out_dir
+        (HNSW graphs can't delete, so those are rebuilt from their surviving vectors).
+        """
+        import faiss  # type: ignore
+        import numpy as np
+        if self._pending:
+            self._train()
+        if self.index is None:
+            raise RuntimeError("Nothing to index: no vectors were added")
+        spec = self.spec
+        if remove_ids:
+            drop = np.asarray(remove_ids, dtype="int64")
+            if spec["index_type"] == "hnsw":
+                old_ids, old_vecs = index_vectors(self.index)
+                keep = ~np.isin(old_ids, drop)
+                self.index = faiss.IndexIDMap2(faiss.IndexHNSWFlat(self.index.d, spec["hnsw_m"], faiss.METRIC_INNER_PRODUCT))
+                if keep.any():
+                    self.index.add_with_ids(old_vecs[keep], old_ids[keep])
+            else:
+                self.index.remove_ids(drop)
+        if spec["index_type"] == "ivf":
+            spec["nlist"] = faiss.extract_index_ivf(self.index).nlist
+        faiss.write_index(self.index, str(out_dir / "index.faiss"))
+        return self.index
+
+def build_faiss_index(vectors, out_dir: Path, ids=None, index=None, remove_ids=None,
+                      spec: Optional[Dict[str, Any]] = None):
+    """
+    Build (or update in place) a FAISS index keyed by manifest row ids and write it to out_dir.
+    `ids` are the stable row ids recorded in the manifest (default: 0..n-1).
+    Pass an existing `index` plus `remove_ids` to drop stale rows instead of rebuilding.
+    """
+    spec = spec if spec is not None else {"index_type": "flat"}
+    n = len(vectors) if vectors is not None else 0
+    builder = IndexBuilder(spec, index=index, expected=n)
+    if n:
+        start = index.ntotal if index is not None else 0
+        builder.add(vectors, ids if ids is not None else range(start, start + n))
+    return builder.finish(out_dir, remove_ids)
+
+def check_recall(store_dir: Path, index, embedder: "Embedder", n_queries: int = 100, k: int = 10,
+                 batch_size: int = 1024) -> Dict[str, Any]:
+    """
+    recall@k of `index` against exact float32 search over the same lessons. Queries are
+    sampled lesson titles; exact scores come from re-embedding every chunk text in batches
+    (embedding-cache hits right after a build), so memory stays bounded by one batch.
+    """
+    import faiss  # type: ignore
+    import numpy as np
+    titles = []
+    with open(store_dir / "chunks.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            title = json.loads(line).get("title")
+            if title:
+                titles.append(title)
+    pick = np.random.default_rng(0).choice(len(titles), min(n_queries, len(titles)), replace=False)
+    xq = np.array(embedder.embed([titles[i] for i in pick]), dtype="float32")
+    faiss.normalize_L2(xq)
+    k = max(1, min(k, index.ntotal))
+
+    best_s = np.full((len(xq), k), -np.inf, dtype="float32")
+    best_i = np.full((len(xq), k), -1, dtype="int64")
+
+    def merge(rows: List[int], texts: List[str]):
+        nonlocal best_s, best_i
+        vecs = np.array(embedder.embed(texts, persist=False), dtype="float32")
+        faiss.normalize_L2(vecs)
+        s = np.hstack([best_s, xq @ vecs.T])
+        i = np.hstack([best_i, np.broadcast_to(np.asarray(rows, dtype="int64"), (len(xq), len(rows)))])
+        top = np.argpartition(-s, k - 1, axis=1)[:, :k]
+        best_s, best_i = np.take_along_axis(s, top, axis=1), np.take_along_axis(i, top, axis=1)
+
+    rows: List[int] = []
+    texts: List[str] = []
+    with open(store_dir / "chunks.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            rows.append(int(rec["row"]))
+            texts.append(rec["rag_text"])
+            if len(texts) >= batch_size:
+                merge(rows, texts)
+                rows, texts = [], []
+    if texts:
+        merge(rows, texts)
+    if embedder.cache is not None:
+        embedder.cache.save()
+
+    _, got = index.search(xq, k)
+    recall = float(np.mean([len(set(g.tolist()) & set(r[r >= 0].tolist())) / k for g, r in zip(best_i, got)]))
+    return {"recall": recall, "k": k, "queries": len(xq), "dim": int(xq.shape[1])}
+
+class EmbedPipeline:
+    """
+    Background stage of build-index: (row, text) pairs are batched into a bounded queue
+    that a worker thread embeds and feeds to an IndexBuilder. Reading and validating the
+    next lessons overlaps with encoding, and at most `queue_size` batches wait in memory
+    (a full queue blocks the producer).
+    """
+    def __init__(self, embedder: "Embedder", builder: IndexBuilder, batch_size: int = 256, queue_size: int = 4):
+        import queue
+        self.embedder = embedder
+        self.builder = builder
+        self.batch_size = max(1, batch_size)
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+        self.count = 0
+        self.error: Optional[BaseException] = None
+        self._rows: List[int] = []
+        self._texts: List[str] = []
+        self._thread = threading.Thread(target=self._run, name="embed", daemon=True)
+        self._thread.start()
+
+    def put(self, row: int, text: str):
+        self._rows.append(row)
+        self._texts.append(text)
+        self.count += 1
+        if len(self._texts) >= self.batch_size:
+            self._send()
+
+    def _send(self):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((self._rows, self._texts))
+        self._rows, self._texts = [], []
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue  # keep draining so the producer never blocks
+            try:
+                rows, texts = batch
+                with METRICS.span("build.embed_batch"):
+                    vecs = self.embedder.embed(texts, persist=False)
+                with METRICS.span("build.index_add"):
+                    self.builder.add(vecs, rows)
+            except BaseException as e:
+                self.error = e
+
+    def close(self):
+        """Flush the last partial batch, wait for the worker and persist the embedding cache."""
+        if self._texts and self.error is None:
+            self._send()
+        self.queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.count and self.embedder.cache is not None:
+            self.embedder.cache.save()
+
+    def abort(self):
+        self._rows, self._texts = [], []
+        self.queue.put(None)
+        self._thread.join()
+
+# Bump when chunk records gain fields, so the next build re-reads every lesson
+MANIFEST_FORMAT = 2
+
+def load_manifest(store: Path) -> Dict[str, Dict[str, Any]]:
+    """lesson id -> {path, mtime_ns, sha256, row}; empty when missing or from an older format."""
+    path = store / "manifest.json"
+    if not path.exists():
+        return {}
+    manifest = load_json(path)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return {}
+    return manifest.get("lessons", {})
+
+def unchanged_files(files: List[Path], prev_by_path: Dict[str, Tuple[str, Dict[str, Any]]],
+                    prev_chunks: Dict[int, Dict[str, Any]], read_all: bool = False) -> set:
+    """
+    Files build-index can carry over from the previous generation without reading them:
+    same mtime as in the manifest, a chunk to reuse and a .rag sidecar on disk. read_all
+    (--write-back, rag.py --force-autogen) reads every file, so each normalized JSON is checked
+    and rewritten when it differs.
+    """
+    fresh = set()
+    if read_all:
+        return fresh
+    for p in files:
+        hit = prev_by_path.get(str(p))
+        if (hit and hit[1].get("mtime_ns") == p.stat().st_mtime_ns and hit[1]["row"] in prev_chunks
+                and p.with_suffix(".rag").exists()):
+            fresh.add(p)
+    return fresh
+
+def load_chunks(store: Path) -> Dict[int, Dict[str, Any]]:
+    """Vector row -> chunk record from a previous build."""
+    out: Dict[int, Dict[str, Any]] = {}
+    path = store / "chunks.jsonl"
+    if not path.exists():
+        return out
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if "row" in rec:
+                out[int(rec["row"])] = rec
+    return out
+
+# ---------- lexical index (BM25) ----------
+# BM25 over rag_text + tags, built from chunks.jsonl at index time and memory-mapped at
+# query time, so `--mode lexical` never loads the embedding model:
+#   vocab.json (term -> id + corpus stats), offsets.npy (postings start per term id),
+#   postings_doc.npy (int32 doc positions), postings_tf.npy (uint16 term freqs),
+#   docs.npy (int64 FAISS rows, sorted), doc_len.npy (int32 tokens per doc)
+SEARCH_MODES = ("dense", "lexical", "hybrid")
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # reciprocal-rank fusion damping: score = sum 1 / (RRF_K + rank)
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+def write_lexical(out_dir: Path, term_cache: Optional[Dict[Tuple[int, str], Any]] = None):
+    """
+    Build out_dir/lexical/ from the chunks.jsonl already written to out_dir.
+    term_cache (build-index --watch) keeps each doc's term counts between builds: a row's
+    text never changes, so only new rows (or re-tagged ones) are tokenized again.
+    """
+    import numpy as np
+    from collections import Counter
+    docs: List[Tuple[int, Counter]] = []
+    seen: Dict[Tuple[int, str], Counter] = {}
+    with open(out_dir / "chunks.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            tags = " ".join(map(str, as_list(rec.get("tags"))))
+            key = (int(rec["row"]), tags)
+            tf = term_cache.get(key) if term_cache is not None else None
+            if tf is None:
+                tf = Counter(tokenize(rec.get("rag_text", "")) + tokenize(tags))
+            docs.append((key[0], tf))
+            seen[key] = tf
+    if term_cache is not None:
+        term_cache.clear()
+        term_cache.update(seen)
+    docs.sort(key=lambda d: d[0])
+    # Postings grouped by term id, docs ascending within a term: one stable argsort
+    # over every (doc, term, tf) triple instead of per-term Python lists
+    counts = np.fromiter((len(tf) for _, tf in docs), dtype="int64", count=len(docs))
+    flat_terms = [t for _, tf in docs for t in tf]
+    terms = sorted(set(flat_terms))
+    term_id = {t: i for i, t in enumerate(terms)}
+    total = len(flat_terms)
+    ids = np.fromiter((term_id[t] for t in flat_terms), dtype="int64", count=total)
+    order = np.argsort(ids, kind="stable")
+    postings_doc = np.repeat(np.arange(len(docs), dtype="int32"), counts)[order]
+    postings_tf = np.fromiter((n for _, tf in docs for n in tf.values()), dtype="int64", count=total)[order]
+    offsets = np.zeros(len(terms) + 1, dtype="int64")
+    np.cumsum(np.bincount(ids, minlength=len(terms)), out=offsets[1:])
+    doc_len = np.asarray([sum(tf.values()) for _, tf in docs], dtype="int32")
+
+    lex_dir = out_dir / "lexical"
+    lex_dir.mkdir(parents=True, exist_ok=True)
+    np.save(lex_dir / "docs.npy", np.asarray([row for row, _ in docs], dtype="int64"))
+    np.save(lex_dir / "doc_len.npy", doc_len)
+    np.save(lex_dir / "offsets.npy", offsets)
+    np.save(lex_dir / "postings_doc.npy", postings_doc)
+    np.save(lex_dir / "postings_tf.npy", np.minimum(postings_tf, 65535).astype("uint16"))
+    save_json(lex_dir / "vocab.json", {"num_docs": len(docs), "avgdl": float(doc_len.mean()) if len(docs) else 0.0,
+                                          "k1": BM25_K1, "b": BM25_B, "terms": term_id})
+
+class LexicalIndex:
+    """BM25 scorer over a store generation's lexical/ postings (memory-mapped)."""
+    def __init__(self, path: Path):
+        import numpy as np
+        lex_dir = path / "lexical"
+        info = load_json(lex_dir / "vocab.json")
+        self.terms: Dict[str, int] = info["terms"]
+        self.k1 = float(info.get("k1", BM25_K1))
+        self.b = float(info.get("b", BM25_B))
+        self.rows = np.load(lex_dir / "docs.npy", mmap_mode="r")
+        self.offsets = np.load(lex_dir / "offsets.npy", mmap_mode="r")
+        self.postings_doc = np.load(lex_dir / "postings_doc.npy", mmap_mode="r")
+        self.postings_tf = np.load(lex_dir / "postings_tf.npy", mmap_mode="r")
+        # BM25 length normalization per doc, computed once per load
+        doc_len = np.asarray(np.load(lex_dir / "doc_len.npy"), dtype="float32")
+        avgdl = float(info.get("avgdl") or 1.0)
+        self.norm = self.k1 * (1.0 - self.b + self.b * doc_len / avgdl)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def search(self, query: str, n: int, allowed=None):
+        """Top-n (FAISS rows, BM25 scores) for `query`; `allowed` is an optional bool mask over docs."""
+        import numpy as np
+        N = len(self.rows)
+        scores = np.zeros(N, dtype="float32")
+        for term in set(tokenize(query)):
+            t = self.terms.get(term)
+            if t is None:
+                continue
+            lo, hi = int(self.offsets[t]), int(self.offsets[t + 1])
+            docs = self.postings_doc[lo:hi]
+            tf = self.postings_tf[lo:hi].astype("float32")
+            df = hi - lo
+            idf = np.log(1.0 + (N - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tf * (self.k1 + 1.0) / (tf + self.norm[docs])
+        if allowed is not None:
+            scores[~allowed] = 0.0
+        hits = np.flatnonzero(scores > 0)
+        top = hits[np.argsort(-scores[hits], kind="stable")[:n]]
+        return np.asarray(self.rows[top], dtype="int64"), scores[top]
+
+def rrf_fuse(dense_rows, lexical_rows, n: int):
+    """
+    Reciprocal-rank fusion of two ranked row lists (-1 = empty slot).
+    Returns the top-n (rows, fused scores) as lists.
+    """
+    fused: Dict[int, float] = {}
+    for ranked in (dense_rows, lexical_rows):
+        rank = 0
+        for row in ranked:
+            if row == -1:
+                continue
+            rank += 1
+            fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (RRF_K + rank)
+    top = sorted(fused.items(), key=lambda kv: -kv[1])[:n]
+    return [r for r, _ in top], [s for _, s in top]
+
+# ---------- store generations ----------
+# Each build writes a complete store into generations/<build_id>/ and then flips the
+# one-line CURRENT pointer with an atomic rename, so readers never see a half-written store.
+STORE_ARTIFACTS = ("index.faiss", "chunks.jsonl", "ids.jsonl", "manifest.json", "meta.json")
+
+def resolve_store(store: Path) -> Path:
+    """Directory holding the published generation (legacy flat stores resolve to themselves)."""
+    current = store / "CURRENT"
+    if current.exists():
+        name = current.read_text(encoding="utf-8").strip()
+        if name:
+            return store / "generations" / name
+    return store
+
+def new_build_id() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+def publish_generation(store: Path, build_id: str):
+    tmp = store / f"CURRENT.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(build_id + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, store / "CURRENT")
+    # artifacts from a pre-generation (flat) store are now shadowed; drop them
+    for name in STORE_ARTIFACTS:
+        if (store / name).is_file():
+            (store / name).unlink()
+
+def prune_generations(store: Path, keep: int):
+    """Delete all but the newest `keep` generations (never the published one)."""
+    gens_dir = store / "generations"
+    if not gens_dir.is_dir():
+        return
+    current = resolve_store(store)
+    gens = sorted(p for p in gens_dir.iterdir() if p.is_dir())
+    for g in gens[:-max(1, keep)]:
+        if g != current:
+            shutil.rmtree(g, ignore_errors=True)
+
+# ---------- parallel file processing ----------
+# Per-process validator, compiled once by the pool initializer (or in-process for --jobs 1)
+_VALIDATOR = None
+_SCHEMA: Dict[str, Any] = {}
+
+def _init_worker(schema: Dict[str, Any]):
+    global _VALIDATOR, _SCHEMA
+    _SCHEMA = schema
+    _VALIDATOR = compile_validator(schema)
+
+def map_files(fn, files: List[Path], jobs: int, schema: Dict[str, Any]) -> Iterator[Any]:
+    """
+    Apply `fn` to every file, fanned out over `jobs` processes.
+    Results come back in input order, so output stays deterministic.
+    """
+    if jobs <= 1 or len(files) < 2:
+        _init_worker(schema)
+        yield from map(fn, files)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(schema,))
+    try:
+        yield from pool.map(fn, files, chunksize=max(1, min(64, len(files) // (jobs * 4))))
+    finally:
+        # an early return (strict mode) must not wait for the rest of the tree
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def validate_in_worker(doc: Dict[str, Any]) -> Tuple[bool, str]:
+    """validate_json against the schema map_files was given, with this process's validator."""
+    return validate_json(doc, _SCHEMA, _VALIDATOR)
+
+def check_file(p: Path) -> Tuple[bool, str]:
+    return validate_in_worker(load_json(p))
+
+# ---------- batch queries ----------
+def iter_batch_queries(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yield {"q": ..., (optional) "id": ...} from a JSONL file ('-' = stdin).
+    Lines may be objects with "q"/"query"/"question" or bare JSON strings.
+    """
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            if isinstance(obj, str):
+                obj = {"q": obj}
+            if not isinstance(obj, dict):
+                obj = {}
+            q = obj.get("q") or obj.get("query") or obj.get("question")
+            if not q:
+                raise ValueError(f"{path}:{n}: expected a string or an object with 'q'")
+            item = {"q": q}
+            if "id" in obj:
+                item["id"] = obj["id"]
+            yield item
+    finally:
+        if f is not sys.stdin:
+            f.close()
@@ -0,0 +1,35 @@
+"""Shared helpers: the scripts under test live in the repo root and are driven as CLIs."""
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def run_script(script: str, *args: str) -> subprocess.CompletedProcess:
+    """Runs `python3 <script> <args>` from the repo root; fails the test on a non-zero exit."""
+    proc = subprocess.run([sys.executable, str(ROOT / script), *map(str, args)],
+                          cwd=ROOT, capture_output=True, text=True, timeout=300)
+    assert proc.returncode == 0, f"{script} {' '.join(map(str, args))} failed:\n{proc.stdout}\n{proc.stderr}"
+    return proc
+
+
+def query_json(script: str, store: Path, q: str, *args: str) -> Dict[str, Any]:
+    return json.loads(run_script(script, "query", "--store", store, "--q", q, "--json-response", *args).stdout)
+
+
+def write_lesson(path: Path, doc: Dict[str, Any]):
+    path.write_text(json.dumps(doc, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+@pytest.fixture(scope="session")
+def needs_embedder():
+    """Building a store always embeds, so these tests need the real model stack."""
+    pytest.importorskip("faiss")
+    pytest.importorskip("numpy")
+    pytest.importorskip("sentence_transformers")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Tiny stand-in for llama.cpp's `llama-server` (OpenAI-compatible chat endpoint), so the
+llama_rag_prompt.py server backend can be exercised without a GGUF model.
+
+It answers with one "Do not ..." bullet per CONTEXT item instead of generating text.
+
+Usage:
+  python3 tests/llama_stub_server.py --port 8080 --delay 0.05
+  python3 llama_rag_prompt.py -q "Kickoff for a biotech client" --llama-url http://127.0.0.1:8080
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+CONTEXT_RE = re.compile(r"CONTEXT_START\s*(.*?)\s*CONTEXT_END", re.S)
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")  # crude stand-in for the model's tokenizer
+
+
+def fake_answer(messages: List[Dict[str, Any]]) -> str:
+    user = "\n".join(m.get("content", "") for m in messages if m.get("role") == "user")
+    m = CONTEXT_RE.search(user)
+    try:
+        items = json.loads(m.group(1)).get("results", []) if m else []
+    except ValueError:
+        items = []
+    bullets = []
+    for r in items[:5]:
+        text = str(r.get("do_not", "")).strip().rstrip(".")
+        text = re.sub(r"(?i)^do not\s+", "", text) or "skip the lessons learned"
+        bullets.append(f"Do not {text[0].lower()}{text[1:]} — impact {r.get('impact', '?')} risk to the project")
+    return "\n".join(bullets) or "Do not proceed without context — the answer would be a guess"
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like llama-server
+    delay = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def _send_json(self, code: int, obj: Dict[str, Any]):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "requests": _StubHandler.requests})
+        elif self.path == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON body: {e}"})
+            return
+        if self.path == "/tokenize":
+            tokens = TOKEN_RE.findall(str(body.get("content", "")))
+            self._send_json(200, {"tokens": list(range(len(tokens)))})
+            return
+        if self.path != "/v1/chat/completions":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        with _StubHandler.lock:
+            _StubHandler.requests += 1
+        time.sleep(self.delay)  # stands in for generation time
+        messages = body.get("messages", [])
+        text = fake_answer(messages)
+        prompt_words = sum(len(TOKEN_RE.findall(str(m.get("content", "")))) for m in messages)
+        self._send_json(200, {
+            "object": "chat.completion",
+            "model": "stub",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": prompt_words, "completion_tokens": len(text.split()),
+                      "total_tokens": prompt_words + len(text.split())},
+        })
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Stub llama.cpp server for tests")
+    p.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1)")
+    p.add_argument("--port", type=int, default=8080, help="Port (default: 8080; 0 = pick a free one)")
+    p.add_argument("--delay", type=float, default=0.0, help="Seconds to sleep per completion (fake generation time)")
+    p.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    args = p.parse_args()
+
+    _StubHandler.delay = args.delay
+    server = ThreadingHTTPServer((args.host, args.port), _StubHandler)
+    server.verbose = args.verbose
+    print(f"✅ Stub llama server on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
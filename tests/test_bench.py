@@ -0,0 +1,21 @@
+"""Smoke test: bench.py run end to end on a tiny corpus, for both script flavors."""
+import json
+
+import pytest
+
+from conftest import run_script
+
+pytestmark = pytest.mark.usefixtures("needs_embedder")
+
+
+@pytest.mark.parametrize("flavor", ["full", "ultralight"])
+def test_bench_run(flavor, tmp_path):
+    out = tmp_path / "bench.json"
+    run_script("bench.py", "run", "--flavor", flavor, "--scales", "30", "--queries", "5", "-k", "5",
+               "--workdir", tmp_path / "work", "--out", out)
+    [scale] = json.loads(out.read_text(encoding="utf-8"))["scales"]
+    for stage in ("validate", "build", "query"):
+        assert scale[stage]["returncode"] == 0, f"{stage} stage failed: {scale[stage]['cmd']}"
+    assert scale["build"]["embedded"] == 30
+    assert scale["query"]["queries"] == 5
+    assert 0.0 <= scale["query"]["recall_at_5"] <= 1.0
@@ -0,0 +1,91 @@
+"""Incremental build-index: the mtime fast path, --write-back and the .rag sidecars."""
+import json
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, run_script
+
+pytestmark = pytest.mark.usefixtures("needs_embedder")
+
+
+@pytest.fixture
+def data(tmp_path):
+    d = tmp_path / "data"
+    shutil.copytree(ROOT / "data_ultralight", d)
+    return d
+
+
+def snapshot(d):
+    return {p.name: (p.stat().st_mtime_ns, p.read_bytes()) for p in sorted(d.iterdir())}
+
+
+def build(data, store, *args):
+    return run_script("rag-ultralight.py", "build-index", "--data", data, "--out", store, *args).stdout
+
+
+def test_noop_rebuild_writes_nothing(data, tmp_path):
+    store = tmp_path / "store"
+    build(data, store, "--write-back")
+    before = snapshot(data)
+    assert "is up to date" in build(data, store, "--write-back")
+    assert snapshot(data) == before
+    assert "is up to date" in build(data, store)
+    assert snapshot(data) == before
+
+
+def test_missing_sidecar_is_recreated(data, tmp_path):
+    store = tmp_path / "store"
+    build(data, store)
+    sidecar = sorted(data.glob("*.rag"))[0]
+    text = sidecar.read_text(encoding="utf-8")
+    sidecar.unlink()
+    assert "is up to date" in build(data, store)  # the sidecar is rewritten, nothing re-embedded
+    assert sidecar.read_text(encoding="utf-8") == text
+
+
+def test_write_back_normalizes_untouched_lessons(data, tmp_path):
+    store = tmp_path / "store"
+    lesson = sorted(data.glob("*.json"))[0]
+    doc = json.loads(lesson.read_text(encoding="utf-8"))
+    doc.pop("rag", None)
+    lesson.write_text(json.dumps(doc), encoding="utf-8")
+    build(data, store)
+    assert "rag" not in json.loads(lesson.read_text(encoding="utf-8"))
+    # the lesson is unchanged since the last build, but --write-back still rewrites it
+    build(data, store, "--write-back")
+    written = json.loads(lesson.read_text(encoding="utf-8"))
+    assert written["rag"]["text"] == lesson.with_suffix(".rag").read_text(encoding="utf-8")
+
+
+def test_edited_lesson_is_reembedded(data, tmp_path):
+    store = tmp_path / "store"
+    build(data, store)
+    lesson = sorted(data.glob("*.json"))[0]
+    doc = json.loads(lesson.read_text(encoding="utf-8"))
+    doc.pop("rag", None)
+    doc["summary"] = "Vendor escrow was never tested. " + doc["summary"]
+    lesson.write_text(json.dumps(doc), encoding="utf-8")
+    out = build(data, store)
+    assert "(1 embedded, 1 removed, 4 unchanged)" in out
+    assert "Vendor escrow" in lesson.with_suffix(".rag").read_text(encoding="utf-8")
+
+
+def test_strict_build_leaves_failing_lesson_untouched(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    doc = json.loads(next((ROOT / "data").glob("*.json")).read_text(encoding="utf-8"))
+    doc.pop("rag", None)
+    doc["severity"] = "P9"  # not in the schema enum
+    lesson = data / "bad.json"
+    lesson.write_text(json.dumps(doc), encoding="utf-8")
+    before = lesson.read_bytes()
+    proc = subprocess.run([sys.executable, str(ROOT / "rag.py"), "build-index", "--data", data,
+                           "--out", tmp_path / "store", "--strict", "--write-back"],
+                          cwd=ROOT, capture_output=True, text=True, timeout=300)
+    assert proc.returncode == 2
+    assert "failed validation (strict mode)" in proc.stdout
+    assert lesson.read_bytes() == before
+    assert not lesson.with_suffix(".rag").exists()
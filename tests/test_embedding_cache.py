@@ -0,0 +1,76 @@
+"""rag_common.EmbeddingCache: concurrent writers and the output dimension in the cache key."""
+import multiprocessing
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rag_common import EmbeddingCache, sha256_text  # noqa: E402
+
+
+def vector(text, dim=8):
+    """Deterministic vector per text, so a slot holding another text's vector is detectable."""
+    return np.random.default_rng(int(sha256_text(text)[:8], 16)).standard_normal(dim).astype("float16")
+
+
+def fill(root, worker, rounds, persist):
+    cache = EmbeddingCache(root, "test/model", max_items=300)
+    cache.bind(8)
+    for r in range(rounds):
+        texts = [f"w{worker}-r{r}-{i}" for i in range(10)] + [f"shared-{r}-{i}" for i in range(5)]
+        cache.get_many([sha256_text(t) for t in texts])
+        cache.put_many([sha256_text(t) for t in texts], np.stack([vector(t) for t in texts]), persist=persist)
+    cache.save()
+
+
+@pytest.mark.parametrize("persist", [True, False])
+def test_concurrent_writers_keep_slots_consistent(tmp_path, persist):
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=fill, args=(tmp_path, w, 30, persist)) for w in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+        assert p.exitcode == 0
+
+    cache = EmbeddingCache(tmp_path, "test/model", max_items=300)
+    cache.bind(8)
+    texts = [f"w{w}-r{r}-{i}" for w in range(4) for r in range(30) for i in range(10)]
+    texts += [f"shared-{r}-{i}" for r in range(30) for i in range(5)]
+    hits = cache.get_many([sha256_text(t) for t in texts])
+    assert hits  # LRU keeps the most recent 300
+    by_digest = {sha256_text(t): t for t in texts}
+    for d, v in hits.items():
+        np.testing.assert_array_equal(v, vector(by_digest[d]).astype("float32"))
+    assert len({cache.keys[d][0] for d in cache.keys}) == len(cache.keys)  # one slot per key
+
+
+def test_other_dimension_is_a_miss(tmp_path):
+    texts = ["Do not skip the kickoff", "Do not assume client data is clean"]
+    digests = [sha256_text(t) for t in texts]
+    cache = EmbeddingCache(tmp_path, "test/model")
+    cache.bind(8)
+    cache.put_many(digests, np.stack([vector(t) for t in texts]))
+
+    other = EmbeddingCache(tmp_path, "test/model")
+    other.bind(16)
+    assert other.get_many(digests) == {}
+    other.put_many(digests, np.stack([vector(t, 16) for t in texts]))
+    assert other.get_many(digests)[digests[0]].shape == (16,)
+
+    same = EmbeddingCache(tmp_path, "test/model")
+    same.bind(8)
+    assert sorted(same.get_many(digests)) == sorted(digests)
+
+
+def test_keys_from_another_dimension_are_ignored(tmp_path):
+    texts = ["Do not skip the kickoff"]
+    cache = EmbeddingCache(tmp_path, "test/model")
+    cache.bind(8)
+    cache.put_many([sha256_text(t) for t in texts], np.stack([vector(t) for t in texts]))
+    # a stale cache dir whose keys.json claims another dimension (e.g. written by an older version)
+    stale = tmp_path / "test__model__d16"
+    (tmp_path / "test__model__d8").rename(stale)
+    other = EmbeddingCache(tmp_path, "test/model")
+    other.bind(16)
+    assert other.get_many([sha256_text(t) for t in texts]) == {}
@@ -0,0 +1,85 @@
+"""llama_rag_prompt: query_llama against the stub llama-server, its llama-cli fallback and --questions parsing."""
+import argparse
+import shutil
+import subprocess
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import llama_rag_prompt as lrp
+from conftest import ROOT
+from llama_stub_server import _StubHandler
+
+SYSTEM = "You are an expert Technical Project Manager coach."
+USER = ('CONTEXT_START\n{"results":[{"r":1,"impact":5,"do_not":"Do not skip the kickoff."}]}\nCONTEXT_END\n\n'
+        "QUESTION:\nHelp me prepare a Kickoff")
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    server.verbose = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def echo_cli(tmp_path):
+    """`echo` stands in for llama-cli: it prints the argv it was given and exits 0."""
+    echo = shutil.which("echo")
+    if echo is None:
+        pytest.skip("no echo binary")
+    model = tmp_path / "model.gguf"
+    model.write_bytes(b"")
+    return echo, str(model)
+
+
+def test_server_answers(stub_server, echo_cli):
+    server = lrp.LlamaServer(stub_server)
+    out = lrp.query_llama(SYSTEM, USER, *echo_cli, server=server)
+    assert out == "Do not skip the kickoff — impact 5 risk to the project"
+    # the keep-alive connection is reused for the next question
+    assert lrp.query_llama(SYSTEM, USER, *echo_cli, server=server) == out
+    assert server.tokenize("Do not skip it.") == 5
+
+
+def test_falls_back_to_cli_when_server_is_down(echo_cli):
+    server = lrp.LlamaServer("http://127.0.0.1:1")  # nothing listens on port 1
+    # twice: a failed request must not leave the connection unusable for the next one
+    for _ in range(2):
+        out = lrp.query_llama(SYSTEM, USER, *echo_cli, server=server)
+        assert "--system-prompt" in out and "Help me prepare a Kickoff" in out
+
+
+
+def test_bad_questions_line_is_a_clean_cli_error(tmp_path):
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text('{"q": "Kickoff for a biotech client"}\n{"q": ""}\n', encoding="utf-8")
+    with pytest.raises(ValueError, match=r"questions\.jsonl:2:"):
+        lrp.load_questions(str(questions))
+    proc = subprocess.run([sys.executable, "llama_rag_prompt.py", "--questions", str(questions)],
+                          cwd=ROOT, capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 2
+    assert "questions.jsonl:2: expected a non-empty string" in proc.stderr
+    assert "Traceback" not in proc.stderr
+
+
+def test_fixed_prompt_text_is_tokenized_once(stub_server):
+    server = lrp.LlamaServer(stub_server)
+    calls = []
+    tokenize = server.tokenize
+    server.tokenize = lambda text: calls.append(text) or tokenize(text)
+    count_tokens = lrp.TokenCounter(server)
+    args = argparse.Namespace(context_tokens=0, ctx_size=4096, n_predict=512, no_titles=False)
+    rag = {"query": "", "results": [{"title": "Kickoff", "impact": 5,
+                                     "do_not": "Do not skip the kickoff.", "do_instead": "Align first."}]}
+    for q in ("Kickoff for a biotech client", "Data migration for a retailer", "Timezone-split team"):
+        _, stats = lrp.build_prompt(args, q, dict(rag, query=q), count_tokens)
+        assert stats["lessons"] == 1 and stats["exact_tokens"]
+    assert calls.count(lrp.SYSTEM_MSG) == 1
+    assert calls.count(lrp.user_prompt("", "")) == 1
@@ -0,0 +1,72 @@
+"""Query-time filtering: rag.py --where, and rows collapsed by rag-ultralight.py build-index --dedupe."""
+import json
+import shutil
+
+import pytest
+
+from conftest import ROOT, query_json, run_script, write_lesson
+
+pytestmark = pytest.mark.usefixtures("needs_embedder")
+
+PHASES = ["Kickoff", "Design", "Build", "Test", "Deploy", "Operate"]
+
+
+@pytest.fixture(scope="module")
+def full_store(tmp_path_factory):
+    """rag.py store with one copy of the sample lesson per phase; severity alternates P1/P2."""
+    tmp = tmp_path_factory.mktemp("full")
+    src = json.loads(next((ROOT / "data").glob("*.json")).read_text(encoding="utf-8"))
+    (tmp / "data").mkdir()
+    for i, phase in enumerate(PHASES):
+        doc = dict(src, id=f"{src['id'][:-2]}{i:02d}", phase=phase, severity="P1" if i % 2 else "P2")
+        doc.pop("rag", None)
+        write_lesson(tmp / "data" / f"lesson-{i}.json", doc)
+    run_script("rag.py", "build-index", "--data", tmp / "data", "--out", tmp / "store")
+    return tmp / "store"
+
+
+def where(store, *filters, mode="dense"):
+    args = [a for f in filters for a in ("--where", f)]
+    res = query_json("rag.py", store, "stakeholder alignment", "-k", "10", "--mode", mode, *args)["results"]
+    return sorted(json.loads((ROOT / r["path"]).read_text(encoding="utf-8"))["phase"] for r in res)
+
+
+@pytest.mark.parametrize("mode", ["dense", "lexical", "hybrid"])
+def test_where_filters(full_store, mode):
+    assert where(full_store, mode=mode) == sorted(PHASES)
+    assert where(full_store, "phase=Design", mode=mode) == ["Design"]
+    # same field = OR, different fields = AND
+    assert where(full_store, "phase=Design", "phase=Build", mode=mode) == ["Build", "Design"]
+    assert where(full_store, "phase=Design", "phase=Build", "severity=P1", mode=mode) == ["Design"]
+    assert where(full_store, "phase!=Kickoff", "severity=P2", mode=mode) == ["Build", "Deploy"]
+    assert where(full_store, "phase=Closeout", mode=mode) == []
+
+
+
+@pytest.mark.parametrize("mode", ["dense", "lexical", "hybrid"])
+def test_k_below_one_is_clamped(full_store, mode):
+    res = query_json("rag.py", full_store, "stakeholder alignment", "-k", "0", "--mode", mode)
+    assert res["k"] == 1 and len(res["results"]) == 1
+
+@pytest.fixture(scope="module")
+def dup_store(tmp_path_factory):
+    """UltraLight store where one lesson has 30 identical copies, built with --dedupe."""
+    tmp = tmp_path_factory.mktemp("dup")
+    data = tmp / "data"
+    shutil.copytree(ROOT / "data_ultralight", data, ignore=shutil.ignore_patterns("*.rag"))
+    lesson = sorted(data.glob("*.json"))[0]
+    doc = json.loads(lesson.read_text(encoding="utf-8"))
+    for i in range(30):
+        write_lesson(data / f"copy-{i:02d}.json", dict(doc, id=f"{doc['id']}-{i:02d}"))
+    out = run_script("rag-ultralight.py", "build-index", "--data", data, "--out", tmp / "store", "--dedupe").stdout
+    assert "Collapsed 30 near-duplicate lesson(s) into 1 cluster(s)" in out
+    return tmp / "store", doc["title"]
+
+
+@pytest.mark.parametrize("mode", ["dense", "lexical", "hybrid"])
+def test_dedupe_still_returns_k(dup_store, mode):
+    store, title = dup_store
+    # the copies rank first and fill the candidate pool; collapsing them must not shrink the results
+    res = query_json("rag-ultralight.py", store, title, "-k", "5", "--pool", "10", "--mode", mode)["results"]
+    assert len(res) == 5
+    assert len({r["title"] for r in res}) == 5